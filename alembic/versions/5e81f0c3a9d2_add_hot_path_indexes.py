@@ -0,0 +1,54 @@
+"""add hot path indexes
+
+Revision ID: 5e81f0c3a9d2
+Revises: 7c2e9a4b5f10
+Create Date: 2026-10-18 12:20:05.731664
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5e81f0c3a9d2'
+down_revision: Union[str, Sequence[str], None] = '7c2e9a4b5f10'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Fusionar conversaciones duplicadas por user_id antes de exigir unicidad
+    op.execute("""
+        UPDATE messages SET conversation_id = (
+            SELECT MIN(c2.id) FROM conversations c1
+            JOIN conversations c2 ON c2.user_id = c1.user_id
+            WHERE c1.id = messages.conversation_id
+        )
+        WHERE conversation_id IN (
+            SELECT id FROM conversations c
+            WHERE id > (SELECT MIN(id) FROM conversations WHERE user_id = c.user_id)
+        )
+    """)
+    op.execute("""
+        DELETE FROM conversation_states WHERE conversation_id IN (
+            SELECT id FROM conversations c
+            WHERE id > (SELECT MIN(id) FROM conversations WHERE user_id = c.user_id)
+        )
+    """)
+    op.execute("""
+        DELETE FROM conversations
+        WHERE id > (SELECT MIN(id) FROM conversations c WHERE c.user_id = conversations.user_id)
+    """)
+    op.drop_index(op.f('ix_conversations_user_id'), table_name='conversations')
+    op.create_index(op.f('ix_conversations_user_id'), 'conversations', ['user_id'], unique=True)
+    op.create_index('ix_messages_conversation_id_timestamp', 'messages', ['conversation_id', 'timestamp'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_messages_conversation_id_timestamp', table_name='messages')
+    op.drop_index(op.f('ix_conversations_user_id'), table_name='conversations')
+    op.create_index(op.f('ix_conversations_user_id'), 'conversations', ['user_id'], unique=False)
@@ -0,0 +1,40 @@
+"""create conversation states table
+
+Revision ID: 7c2e9a4b5f10
+Revises: d31b312e132a
+Create Date: 2026-10-18 11:02:47.118305
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7c2e9a4b5f10'
+down_revision: Union[str, Sequence[str], None] = 'd31b312e132a'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('conversation_states',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('conversation_id', sa.Integer(), nullable=True),
+    sa.Column('model', sa.String(), nullable=True),
+    sa.Column('context', sa.Text(), nullable=True),
+    sa.Column('last_message_id', sa.Integer(), nullable=True),
+    sa.Column('updated_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['conversation_id'], ['conversations.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('conversation_id')
+    )
+    op.create_index(op.f('ix_conversation_states_id'), 'conversation_states', ['id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_conversation_states_id'), table_name='conversation_states')
+    op.drop_table('conversation_states')
@@ -0,0 +1,58 @@
+"""add messages full text search
+
+Revision ID: 9b4d6e2f1a73
+Revises: 5e81f0c3a9d2
+Create Date: 2026-10-18 18:05:41.208317
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9b4d6e2f1a73'
+down_revision: Union[str, Sequence[str], None] = '5e81f0c3a9d2'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Tabla FTS5 de contenido externo: el texto sigue solo en messages
+    op.execute("""
+        CREATE VIRTUAL TABLE messages_fts USING fts5(
+            content, conversation_id,
+            content='messages', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    """)
+    op.execute("""
+        CREATE TRIGGER messages_fts_ai AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts(rowid, content, conversation_id) VALUES (new.id, new.content, new.conversation_id);
+        END
+    """)
+    op.execute("""
+        CREATE TRIGGER messages_fts_ad AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts(messages_fts, rowid, content, conversation_id) VALUES ('delete', old.id, old.content, old.conversation_id);
+        END
+    """)
+    op.execute("""
+        CREATE TRIGGER messages_fts_au AFTER UPDATE OF content, conversation_id ON messages BEGIN
+            INSERT INTO messages_fts(messages_fts, rowid, content, conversation_id) VALUES ('delete', old.id, old.content, old.conversation_id);
+            INSERT INTO messages_fts(rowid, content, conversation_id) VALUES (new.id, new.content, new.conversation_id);
+        END
+    """)
+    # conversation_id solo sirve de filtro: peso 0 en el ranking
+    op.execute("INSERT INTO messages_fts(messages_fts, rank) VALUES ('rank', 'bm25(1.0, 0.0)')")
+    # Backfill de los mensajes existentes
+    op.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.execute("DROP TRIGGER IF EXISTS messages_fts_au")
+    op.execute("DROP TRIGGER IF EXISTS messages_fts_ad")
+    op.execute("DROP TRIGGER IF EXISTS messages_fts_ai")
+    op.execute("DROP TABLE IF EXISTS messages_fts")
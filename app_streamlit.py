@@ -209,6 +209,24 @@ if st.sidebar.button("ℹ️ Acerca de", use_container_width=True):
 st.title("🤖 Local AI Agent")
 st.markdown(f"**Modelo seleccionado:** {models[st.session_state.selected_model]}")
 
+def summarize_document(data: dict = None, files: dict = None):
+    """Llama a /documents/summarize y muestra el resultado"""
+    try:
+        response = requests.post(
+            f"{st.session_state.api_url}/documents/summarize",
+            data={"user_id": st.session_state.user_id, **(data or {})},
+            files=files,
+            timeout=600
+        )
+        if response.status_code == 200:
+            result = response.json()
+            st.markdown(result["summary"])
+            st.caption(f"{result['chunks']} fragmentos · {result['processing_time']} s")
+        else:
+            st.error(f"Error: {response.status_code} {response.json().get('detail', '')}")
+    except requests.exceptions.ConnectionError:
+        st.error(f"❌ No se puede conectar a la API en {st.session_state.api_url}")
+
 # Mostrar contenido según la herramienta seleccionada
 if st.session_state.current_tool == "chat":
     st.header("💬 Chat")
@@ -293,21 +311,24 @@ elif st.session_state.current_tool == "resumen":
             if uploaded_file:
                 st.success(f"Archivo cargado: {uploaded_file.name}")
                 if st.button("Resumir PDF"):
-                    st.info("Resumiendo PDF...")
+                    with st.spinner("Resumiendo PDF..."):
+                        summarize_document(files={"file": (uploaded_file.name, uploaded_file.getvalue(), "application/pdf")})
         
         elif st.session_state.summary_type == "url":
             st.markdown("### Ingresa una URL")
             url = st.text_input("Pega la URL de la página web:")
             if url:
                 if st.button("Resumir URL"):
-                    st.info(f"Resumiendo contenido de: {url}")
+                    with st.spinner(f"Resumiendo contenido de: {url}"):
+                        summarize_document(data={"url": url})
         
         elif st.session_state.summary_type == "text":
             st.markdown("### Ingresa el texto")
             text = st.text_area("Pega el texto a resumir:", height=200)
             if text:
                 if st.button("Resumir Texto"):
-                    st.info("Resumiendo texto...")
+                    with st.spinner("Resumiendo texto..."):
+                        summarize_document(data={"text": text})
 
 elif st.session_state.current_tool == "escribir":
     st.header("✍️ Herramienta de Escritura")
@@ -350,14 +371,48 @@ elif st.session_state.current_tool == "escribir":
 elif st.session_state.current_tool == "buscar":
     st.header("🔍 Búsqueda")
     
-    search_query = st.text_input("¿Qué deseas buscar?", placeholder="Ingresa tu búsqueda...")
+    search_query = st.text_input("¿Qué deseas buscar?", placeholder="Busca en tus conversaciones...")
+    search_sort = st.radio("Ordenar por", ["Relevancia", "Más recientes"], horizontal=True)
     
     if search_query and st.button("Buscar", use_container_width=True):
-        st.info(f"Buscando: {search_query}")
-        st.markdown("**Resultados rápidos:**")
-        st.markdown("- Resultado 1")
-        st.markdown("- Resultado 2")
-        st.markdown("- Resultado 3")
+        # Nueva búsqueda: empezar desde la primera página
+        st.session_state.search = {"query": search_query, "sort": search_sort, "hits": [], "cursor": None, "done": False}
+    
+    search = st.session_state.get("search")
+    if search and (not search["hits"] and not search["done"] or st.session_state.pop("search_more", False)):
+        try:
+            params = {
+                "q": search["query"],
+                "user_id": st.session_state.user_id,
+                "sort": "rank" if search["sort"] == "Relevancia" else "recent",
+                "highlight_start": "**",
+                "highlight_end": "**"
+            }
+            if search["cursor"]:
+                params["cursor"] = search["cursor"]
+            response = requests.get(f"{st.session_state.api_url}/search", params=params, timeout=30)
+            if response.status_code == 200:
+                result = response.json()
+                search["hits"].extend(result["hits"])
+                search["cursor"] = result["next_cursor"]
+                search["done"] = result["next_cursor"] is None
+            else:
+                st.error(f"Error: {response.status_code} {response.json().get('detail', '')}")
+                search["done"] = True
+        except requests.exceptions.ConnectionError:
+            st.error(f"❌ No se puede conectar a la API en {st.session_state.api_url}")
+            search["done"] = True
+    
+    if search:
+        if not search["hits"]:
+            st.info(f"Sin resultados para: {search['query']}")
+        for hit in search["hits"]:
+            icon = "👤" if hit["role"] == "user" else "🤖"
+            st.markdown(f"{icon} {hit['snippet']}")
+            st.caption(f"{hit['timestamp'][:16]} · relevancia {hit['score']}")
+        if not search["done"] and st.button("Cargar más", use_container_width=True):
+            st.session_state.search_more = True
+            st.rerun()
 
 elif st.session_state.current_tool == "leer":
     st.header("📖 Leer y Analizar")
@@ -375,6 +430,15 @@ elif st.session_state.current_tool == "leer":
         url = st.text_input("O proporciona una URL:")
         if url:
             st.success(f"URL ingresada: {url}")
+    
+    question = st.text_input("Pregunta sobre el documento (opcional):")
+    if (uploaded_file or url) and st.button("Analizar", use_container_width=True):
+        with st.spinner("Analizando documento..."):
+            data = {"question": question} if question else {}
+            if uploaded_file:
+                summarize_document(data=data, files={"file": (uploaded_file.name, uploaded_file.getvalue(), uploaded_file.type)})
+            else:
+                summarize_document(data={**data, "url": url})
 
 elif st.session_state.current_tool == "traducir":
     st.header("🌐 Traductor")
@@ -441,9 +505,12 @@ elif st.session_state.current_tool == "settings":
     
     if st.button("Probar conexión", use_container_width=True):
         try:
-            response = requests.get(f"{st.session_state.api_url}/health")
+            response = requests.get(f"{st.session_state.api_url}/ready")
             if response.status_code == 200:
                 st.success("✅ Conexión exitosa")
+            elif response.status_code == 503:
+                pending = [name for name, c in response.json()["components"].items() if c["required"] and c["state"] != "ready"]
+                st.warning(f"⏳ API iniciándose o sin dependencias: {', '.join(pending)}")
             else:
                 st.error("❌ Error en la conexión")
         except:
@@ -0,0 +1,382 @@
+"""
+Prueba de carga de /process contra un Ollama falso (benchmarks/fake_ollama.py)
+
+Lanza el Ollama falso y uvicorn main:app con directorios temporales (base de datos,
+caché, subidas y logs nuevos en cada ejecución), espera a /ready y ejecuta cada escenario
+con N clientes concurrentes durante --duration segundos:
+- plain: texto, respuesta completa
+- stream: texto con stream=true (SSE); TTFT = primer evento con token
+- image: imagen JPEG de 1920x1080 (preprocesado + modelo de visión)
+- audio: WAV de --audio-seconds segundos (almacén de subidas + Whisper si está instalado)
+
+Por escenario: throughput, latencia p50/p95/p99, TTFT, códigos de respuesta y retraso del
+event loop, tanto del servidor (histograma event_loop_lag_seconds de /metrics) como del propio
+generador de carga (si este se satura, las cifras del servidor no son fiables).
+El resultado se guarda en JSON (--output) para comparar ejecuciones.
+
+Con --url se usa un servidor ya arrancado (y su Ollama) en vez de lanzar ambos.
+
+Uso: python benchmarks/bench_load.py [--scenarios plain,stream,image,audio] [--concurrency 16]
+     [--duration 20] [--token-ms 20] [--failure-rate 0.01] [--env SCHEDULER_DEFAULT_CONCURRENCY=8]
+"""
+import argparse
+import asyncio
+import io
+import json
+import math
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+
+ROOT = Path(__file__).resolve().parent.parent
+SCENARIOS = ("plain", "stream", "image", "audio")
+
+
+# ===== Entradas =====
+def make_image() -> bytes:
+    from PIL import Image
+    # Degradado con ruido: no se comprime a casi nada como un color plano
+    rng = random.Random(0)
+    img = Image.radial_gradient("L").resize((1920, 1080)).convert("RGB")
+    noise = Image.frombytes("RGB", (480, 270), bytes(rng.getrandbits(8) for _ in range(480 * 270 * 3))).resize((1920, 1080))
+    out = io.BytesIO()
+    Image.blend(img, noise, 0.3).save(out, "JPEG", quality=90)
+    return out.getvalue()
+
+
+def make_audio(seconds: float, rate: int = 16000) -> bytes:
+    out = io.BytesIO()
+    with wave.open(out, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        frames = bytearray()
+        for i in range(int(seconds * rate)):
+            sample = int(8000 * math.sin(2 * math.pi * 440 * i / rate))
+            frames += sample.to_bytes(2, "little", signed=True)
+        wav.writeframes(bytes(frames))
+    return out.getvalue()
+
+
+# ===== Estadísticas =====
+def summarize(values: List[float]) -> Optional[dict]:
+    """Percentiles en ms (método de rango más cercano)"""
+    if not values:
+        return None
+    ordered = sorted(values)
+
+    def pct(p: float) -> float:
+        return ordered[min(len(ordered) - 1, max(0, math.ceil(p / 100 * len(ordered)) - 1))]
+
+    return {
+        "p50": round(pct(50) * 1000, 2),
+        "p95": round(pct(95) * 1000, 2),
+        "p99": round(pct(99) * 1000, 2),
+        "mean": round(statistics.fmean(ordered) * 1000, 2),
+        "max": round(ordered[-1] * 1000, 2)
+    }
+
+
+def parse_histogram(metrics_text: str, name: str) -> Tuple[Dict[float, float], float, float]:
+    """Buckets acumulados (sumando todas las etiquetas), suma y conteo de un histograma"""
+    buckets: Dict[float, float] = {}
+    total = count = 0.0
+    for line in metrics_text.splitlines():
+        if not line.startswith(name):
+            continue
+        series, value = line.rsplit(" ", 1)
+        if series.startswith(f"{name}_bucket"):
+            le = series.split('le="', 1)[1].split('"', 1)[0]
+            bound = math.inf if le == "+Inf" else float(le)
+            buckets[bound] = buckets.get(bound, 0.0) + float(value)
+        elif series.startswith(f"{name}_sum"):
+            total += float(value)
+        elif series.startswith(f"{name}_count"):
+            count += float(value)
+    return buckets, total, count
+
+
+def histogram_delta(before: str, after: str, name: str) -> Optional[dict]:
+    """Percentiles (ms, interpolados dentro del bucket) de lo observado entre dos lecturas de /metrics"""
+    b0, s0, c0 = parse_histogram(before, name)
+    b1, s1, c1 = parse_histogram(after, name)
+    count = c1 - c0
+    if count <= 0:
+        return None
+    bounds = sorted(b1)
+    cumulative = [b1[bound] - b0.get(bound, 0.0) for bound in bounds]
+
+    def quantile(q: float) -> float:
+        rank = q * count
+        lower, below = 0.0, 0.0
+        for bound, seen in zip(bounds, cumulative):
+            if seen >= rank:
+                if math.isinf(bound):
+                    return lower # Por encima del último bucket: cota inferior
+                return lower + (bound - lower) * (rank - below) / max(seen - below, 1e-9)
+            lower, below = bound, seen
+        return lower
+
+    return {
+        "samples": int(count),
+        "p50": round(quantile(0.50) * 1000, 3),
+        "p99": round(quantile(0.99) * 1000, 3),
+        "mean": round((s1 - s0) / count * 1000, 3)
+    }
+
+
+# ===== Carga =====
+async def one_request(client: httpx.AsyncClient, scenario: str, user_id: str, n: int, payloads: dict) -> dict:
+    data = {"user_id": user_id, "text": f"Pregunta de prueba número {n}: explica algo breve", "no_cache": "true"}
+    files = None
+    if scenario == "stream":
+        data["stream"] = "true"
+    elif scenario == "image":
+        files = {"file": ("foto.jpg", payloads["image"], "image/jpeg")}
+    elif scenario == "audio":
+        files = {"file": ("audio.wav", payloads["audio"], "audio/wav")}
+
+    start = time.perf_counter()
+    ttft = None
+    error = None
+    try:
+        if scenario == "stream":
+            async with client.stream("POST", "/process", data=data) as response:
+                status = response.status_code
+                event = None
+                async for line in response.aiter_lines():
+                    if line.startswith("event:"):
+                        event = line[6:].strip()
+                    elif line.startswith("data:"):
+                        if event == "error":
+                            error = json.loads(line[5:]).get("error", "error")
+                        elif ttft is None and event is None:
+                            ttft = time.perf_counter() - start
+                        event = None
+        else:
+            response = await client.post("/process", data=data, files=files)
+            status = response.status_code
+            if status == 200 and response.json().get("model") == "error":
+                error = response.json().get("response")
+    except httpx.HTTPError as e:
+        status = 0
+        error = type(e).__name__
+    return {"latency": time.perf_counter() - start, "ttft": ttft, "status": status, "error": error}
+
+
+async def loop_lag_monitor(samples: List[float], interval: float = 0.05):
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, loop.time() - start - interval))
+
+
+async def run_scenario(base_url: str, scenario: str, args, payloads: dict) -> dict:
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=args.timeout, limits=limits) as client:
+        before = (await client.get("/metrics")).text
+        results: List[dict] = []
+        client_lag: List[float] = []
+        counter = iter(range(10**9))
+        deadline = time.perf_counter() + args.duration
+
+        async def worker(w: int):
+            # Varios usuarios por escenario: conversaciones y buckets del rate limiter distintos
+            user_id = f"bench-{scenario}-{w % args.users}"
+            while time.perf_counter() < deadline:
+                n = next(counter)
+                if args.requests and n >= args.requests:
+                    return
+                results.append(await one_request(client, scenario, user_id, n, payloads))
+
+        monitor = asyncio.create_task(loop_lag_monitor(client_lag))
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(w) for w in range(args.concurrency)))
+        elapsed = time.perf_counter() - start
+        monitor.cancel()
+        after = (await client.get("/metrics")).text
+
+    ok = [r for r in results if r["status"] == 200 and r["error"] is None]
+    statuses: Dict[str, int] = {}
+    for r in results:
+        statuses[str(r["status"])] = statuses.get(str(r["status"]), 0) + 1
+    return {
+        "requests": len(results),
+        "ok": len(ok),
+        "errors": len(results) - len(ok),
+        "status_codes": statuses,
+        "elapsed_s": round(elapsed, 2),
+        "throughput_rps": round(len(ok) / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": summarize([r["latency"] for r in ok]),
+        "ttft_ms": summarize([r["ttft"] for r in ok if r["ttft"] is not None]),
+        "event_loop_lag_ms": {
+            "server": histogram_delta(before, after, "event_loop_lag_seconds"),
+            "client": summarize(client_lag)
+        },
+        "server_queue_wait_ms": histogram_delta(before, after, "scheduler_queue_wait_seconds"),
+        "server_db_query_ms": histogram_delta(before, after, "db_query_seconds")
+    }
+
+
+# ===== Servidores =====
+def wait_ready(base_url: str, timeout: float = 120.0) -> dict:
+    deadline = time.perf_counter() + timeout
+    with httpx.Client(base_url=base_url, timeout=2.0) as client:
+        while time.perf_counter() < deadline:
+            try:
+                response = client.get("/ready")
+                if response.status_code == 200:
+                    return response.json()
+            except httpx.TransportError:
+                pass
+            time.sleep(0.1)
+    raise RuntimeError(f"{base_url} no está listo tras {timeout}s")
+
+
+def wait_listening(url: str, timeout: float = 30.0):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            httpx.get(url, timeout=1.0)
+            return
+        except httpx.TransportError:
+            time.sleep(0.05)
+    raise RuntimeError(f"{url} no responde tras {timeout}s")
+
+
+def start_servers(args, tmp: Path) -> Tuple[List[subprocess.Popen], str]:
+    fake = subprocess.Popen(
+        [sys.executable, str(ROOT / "benchmarks" / "fake_ollama.py"), "--port", str(args.ollama_port),
+         "--prefill-ms", str(args.prefill_ms), "--token-ms", str(args.token_ms), "--tokens", str(args.tokens),
+         "--failure-rate", str(args.failure_rate), "--stream-error-rate", str(args.stream_error_rate)],
+        cwd=ROOT
+    )
+    wait_listening(f"http://127.0.0.1:{args.ollama_port}/api/tags")
+    env = {
+        **os.environ,
+        "OLLAMA_HOST": f"http://127.0.0.1:{args.ollama_port}",
+        "OLLAMA_HOSTS": "[]",
+        "BASE_DIR": str(tmp),
+        "CACHE_DIR": str(tmp / "cache"),
+        "LOGS_DIR": str(tmp / "logs"),
+        "UPLOADS_DIR": str(tmp / "uploads"),
+        # Sin límite por usuario: se mide el servidor, no el rate limiter
+        "RATE_LIMIT_MAX_REQUESTS": "1000000000",
+    }
+    for override in args.env:
+        key, _, value = override.partition("=")
+        env[key] = value
+    for name in ("cache", "logs", "uploads"):
+        (tmp / name).mkdir(exist_ok=True)
+    app = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(args.port), "--workers", str(args.workers),
+         "--log-level", "warning", "--no-access-log"],
+        cwd=ROOT, env=env
+    )
+    return [app, fake], f"http://127.0.0.1:{args.port}"
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_summary(name: str, r: dict):
+    print(f"== {name}: {r['ok']}/{r['requests']} ok, {r['throughput_rps']} req/s ==")
+    if r["latency_ms"]:
+        lat = r["latency_ms"]
+        print(f"  latencia ms: p50={lat['p50']} p95={lat['p95']} p99={lat['p99']} max={lat['max']}")
+    if r["ttft_ms"]:
+        print(f"  TTFT ms: p50={r['ttft_ms']['p50']} p95={r['ttft_ms']['p95']} p99={r['ttft_ms']['p99']}")
+    server_lag = r["event_loop_lag_ms"]["server"]
+    client_lag = r["event_loop_lag_ms"]["client"]
+    if server_lag:
+        print(f"  event loop servidor ms: p50={server_lag['p50']} p99={server_lag['p99']}")
+    if client_lag:
+        print(f"  event loop cliente ms: p99={client_lag['p99']} max={client_lag['max']}")
+    if r["errors"]:
+        print(f"  códigos: {r['status_codes']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--concurrency", type=int, default=16, help="Clientes simultáneos")
+    parser.add_argument("--duration", type=float, default=20.0, help="Segundos por escenario")
+    parser.add_argument("--requests", type=int, default=0, help="Máximo de peticiones por escenario (0 = sin límite)")
+    parser.add_argument("--users", type=int, default=8, help="Usuarios distintos por escenario")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--audio-seconds", type=float, default=5.0)
+    parser.add_argument("--url", help="Servidor ya arrancado (no se lanzan main.py ni el Ollama falso)")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--workers", type=int, default=1, help="Workers de uvicorn")
+    parser.add_argument("--env", action="append", default=[], help="KEY=VALUE para la configuración de main.py")
+    parser.add_argument("--ollama-port", type=int, default=11500)
+    parser.add_argument("--prefill-ms", type=float, default=100.0)
+    parser.add_argument("--token-ms", type=float, default=20.0)
+    parser.add_argument("--tokens", type=int, default=64)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--stream-error-rate", type=float, default=0.0)
+    parser.add_argument("--output", help="Archivo JSON (por defecto benchmarks/results/load_<fecha>.json)")
+    args = parser.parse_args()
+
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Escenarios desconocidos: {', '.join(sorted(unknown))}")
+    payloads = {
+        "image": make_image() if "image" in scenarios else None,
+        "audio": make_audio(args.audio_seconds) if "audio" in scenarios else None
+    }
+
+    processes: List[subprocess.Popen] = []
+    with tempfile.TemporaryDirectory(prefix="bench_load_") as tmp:
+        try:
+            if args.url:
+                base_url = args.url.rstrip("/")
+            else:
+                processes, base_url = start_servers(args, Path(tmp))
+            t = time.perf_counter()
+            ready = wait_ready(base_url)
+            print(f"Servidor listo en {time.perf_counter() - t:.1f}s ({base_url})")
+
+            results = {}
+            for scenario in scenarios:
+                results[scenario] = asyncio.run(run_scenario(base_url, scenario, args, payloads))
+                print_summary(scenario, results[scenario])
+        finally:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                process.wait()
+
+    report = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "config": {k: v for k, v in vars(args).items() if k != "output"},
+        "components": {name: c["state"] for name, c in ready["components"].items()},
+        "scenarios": results
+    }
+    output = Path(args.output) if args.output else ROOT / "benchmarks" / "results" / f"load_{datetime.now():%Y%m%d_%H%M%S}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2, ensure_ascii=False))
+    print(f"Resultados: {output}")
+
+
+if __name__ == "__main__":
+    main()
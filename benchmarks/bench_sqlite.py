@@ -0,0 +1,127 @@
+"""
+Micro-benchmark de SQLite para la ruta caliente de /process
+
+Compara el esquema/configuración original (journal rollback, synchronous FULL,
+sin índice compuesto) con el perfil de settings.py y los índices de la
+migración 5e81f0c3a9d2.
+
+Uso: python benchmarks/bench_sqlite.py [--conversations 2000] [--messages 50] [--queries 2000]
+"""
+import argparse
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from settings import settings
+
+SCHEMA = """
+CREATE TABLE conversations (id INTEGER PRIMARY KEY, user_id VARCHAR, created_at DATETIME, updated_at DATETIME);
+CREATE INDEX ix_conversations_id ON conversations (id);
+CREATE TABLE messages (id INTEGER PRIMARY KEY, conversation_id INTEGER REFERENCES conversations(id),
+                       role VARCHAR, content TEXT, timestamp DATETIME);
+CREATE INDEX ix_messages_id ON messages (id);
+"""
+BASELINE_INDEXES = "CREATE INDEX ix_conversations_user_id ON conversations (user_id);"
+TUNED_INDEXES = """
+CREATE UNIQUE INDEX ix_conversations_user_id ON conversations (user_id);
+CREATE INDEX ix_messages_conversation_id_timestamp ON messages (conversation_id, timestamp);
+"""
+
+HOT_QUERY = """
+SELECT id, role, content FROM messages
+WHERE conversation_id = (SELECT id FROM conversations WHERE user_id = ?) AND id > 0
+ORDER BY timestamp DESC, id DESC LIMIT 40
+"""
+
+
+def connect(path: Path, tuned: bool) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, isolation_level=None)
+    if tuned:
+        conn.execute(f"PRAGMA journal_mode={settings.SQLITE_JOURNAL_MODE}")
+        conn.execute(f"PRAGMA synchronous={settings.SQLITE_SYNCHRONOUS}")
+        conn.execute(f"PRAGMA cache_size={settings.SQLITE_CACHE_SIZE}")
+        conn.execute(f"PRAGMA mmap_size={settings.SQLITE_MMAP_SIZE}")
+        conn.execute(f"PRAGMA busy_timeout={settings.SQLITE_BUSY_TIMEOUT}")
+    else:
+        conn.execute("PRAGMA journal_mode=DELETE")
+        conn.execute("PRAGMA synchronous=FULL")
+    return conn
+
+
+def populate(conn: sqlite3.Connection, tuned: bool, conversations: int, messages: int):
+    conn.executescript(SCHEMA + (TUNED_INDEXES if tuned else BASELINE_INDEXES))
+    start = datetime(2025, 1, 1)
+    conn.execute("BEGIN")
+    conn.executemany(
+        "INSERT INTO conversations (id, user_id) VALUES (?, ?)",
+        ((i, f"user{i}") for i in range(1, conversations + 1))
+    )
+    # Mensajes intercalados entre conversaciones, como en producción
+    rows = (
+        (c, "user" if m % 2 == 0 else "assistant", "x" * 200, start + timedelta(seconds=m * conversations + c))
+        for m in range(messages) for c in range(1, conversations + 1)
+    )
+    conn.executemany("INSERT INTO messages (conversation_id, role, content, timestamp) VALUES (?, ?, ?, ?)", rows)
+    conn.execute("COMMIT")
+
+
+def bench_reads(conn: sqlite3.Connection, conversations: int, queries: int) -> list:
+    rng = random.Random(42)
+    timings = []
+    for _ in range(queries):
+        user = f"user{rng.randint(1, conversations)}"
+        t = time.perf_counter()
+        conn.execute(HOT_QUERY, (user,)).fetchall()
+        timings.append(time.perf_counter() - t)
+    return timings
+
+
+def bench_writes(conn: sqlite3.Connection, conversations: int, inserts: int) -> float:
+    """Un commit por mensaje, como hacía /process"""
+    rng = random.Random(7)
+    t = time.perf_counter()
+    for _ in range(inserts):
+        conn.execute(
+            "INSERT INTO messages (conversation_id, role, content, timestamp) VALUES (?, 'user', 'hola', ?)",
+            (rng.randint(1, conversations), datetime.utcnow())
+        )
+    return inserts / (time.perf_counter() - t)
+
+
+def percentile(values: list, p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--conversations", type=int, default=2000)
+    parser.add_argument("--messages", type=int, default=50, help="Mensajes por conversación")
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--inserts", type=int, default=500)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, tuned in (("original", False), ("perfil+índices", True)):
+            path = Path(tmp) / f"{'tuned' if tuned else 'baseline'}.db"
+            conn = connect(path, tuned)
+            populate(conn, tuned, args.conversations, args.messages)
+            plan = conn.execute("EXPLAIN QUERY PLAN " + HOT_QUERY, ("user1",)).fetchall()
+            reads = bench_reads(conn, args.conversations, args.queries)
+            writes = bench_writes(conn, args.conversations, args.inserts)
+            conn.close()
+            print(f"== {label} ==")
+            print("  plan: " + " | ".join(row[-1] for row in plan))
+            print(f"  lectura historial: p50={statistics.median(reads) * 1000:.3f} ms "
+                  f"p95={percentile(reads, 0.95) * 1000:.3f} ms")
+            print(f"  inserciones con commit: {writes:.0f} msg/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Benchmark de arranque: tiempo de import de main.py y tiempo hasta /health y /ready
+
+- import: `python -c "import main"` en un proceso nuevo (mediana de --runs)
+- arranque: lanza uvicorn y sondea cada 10 ms; mide cuándo /health responde (el proceso
+  acepta peticiones) y cuándo /ready deja de tener componentes en calentamiento
+
+Con Ollama apagado /ready termina en 503 (ollama: failed); el tiempo se mide igual.
+
+Uso: python benchmarks/bench_startup.py [--runs 5] [--port 8765]
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import httpx
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def time_import() -> float:
+    t = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "import main"], cwd=ROOT, check=True, capture_output=True)
+    return time.perf_counter() - t
+
+
+def time_startup(port: int, timeout: float = 120.0) -> dict:
+    t = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    live = ready = None
+    status = {}
+    try:
+        with httpx.Client(base_url=f"http://127.0.0.1:{port}", timeout=1.0) as client:
+            while time.perf_counter() - t < timeout:
+                try:
+                    if live is None and client.get("/health").status_code == 200:
+                        live = time.perf_counter() - t
+                    if live is not None:
+                        status = client.get("/ready").json()
+                        states = [c["state"] for c in status["components"].values()]
+                        if not any(state in ("pending", "warming") for state in states):
+                            ready = time.perf_counter() - t
+                            break
+                except httpx.TransportError:
+                    pass
+                time.sleep(0.01)
+    finally:
+        server.terminate()
+        server.wait()
+    return {"live": live, "ready": ready, "status": status}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    imports = [time_import() for _ in range(args.runs)]
+    print(f"import main: mediana={statistics.median(imports) * 1000:.0f} ms "
+          f"min={min(imports) * 1000:.0f} ms")
+
+    runs = [time_startup(args.port) for _ in range(args.runs)]
+    lives = [r["live"] for r in runs if r["live"] is not None]
+    readies = [r["ready"] for r in runs if r["ready"] is not None]
+    if lives:
+        print(f"hasta /health: mediana={statistics.median(lives) * 1000:.0f} ms")
+    if readies:
+        print(f"hasta /ready estable: mediana={statistics.median(readies) * 1000:.0f} ms")
+    last = runs[-1]["status"]
+    if last:
+        print(f"último /ready: ready={last['ready']}")
+        for name, component in last["components"].items():
+            duration = f" {component['duration_ms']:.0f} ms" if "duration_ms" in component else ""
+            print(f"  {name}: {component['state']}{duration}")
+
+
+if __name__ == "__main__":
+    main()
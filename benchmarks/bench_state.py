@@ -0,0 +1,109 @@
+"""
+Benchmark del estado compartido (state_backend) con uno y varios workers
+
+Cada worker es un proceso que imita lo que hace un worker de uvicorn por petición:
+una comprobación del rate limiter (token bucket con update atómico) y una lectura
+del caché de respuestas, escribiendo la respuesta si falla. Para cada backend se mide:
+- throughput total (peticiones/s)
+- tasa de aciertos agregada del caché
+- peticiones admitidas a un mismo usuario frente al límite configurado
+  (con memory cada worker tiene su propio bucket: el límite efectivo se multiplica)
+
+Uso: python benchmarks/bench_state.py [--workers 4] [--requests 5000] [--keys 2000] [--limit 100]
+"""
+import argparse
+import json
+import multiprocessing
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from state_backend import open_store
+
+
+def take_token(capacity: int, rate: float):
+    """Mismo cálculo que TokenBucketRateLimiter.check en main.py"""
+    def take(current):
+        now = time.time()
+        tokens, updated_at = json.loads(current) if current else (capacity, now)
+        tokens = min(capacity, tokens + max(0.0, now - updated_at) * rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        return json.dumps([tokens, now]), now + (capacity - tokens) / rate, allowed
+    return take
+
+
+def worker(backend: str, path: str, seed: int, requests: int, keys: int, limit: int, start, results):
+    cache = open_store(backend, Path(path), "entries", max_entries=keys * 2)
+    limiter = open_store(backend, Path(path), "rate_limits", max_entries=10_000)
+    # Ventana larga: durante el benchmark solo cuenta la capacidad del bucket
+    take = take_token(limit, limit / 3600)
+    rng = random.Random(seed)
+    payload = json.dumps({"content": "x" * 500, "model": "llama3.1:8b", "tokens": 120})
+    hits = allowed = 0
+    start.wait()
+    t = time.perf_counter()
+    for _ in range(requests):
+        allowed += limiter.update("usuario-compartido", take)
+        key = f"k{int(rng.paretovariate(1.2)) % keys}" # Pocas claves muy repetidas, como prompts reales
+        if cache.get(key):
+            hits += 1
+        else:
+            cache.set(key, payload, time.time() + 3600)
+    results.put((time.perf_counter() - t, hits, allowed))
+    cache.close()
+    limiter.close()
+
+
+def run(backend: str, workers: int, args) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        path = str(Path(tmp) / "state.db")
+        # Crear las tablas antes de lanzar los workers
+        open_store(backend, Path(path), "entries", 1).close()
+        open_store(backend, Path(path), "rate_limits", 1).close()
+        ctx = multiprocessing.get_context("spawn")
+        start = ctx.Barrier(workers + 1)
+        results = ctx.Queue()
+        processes = [
+            ctx.Process(target=worker, args=(backend, path, seed, args.requests, args.keys, args.limit, start, results))
+            for seed in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        start.wait()
+        t = time.perf_counter()
+        outcomes = [results.get() for _ in processes]
+        elapsed = time.perf_counter() - t
+        for process in processes:
+            process.join()
+    total = workers * args.requests
+    return {
+        "throughput": total / elapsed,
+        "hit_rate": sum(hits for _, hits, _ in outcomes) / total,
+        "allowed": sum(allowed for _, _, allowed in outcomes)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=5000, help="Peticiones por worker")
+    parser.add_argument("--keys", type=int, default=2000, help="Claves distintas del caché")
+    parser.add_argument("--limit", type=int, default=100, help="Capacidad del bucket del usuario compartido")
+    args = parser.parse_args()
+
+    for backend in ("memory", "sqlite"):
+        for workers in sorted({1, args.workers}):
+            r = run(backend, workers, args)
+            print(f"== {backend}, {workers} worker(s) ==")
+            print(f"  throughput: {r['throughput']:.0f} peticiones/s")
+            print(f"  aciertos de caché: {r['hit_rate']:.1%}")
+            print(f"  admitidas al mismo usuario: {r['allowed']} (límite {args.limit})")
+
+
+if __name__ == "__main__":
+    main()
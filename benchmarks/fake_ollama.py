@@ -0,0 +1,126 @@
+"""
+Servidor Ollama falso para pruebas de carga sin GPU
+
+Implementa lo que usa main.py: /api/tags, /api/ps, /api/generate (con y sin stream,
+incluida la precarga/descarga sin prompt) y /api/embed. Las respuestas tardan lo que
+se configure y devuelven eval_count/eval_duration coherentes con esa velocidad.
+
+- --prefill-ms: espera antes del primer token (carga + prompt_eval)
+- --token-ms: tiempo entre tokens (velocidad de streaming: 20 ms = 50 tokens/s)
+- --tokens: tokens por respuesta
+- --failure-rate: fracción de peticiones que responden 500 antes de generar
+- --stream-error-rate: fracción de streams que se cortan con {"error": ...} a mitad
+
+Uso: python benchmarks/fake_ollama.py [--port 11500] [--token-ms 20] [--failure-rate 0.01]
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+WORDS = ("Hola", " desde", " el", " modelo", " local", " de", " pruebas", ",", " sin", " GPU", ".")
+EMBEDDING_DIM = 768
+
+
+def create_app(prefill_ms: float = 100.0, token_ms: float = 20.0, tokens: int = 64,
+               failure_rate: float = 0.0, stream_error_rate: float = 0.0,
+               models: tuple = ("llama3.1:8b", "llava:13b", "nomic-embed-text"), seed: int = 0) -> FastAPI:
+    app = FastAPI()
+    rng = random.Random(seed)
+    stats = {"generate": 0, "embed": 0, "failures": 0}
+
+    def final_stats(prompt: str) -> dict:
+        prompt_tokens = max(1, len(prompt) // 4)
+        return {
+            "done": True,
+            "eval_count": tokens,
+            "eval_duration": int(tokens * token_ms * 1e6),
+            "prompt_eval_count": prompt_tokens,
+            "prompt_eval_duration": int(prefill_ms * 1e6),
+            "load_duration": 0,
+            "total_duration": int((prefill_ms + tokens * token_ms) * 1e6),
+            "context": list(range(prompt_tokens + tokens))[:4096]
+        }
+
+    @app.get("/api/tags")
+    async def tags():
+        return {"models": [{"name": name, "size": 4_000_000_000} for name in models]}
+
+    @app.get("/api/ps")
+    async def ps():
+        return {"models": [{"name": name, "size": 4_000_000_000, "size_vram": 0} for name in models]}
+
+    @app.get("/stats")
+    async def get_stats():
+        return stats
+
+    @app.post("/api/embed")
+    async def embed(request: Request):
+        body = await request.json()
+        stats["embed"] += 1
+        texts = body.get("input") or []
+        texts = [texts] if isinstance(texts, str) else texts
+        await asyncio.sleep(0.001 * len(texts))
+        return {"embeddings": [[rng.random() for _ in range(EMBEDDING_DIM)] for _ in texts], "load_duration": 0}
+
+    @app.post("/api/generate")
+    async def generate(request: Request):
+        body = await request.json()
+        stats["generate"] += 1
+        if "prompt" not in body:
+            # Precarga (keep_alive) o descarga (keep_alive 0) de main.py
+            return {"model": body.get("model"), "done": True, "response": "", "load_duration": 0}
+        if rng.random() < failure_rate:
+            stats["failures"] += 1
+            return JSONResponse({"error": "fallo simulado"}, status_code=500)
+        prompt = body.get("prompt", "")
+
+        if not body.get("stream", True):
+            await asyncio.sleep((prefill_ms + tokens * token_ms) / 1000)
+            text = "".join(WORDS[i % len(WORDS)] for i in range(tokens))
+            return {"model": body["model"], "response": text, **final_stats(prompt)}
+
+        fail_at = rng.randrange(tokens) if rng.random() < stream_error_rate else None
+
+        async def stream():
+            await asyncio.sleep(prefill_ms / 1000)
+            # Reloj absoluto: la velocidad no se degrada por el coste de cada iteración
+            start = time.perf_counter()
+            for i in range(tokens):
+                if i == fail_at:
+                    stats["failures"] += 1
+                    yield json.dumps({"error": "stream cortado (simulado)"}) + "\n"
+                    return
+                delay = start + i * token_ms / 1000 - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                yield json.dumps({"model": body["model"], "response": WORDS[i % len(WORDS)], "done": False}) + "\n"
+            yield json.dumps({"model": body["model"], "response": "", **final_stats(prompt)}) + "\n"
+
+        return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=11500)
+    parser.add_argument("--prefill-ms", type=float, default=100.0)
+    parser.add_argument("--token-ms", type=float, default=20.0)
+    parser.add_argument("--tokens", type=int, default=64)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--stream-error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    import uvicorn
+    app = create_app(args.prefill_ms, args.token_ms, args.tokens, args.failure_rate, args.stream_error_rate, seed=args.seed)
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
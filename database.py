@@ -1,6 +1,7 @@
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, ForeignKey, Boolean
+from sqlalchemy import create_engine, event, Column, Integer, String, Text, DateTime, ForeignKey, Boolean, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from datetime import datetime
 from settings import settings
 
@@ -9,15 +10,39 @@ DATABASE_URL = f"sqlite:///{settings.BASE_DIR / 'conversations.db'}"
 
 engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+# Motor asíncrono para la ruta caliente de /process (el síncrono queda para Alembic y scripts)
+ASYNC_DATABASE_URL = f"sqlite+aiosqlite:///{settings.BASE_DIR / 'conversations.db'}"
+async_engine = create_async_engine(ASYNC_DATABASE_URL)
+# expire_on_commit=False: los objetos siguen usables tras commit sin otro SELECT
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+def _apply_sqlite_profile(dbapi_connection, connection_record):
+    """Perfil de rendimiento de SQLite, aplicado a cada conexión nueva"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA journal_mode={settings.SQLITE_JOURNAL_MODE}")
+    cursor.execute(f"PRAGMA synchronous={settings.SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA cache_size={settings.SQLITE_CACHE_SIZE}")
+    cursor.execute(f"PRAGMA mmap_size={settings.SQLITE_MMAP_SIZE}")
+    cursor.execute(f"PRAGMA busy_timeout={settings.SQLITE_BUSY_TIMEOUT}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+event.listen(engine, "connect", _apply_sqlite_profile)
+event.listen(async_engine.sync_engine, "connect", _apply_sqlite_profile)
+
 Base = declarative_base()
 
 class Conversation(Base):
     __tablename__ = "conversations"
 
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(String, index=True)
+    user_id = Column(String, index=True, unique=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # Resumen acumulado de los mensajes que ya no entran en la ventana de contexto
+    summary = Column(Text, nullable=True)
+    summary_until_id = Column(Integer, default=0) # Último Message.id incluido en el resumen
 
     messages = relationship("Message", back_populates="conversation", cascade="all, delete-orphan")
 
@@ -32,7 +57,58 @@ class Message(Base):
 
     conversation = relationship("Conversation", back_populates="messages")
 
+    __table_args__ = (
+        # Ruta caliente: mensajes de una conversación ordenados por tiempo
+        Index("ix_messages_conversation_id_timestamp", "conversation_id", "timestamp"),
+    )
+
+class ConversationState(Base):
+    """Estado de continuación de Ollama (array `context`) para reutilizar el prefill"""
+    __tablename__ = "conversation_states"
+
+    id = Column(Integer, primary_key=True, index=True)
+    conversation_id = Column(Integer, ForeignKey("conversations.id"), unique=True)
+    model = Column(String)
+    context = Column(Text) # JSON con los tokens devueltos por /api/generate
+    last_message_id = Column(Integer) # Último Message.id cubierto por el contexto
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+# Búsqueda de texto completo sobre messages: tabla FTS5 de contenido externo (no duplica el texto)
+# sincronizada por triggers. conversation_id se indexa como token para filtrar por usuario
+# dentro del propio índice; su peso en bm25 es 0. Misma definición que la migración 9b4d6e2f1a73
+MESSAGES_FTS = "messages_fts"
+MESSAGES_FTS_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        content, conversation_id,
+        content='messages', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts(rowid, content, conversation_id) VALUES (new.id, new.content, new.conversation_id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, content, conversation_id) VALUES ('delete', old.id, old.content, old.conversation_id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF content, conversation_id ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, content, conversation_id) VALUES ('delete', old.id, old.content, old.conversation_id);
+        INSERT INTO messages_fts(rowid, content, conversation_id) VALUES (new.id, new.content, new.conversation_id);
+    END""",
+    "INSERT INTO messages_fts(messages_fts, rank) VALUES ('rank', 'bm25(1.0, 0.0)')",
+]
+
+def create_message_search(connection):
+    """Crea el índice FTS5 si falta y lo rellena con los mensajes existentes"""
+    exists = connection.exec_driver_sql(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'"
+    ).first()
+    for statement in MESSAGES_FTS_DDL:
+        connection.exec_driver_sql(statement)
+    if not exists:
+        connection.exec_driver_sql("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+
 # Función para crear todas las tablas
 def create_db_and_tables():
     Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        create_message_search(connection)
 
@@ -0,0 +1,219 @@
+"""
+Ingesta de documentos: extracción de texto en streaming, troceado por tokens y
+caché en disco por hash del documento (trozos y resúmenes parciales)
+PDF (pypdf, página a página), DOCX (XML del zip, párrafo a párrafo), HTML y texto plano
+"""
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+import asyncio
+import itertools
+import json
+import os
+import threading
+import zipfile
+from xml.etree import ElementTree
+
+TEXT_BLOCK_SIZE = 64 * 1024
+DOCX_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+DOCX_MIME = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+
+
+class UnsupportedDocument(Exception):
+    """No hay extractor para este tipo de archivo"""
+
+
+def refine_mime(path: Path, mime_type: str) -> str:
+    """magic ve solo los primeros KB: un DOCX suele parecer un zip cualquiera"""
+    if mime_type in ("application/zip", "application/octet-stream") and zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            if "word/document.xml" in archive.namelist():
+                return DOCX_MIME
+    return mime_type
+
+
+def is_document(mime_type: str) -> bool:
+    return mime_type in ("application/pdf", DOCX_MIME, "application/json") or mime_type.startswith("text/")
+
+
+def _iter_pdf(path: Path) -> Iterator[str]:
+    from pypdf import PdfReader
+    for page in PdfReader(path).pages:
+        yield (page.extract_text() or "") + "\n\n"
+
+
+def _iter_docx(path: Path) -> Iterator[str]:
+    with zipfile.ZipFile(path) as archive, archive.open("word/document.xml") as xml:
+        parts = []
+        for _, element in ElementTree.iterparse(xml):
+            if element.tag == f"{DOCX_NS}t":
+                parts.append(element.text or "")
+            elif element.tag == f"{DOCX_NS}p":
+                yield "".join(parts) + "\n"
+                parts = []
+                element.clear()
+
+
+def _iter_html(path: Path) -> Iterator[str]:
+    from bs4 import BeautifulSoup
+    with open(path, "rb") as f:
+        soup = BeautifulSoup(f, "html.parser")
+    for tag in soup(["script", "style", "noscript"]):
+        tag.decompose()
+    yield soup.get_text("\n")
+
+
+def _iter_plain(path: Path) -> Iterator[str]:
+    with open(path, encoding="utf-8", errors="replace") as f:
+        while block := f.read(TEXT_BLOCK_SIZE):
+            yield block
+
+
+def iter_text(path: Path, mime_type: str) -> Iterator[str]:
+    """Bloques de texto del documento, sin cargarlo entero salvo en HTML"""
+    if mime_type == "application/pdf":
+        return _iter_pdf(path)
+    if mime_type == DOCX_MIME:
+        return _iter_docx(path)
+    if mime_type in ("text/html", "application/xhtml+xml"):
+        return _iter_html(path)
+    if mime_type.startswith("text/") or mime_type == "application/json":
+        return _iter_plain(path)
+    raise UnsupportedDocument(f"Tipo de documento no soportado: {mime_type}")
+
+
+def iter_chunks(blocks: Iterator[str], max_chars: int) -> Iterator[str]:
+    """Trozos de como mucho max_chars, cortando en salto de línea o espacio cuando se puede"""
+    buffer = ""
+    for block in blocks:
+        buffer += block
+        while len(buffer) >= max_chars:
+            cut = max(buffer.rfind("\n", 0, max_chars), buffer.rfind(" ", 0, max_chars))
+            if cut < max_chars // 2:
+                cut = max_chars # Sin separador razonable: corte duro
+            chunk = buffer[:cut].strip()
+            buffer = buffer[cut:]
+            if chunk:
+                yield chunk
+    if buffer.strip():
+        yield buffer.strip()
+
+
+class KeyedLocks:
+    """Un asyncio.Lock por clave (p. ej. sha256); la entrada se borra al soltarla si nadie más la espera"""
+    def __init__(self):
+        self._locks: Dict[str, list] = {} # clave -> [lock, tareas que lo tienen o esperan]
+
+    @asynccontextmanager
+    async def hold(self, key: str):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+
+async def iterate_in_thread(iterator: Iterator, maxsize: int = 8):
+    """
+    Consume un iterador bloqueante en un hilo y entrega sus elementos al event loop.
+    La cola acotada da contrapresión: el hilo no adelanta más de `maxsize` elementos
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue(maxsize)
+    stop = threading.Event()
+    done = object()
+
+    def produce():
+        try:
+            for item in iterator:
+                if stop.is_set():
+                    return
+                asyncio.run_coroutine_threadsafe(queue.put((item, None)), loop).result()
+        except Exception as e:
+            asyncio.run_coroutine_threadsafe(queue.put((done, e)), loop).result()
+        else:
+            asyncio.run_coroutine_threadsafe(queue.put((done, None)), loop).result()
+
+    producer = loop.run_in_executor(None, produce)
+    try:
+        while True:
+            item, error = await queue.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                break
+            yield item
+    finally:
+        stop.set()
+        # Desbloquear al productor si espera hueco en la cola
+        while not producer.done():
+            while not queue.empty():
+                queue.get_nowait()
+            await asyncio.sleep(0.01)
+
+
+class DocumentCache:
+    """Artefactos por documento en <root>/<sha256>/: trozos (JSONL) y resúmenes parciales"""
+    def __init__(self, root: Path):
+        self.root = root
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def _dir(self, sha256: str) -> Path:
+        path = self.root / sha256
+        path.mkdir(exist_ok=True)
+        return path
+
+    def load_chunks(self, sha256: str, chunk_tokens: int, max_chunks: int) -> Optional[List[str]]:
+        """El archivo depende del tope de trozos: con otro tope se vuelve a extraer"""
+        path = self.root / sha256 / f"chunks_{chunk_tokens}_{max_chunks}.jsonl"
+        if not path.exists():
+            return None
+        with open(path, encoding="utf-8") as f:
+            return [json.loads(line) for line in itertools.islice(f, max_chunks)]
+
+    def chunk_writer(self, sha256: str, chunk_tokens: int, max_chunks: int) -> "_ChunkWriter":
+        return _ChunkWriter(self._dir(sha256) / f"chunks_{chunk_tokens}_{max_chunks}.jsonl")
+
+    def load_summaries(self, sha256: str, key: str) -> Dict[str, str]:
+        path = self.root / sha256 / f"summaries_{key}.json"
+        if not path.exists():
+            return {}
+        return json.loads(path.read_text(encoding="utf-8"))
+
+    def save_summaries(self, sha256: str, key: str, summaries: Dict[str, str]):
+        path = self._dir(sha256) / f"summaries_{key}.json"
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(summaries, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, path)
+
+
+class _ChunkWriter:
+    """Escribe los trozos según se extraen; el archivo solo aparece si la extracción termina"""
+    def __init__(self, path: Path):
+        self.path = path
+        self._tmp = path.with_suffix(".tmp")
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self._tmp, "w", encoding="utf-8")
+        return self
+
+    def write(self, chunk: str):
+        self._file.write(json.dumps(chunk, ensure_ascii=False) + "\n")
+
+    def __exit__(self, exc_type, exc, tb):
+        self._file.close()
+        if exc_type is None:
+            os.replace(self._tmp, self.path)
+        else:
+            self._tmp.unlink(missing_ok=True)
+        return False
@@ -0,0 +1,28 @@
+"""
+Preprocesado de imágenes para el modelo de visión
+Decodifica, aplica la orientación EXIF, reduce al lado máximo útil y recodifica como JPEG
+sin metadatos. Bloqueante (CPU): se llama con asyncio.to_thread
+"""
+from pathlib import Path
+import io
+
+from PIL import Image, ImageOps
+
+
+def preprocess_image(path: Path, max_side: int, quality: int) -> bytes:
+    with Image.open(path) as img:
+        # JPEG: decodifica directamente a una escala reducida (mucho más rápido en fotos grandes)
+        img.draft("RGB", (max_side, max_side))
+        img = ImageOps.exif_transpose(img)
+        if img.mode in ("RGBA", "LA", "P"):
+            # JPEG no tiene alfa: componer sobre blanco
+            rgba = img.convert("RGBA")
+            img = Image.new("RGB", rgba.size, "white")
+            img.paste(rgba, mask=rgba.getchannel("A"))
+        elif img.mode != "RGB":
+            img = img.convert("RGB")
+        img.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+        out = io.BytesIO()
+        # Sin exif= ni icc_profile=: se descartan los metadatos
+        img.save(out, "JPEG", quality=quality, optimize=True)
+        return out.getvalue()
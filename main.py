@@ -6,226 +6,703 @@ Ejecutable en laptop con GPU o CPU
 """
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Depends
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
-from sqlalchemy.orm import Session
-from database import SessionLocal, Conversation, Message, create_db_and_tables
+from sqlalchemy import event, select, text as sql_text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import AsyncSessionLocal, async_engine, Conversation, Message, ConversationState, create_db_and_tables
+from scheduler import ModelScheduler, SchedulerOverloaded, PRIORITIES
+from message_writer import MessageWriter
+from state_backend import SWEEP_BATCH, open_store
+from residency import ModelResidency
+from uploads import UploadStore, UploadTooLarge, StoredUpload
+from images import preprocess_image
+from metrics import Registry
+from request_log import RequestLog
+from documents import DocumentCache, KeyedLocks, UnsupportedDocument, is_document, iter_chunks, iter_text, iterate_in_thread, refine_mime
+import whisper_worker
 from dotenv import load_dotenv
 
 # Cargar variables de entorno del archivo .env
 load_dotenv()
 
 from settings import settings
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Union
+from contextlib import asynccontextmanager
 import base64
 import json
-import magic
+import re
 from datetime import datetime
 import hashlib
-import subprocess
+import io
+import itertools
 import tempfile
-import os
+import sys
 from pathlib import Path
 import asyncio
-from collections import defaultdict
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import importlib.util
+import multiprocessing
+import ipaddress
+import math
+import sqlite3
 import time
 
-create_db_and_tables()
+# ===== CACHÉ LOCAL (Sin Redis) =====
+async def get_db():
+    async with AsyncSessionLocal() as db:
+        yield db
 
-app = FastAPI(
-    title="Local AI Agent",
-    description="Sistema IA 100% local sin costos cloud",
-    version="1.0.0"
+# ===== MÉTRICAS (GET /metrics, formato Prometheus) =====
+metrics = Registry()
+request_latency = metrics.histogram("http_request_duration_seconds", "Latencia total por ruta, hasta el último byte", ("method", "route", "status"))
+queue_wait = metrics.histogram("scheduler_queue_wait_seconds", "Espera por un slot del planificador", ("model", "priority"))
+db_query_time = metrics.histogram("db_query_seconds", "Duración de las sentencias SQL", ("operation",))
+upload_time = metrics.histogram("upload_seconds", "Copia de subidas al almacén (hash + MIME)", ("endpoint",))
+transcription_time = metrics.histogram("transcription_seconds", "Transcripciones de audio con Whisper")
+executor_time = metrics.histogram("executor_run_seconds", "Ejecuciones de código en el sandbox", ("status",))
+ttft_time = metrics.histogram("ttft_seconds", "Tiempo hasta el primer token (stream: medido; ollama: carga + prefill)", ("model", "source"))
+tokens_per_second = metrics.histogram(
+    "ollama_tokens_per_second", "Velocidad de generación por respuesta (eval_count / eval_duration)", ("model",),
+    buckets=(1, 2.5, 5, 10, 15, 20, 30, 40, 50, 75, 100, 150, 200, 300)
 )
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+eval_tokens = metrics.counter("ollama_eval_tokens_total", "Tokens generados", ("model",))
+eval_seconds = metrics.counter("ollama_eval_seconds_total", "Tiempo de generación según Ollama", ("model",))
+event_loop_lag = metrics.histogram(
+    "event_loop_lag_seconds", "Retraso del event loop respecto a un temporizador periódico",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
 )
 
-# Directorios
+async def monitor_event_loop_lag(interval: float):
+    """Cuánto tarda en despertar un sleep(interval): trabajo bloqueante en el loop se ve aquí"""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        event_loop_lag.observe(max(0.0, loop.time() - start - interval))
 
+# El inicio se guarda en el contexto de ejecución (uno por sentencia): si la sentencia falla
+# no hay after_cursor_execute, y el contexto se descarta con ella en vez de acumularse
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._query_started = time.perf_counter()
 
-# ===== CACHÉ LOCAL (Sin Redis) =====
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, "_query_started", None)
+    if started is not None:
+        db_query_time.observe(time.perf_counter() - started, operation=statement.lstrip().split(None, 1)[0].upper())
+
+event.listen(async_engine.sync_engine, "before_cursor_execute", _before_cursor_execute)
+event.listen(async_engine.sync_engine, "after_cursor_execute", _after_cursor_execute)
 
 class LocalCache:
-    """Caché en memoria + archivo para persistencia"""
-    def __init__(self, cache_dir: Path, cache_ttl: int):
-        self.cache_dir = cache_dir
-        self.memory_cache: Dict[str, Any] = {}
-        self.stats = {"hits": 0, "misses": 0}
-        self._load_cache()
+    """
+    Caché LRU en memoria (acotado por entradas y bytes) con TTL, respaldado en un
+    almacén de state_backend (SQLite por defecto: persistente y compartido entre workers)
+    """
+    def __init__(self, store, cache_ttl: int, max_entries: int = 1000, max_bytes: int = 64 * 1024 * 1024):
+        self.store = store
+        self.cache_ttl = cache_ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # key -> (expires_at, size, data), en orden LRU (el más reciente al final)
+        self.memory_cache: "OrderedDict[str, tuple]" = OrderedDict()
+        # key -> expires_at, en orden de escritura. Con TTL fijo es también el orden de expiración
+        # (las entradas promovidas desde disco pueden quedar desordenadas; get() valida igualmente)
+        self._expiry: "OrderedDict[str, float]" = OrderedDict()
+        self.memory_bytes = 0
+        self.stats = {"hits": 0, "store_hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+        self._sweeper: Optional[asyncio.Task] = None
 
     def _get_key(self, content: Any) -> str:
         serialized = json.dumps(content, sort_keys=True)
         return hashlib.sha256(serialized.encode()).hexdigest()
 
-    def _load_cache(self):
-        """Carga caché del disco al iniciar"""
-        cache_file = self.cache_dir / "cache.json"
-        if cache_file.exists():
-            try:
-                with open(cache_file, 'r') as f:
-                    self.memory_cache = json.load(f)
-                print(f"✅ Caché cargado: {len(self.memory_cache)} entradas")
-            except:
-                pass
-
-    def _save_cache(self):
-        """Guarda caché en disco"""
-        cache_file = self.cache_dir / "cache.json"
-        with open(cache_file, 'w') as f:
-            json.dump(self.memory_cache, f)
+    def _remember(self, key: str, data: dict, size: int, expires_at: float):
+        """Inserta en memoria y aplica los límites LRU"""
+        self._forget(key)
+        self.memory_cache[key] = (expires_at, size, data)
+        self._expiry[key] = expires_at
+        self.memory_bytes += size
+        while self.memory_cache and (len(self.memory_cache) > self.max_entries or self.memory_bytes > self.max_bytes):
+            old_key, _ = next(iter(self.memory_cache.items()))
+            self._forget(old_key)
+            self.stats["evictions"] += 1
+
+    def _forget(self, key: str):
+        entry = self.memory_cache.pop(key, None)
+        if entry is not None:
+            self.memory_bytes -= entry[1]
+            self._expiry.pop(key, None)
 
     def get(self, content: Any) -> Optional[dict]:
         key = self._get_key(content)
-        if key in self.memory_cache:
-            # Verificar expiración (1 hora)
-            entry = self.memory_cache[key]
-            if time.time() - entry["timestamp"] < self.cache_ttl:
+        now = time.time()
+        entry = self.memory_cache.get(key)
+        if entry is not None:
+            if entry[0] > now:
+                self.memory_cache.move_to_end(key)
                 self.stats["hits"] += 1
-                return entry["data"]
-            else:
-                del self.memory_cache[key]
+                return entry[2]
+            self._forget(key)
+            self.stats["expirations"] += 1
+        # Fallo en memoria: buscar en el almacén compartido y promover
+        row = self.store.get(key)
+        if row:
+            data = json.loads(row[0])
+            self._remember(key, data, len(row[0]), row[1])
+            self.stats["hits"] += 1
+            self.stats["store_hits"] += 1
+            return data
         self.stats["misses"] += 1
         return None
 
     def set(self, content: Any, data: dict):
         key = self._get_key(content)
-        self.memory_cache[key] = {
-            "data": data,
-            "timestamp": time.time()
-        }
-        # Guardar cada 10 entradas
-        if len(self.memory_cache) % 10 == 0:
-            self._save_cache()
+        serialized = json.dumps(data)
+        expires_at = time.time() + self.cache_ttl
+        self._remember(key, data, len(serialized), expires_at)
+        try:
+            self.store.set(key, serialized, expires_at)
+        except sqlite3.OperationalError as e:
+            # Lock de otro worker más allá de STATE_BUSY_TIMEOUT: queda solo en memoria
+            print(f"⚠ No se pudo guardar en el caché compartido: {e}")
+
+    def sweep(self, max_rows: Optional[int] = None) -> int:
+        """Elimina entradas expiradas (memoria y almacén) y recorta el almacén al límite"""
+        now = time.time()
+        while self._expiry:
+            key, expires_at = next(iter(self._expiry.items()))
+            if expires_at > now:
+                break
+            self._forget(key)
+            self.stats["expirations"] += 1
+        return self.store.sweep(max_rows)
+
+    async def _sweep_loop(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                # Por lotes, cediendo el event loop (y el lock de SQLite) entre uno y otro
+                while self.sweep(SWEEP_BATCH) >= SWEEP_BATCH:
+                    await asyncio.sleep(0)
+            except Exception as e:
+                print(f"⚠ Error limpiando caché: {e}")
+
+    def start_sweeper(self, interval: float):
+        if self._sweeper is None:
+            self._sweeper = asyncio.create_task(self._sweep_loop(interval))
+
+    async def close(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+        self.store.close()
 
     def get_stats(self) -> dict:
         total = self.stats["hits"] + self.stats["misses"]
         return {
             "hits": self.stats["hits"],
+            "store_hits": self.stats["store_hits"],
             "misses": self.stats["misses"],
             "hit_rate": self.stats["hits"] / total if total > 0 else 0,
-            "entries": len(self.memory_cache)
+            "entries": len(self.memory_cache),
+            "bytes": self.memory_bytes,
+            "store_entries": self.store.count(),
+            "evictions": self.stats["evictions"],
+            "expirations": self.stats["expirations"]
         }
 
-cache = LocalCache(settings.CACHE_DIR, settings.CACHE_TTL)
+cache = LocalCache(
+    open_store(
+        settings.STATE_BACKEND, settings.CACHE_DIR / "cache.db", "entries",
+        max_entries=settings.CACHE_DISK_MAX_ENTRIES, sweep_interval=settings.CACHE_SWEEP_INTERVAL,
+        busy_timeout=settings.STATE_BUSY_TIMEOUT
+    ),
+    settings.CACHE_TTL,
+    max_entries=settings.CACHE_MAX_ENTRIES,
+    max_bytes=settings.CACHE_MAX_BYTES
+)
+
+# Imágenes preprocesadas (base64): aparte, para no desalojar respuestas ni sesgar sus estadísticas
+image_cache = LocalCache(
+    open_store(
+        settings.STATE_BACKEND, settings.CACHE_DIR / "cache.db", "images",
+        max_entries=settings.IMAGE_CACHE_DISK_MAX_ENTRIES, sweep_interval=settings.CACHE_SWEEP_INTERVAL,
+        busy_timeout=settings.STATE_BUSY_TIMEOUT
+    ),
+    settings.CACHE_TTL,
+    max_entries=settings.IMAGE_CACHE_MAX_ENTRIES,
+    max_bytes=settings.IMAGE_CACHE_MAX_BYTES
+)
+
+semantic_cache = None # SemanticCache; se crea en el arranque si SEMANTIC_CACHE_ENABLED (importa numpy)
 
 # ===== RATE LIMITER LOCAL =====
-class SimpleRateLimiter:
-    """Rate limiter en memoria"""
-    def __init__(self, max_requests: int, window: int):
+class TokenBucketRateLimiter:
+    """
+    Rate limiter por token bucket: O(1) en tiempo y memoria por usuario.
+    Recarga max_requests por ventana y permite ráfagas de hasta `burst` peticiones.
+    Los buckets viven en un almacén de state_backend (compartido entre workers con SQLite)
+    """
+    def __init__(self, store, max_requests: int, window: int, burst: int = 0):
+        self.store = store
         self.max_requests = max_requests
         self.window = window
-        self.requests: Dict[str, List[float]] = defaultdict(list)
+        self.capacity = burst or max_requests
+        self.rate = max_requests / window # tokens por segundo
 
-    def check_limit(self, user_id: str) -> bool:
-        now = time.time()
-        cutoff = now - self.window
-        # Limpiar requests antiguos
-        self.requests[user_id] = [
-            req_time for req_time in self.requests[user_id]
-            if req_time > cutoff
-        ]
-        # Verificar límite
-        if len(self.requests[user_id]) >= self.max_requests:
-            return False
-        self.requests[user_id].append(now)
-        return True
+    def check(self, user_id: str) -> tuple:
+        """Consume un token. Devuelve (permitido, info para las cabeceras RateLimit-*)"""
+        def take(current: Optional[str]):
+            now = time.time()
+            tokens, updated_at = json.loads(current) if current else (self.capacity, now)
+            tokens = min(self.capacity, tokens + max(0.0, now - updated_at) * self.rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            # Expira cuando volvería a estar lleno: el barrido lo elimina sin cambiar el resultado
+            expires_at = now + (self.capacity - tokens) / self.rate
+            return json.dumps([tokens, now]), expires_at, (allowed, tokens)
 
-rate_limiter = SimpleRateLimiter(max_requests=settings.RATE_LIMIT_MAX_REQUESTS, window=settings.RATE_LIMIT_WINDOW)
+        try:
+            allowed, tokens = self.store.update(user_id, take)
+        except sqlite3.OperationalError as e:
+            # cache.db bloqueado por otro worker más allá de STATE_BUSY_TIMEOUT: se deja pasar
+            # la petición antes que devolver un 500 o seguir bloqueando el event loop
+            print(f"⚠ Rate limiter sin acceso al almacén ({e}); se permite la petición")
+            allowed, tokens = True, float(self.capacity)
+        return allowed, {
+            "limit": self.capacity,
+            "remaining": int(tokens),
+            "reset": math.ceil((self.capacity - tokens) / self.rate), # Hasta tener el bucket lleno
+            "retry_after": 0 if allowed else math.ceil((1 - tokens) / self.rate)
+        }
+
+rate_limiter = TokenBucketRateLimiter(
+    open_store(
+        settings.STATE_BACKEND, settings.CACHE_DIR / "cache.db", "rate_limits",
+        max_entries=settings.RATE_LIMIT_MAX_USERS, sweep_interval=settings.CACHE_SWEEP_INTERVAL,
+        busy_timeout=settings.STATE_BUSY_TIMEOUT
+    ),
+    max_requests=settings.RATE_LIMIT_MAX_REQUESTS,
+    window=settings.RATE_LIMIT_WINDOW,
+    burst=settings.RATE_LIMIT_BURST
+)
+
+def rate_limit_headers(info: dict) -> Dict[str, str]:
+    """Cabeceras estándar (borrador IETF RateLimit) más Retry-After en los 429"""
+    headers = {
+        "RateLimit-Limit": str(info["limit"]),
+        "RateLimit-Remaining": str(info["remaining"]),
+        "RateLimit-Reset": str(info["reset"])
+    }
+    if info["retry_after"]:
+        headers["Retry-After"] = str(info["retry_after"])
+    return headers
 
 # ===== MODELO LOCAL (Ollama) =====
+def _model_key(name: str) -> str:
+    """Ollama reporta 'llava' como 'llava:latest'"""
+    return name if ":" in name else f"{name}:latest"
+
+class OllamaBackend:
+    """Una instancia de Ollama del pool y lo que sabemos de ella"""
+    def __init__(self, url: str):
+        self.url = url.rstrip("/")
+        self.healthy = True # Optimista hasta el primer chequeo
+        self.available_models: set = set() # /api/tags
+        self.loaded_models: set = set() # /api/ps (modelos calientes)
+        self.model_sizes: Dict[str, int] = {} # /api/tags, bytes
+        self.resident: Dict[str, dict] = {} # /api/ps: size, size_vram, expires_at por modelo
+        self.outstanding = 0 # Peticiones en curso
+        self.busy: Dict[str, int] = {} # Peticiones en curso por modelo (no se descargan)
+        self.residency_lock = asyncio.Lock()
+        self.last_check: Optional[float] = None
+        self.last_error: Optional[str] = None
+
+    def to_dict(self) -> dict:
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "outstanding": self.outstanding,
+            "available_models": sorted(self.available_models),
+            "loaded_models": sorted(self.loaded_models),
+            "resident": self.resident,
+            "last_check": self.last_check,
+            "last_error": self.last_error
+        }
+
 class LocalModelManager:
-    """Gestiona modelos locales vía Ollama"""
-    def __init__(self, ollama_host: str, default_model: str, vision_model: str):
-        self.ollama_url = ollama_host
+    """Gestiona modelos locales vía Ollama (uno o varios backends)"""
+    def __init__(self, ollama_hosts: List[str], default_model: str, vision_model: str, residency: ModelResidency):
+        self.backends = [OllamaBackend(url) for url in ollama_hosts]
         self.default_model = default_model
         self.vision_model = vision_model # Para imágenes
-        self._check_ollama()
+        self.residency = residency
+        self._client = None # httpx.AsyncClient compartido, se abre en startup
+        self._health_task: Optional[asyncio.Task] = None
 
-    def _check_ollama(self):
-        """Verifica que Ollama esté corriendo"""
+    async def start(self):
+        """Abre el cliente HTTP compartido (pool de conexiones con keep-alive)"""
+        if self._client is not None:
+            return
+        import httpx
+        self._client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=settings.OLLAMA_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.OLLAMA_MAX_KEEPALIVE,
+                keepalive_expiry=settings.OLLAMA_KEEPALIVE_EXPIRY,
+            ),
+            timeout=self._timeout(),
+        )
+
+    async def close(self):
+        """Cierra el cliente HTTP compartido"""
+        if self._health_task is not None:
+            self._health_task.cancel()
+            self._health_task = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _get_client(self):
+        if self._client is None:
+            await self.start()
+        return self._client
+
+    def _timeout(self):
+        """Timeouts por fase (la espera del primer token se controla en _stream)"""
+        import httpx
+        return httpx.Timeout(
+            connect=settings.OLLAMA_CONNECT_TIMEOUT,
+            read=settings.OLLAMA_READ_TIMEOUT,
+            write=settings.OLLAMA_CONNECT_TIMEOUT,
+            pool=settings.OLLAMA_CONNECT_TIMEOUT,
+        )
+
+    async def _probe(self, backend: OllamaBackend):
+        """Salud y modelos (disponibles y cargados) de un backend"""
+        client = await self._get_client()
         try:
-            import httpx
-            response = httpx.get(f"{self.ollama_url}/api/tags", timeout=2.0)
-            if response.status_code == 200:
-                models = response.json().get("models", [])
-                print(f"✅ Ollama conectado. Modelos disponibles: {len(models)}")
-            else:
-                print("⚠ Ollama no responde. Instala con: curl -fsSL\nhttps://ollama.com/install.sh | sh")
+            tags, ps = await asyncio.gather(
+                client.get(f"{backend.url}/api/tags", timeout=2.0),
+                client.get(f"{backend.url}/api/ps", timeout=2.0),
+            )
+            tags.raise_for_status()
+            models = tags.json().get("models", [])
+            backend.available_models = {_model_key(m["name"]) for m in models}
+            backend.model_sizes = {_model_key(m["name"]): m.get("size", 0) for m in models}
+            running = ps.json().get("models", []) if ps.status_code == 200 else []
+            backend.resident = {
+                _model_key(m["name"]): {"size": m.get("size", 0), "size_vram": m.get("size_vram", 0), "expires_at": m.get("expires_at")}
+                for m in running
+            }
+            backend.loaded_models = set(backend.resident)
+            backend.healthy = True
+            backend.last_error = None
         except Exception as e:
-            print(f"❌ Error conectando a Ollama: {e}")
+            backend.healthy = False
+            backend.last_error = str(e)
+        backend.last_check = time.time()
+
+    async def refresh_backends(self):
+        await asyncio.gather(*(self._probe(backend) for backend in self.backends))
+
+    async def _health_loop(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            await self.refresh_backends()
+
+    def start_health_checks(self, interval: float):
+        if self._health_task is None:
+            self._health_task = asyncio.create_task(self._health_loop(interval))
+
+    async def _check_ollama(self):
+        """Verifica que Ollama esté corriendo"""
+        await self.refresh_backends()
+        for backend in self.backends:
+            if backend.healthy:
+                print(f"✅ Ollama conectado ({backend.url}). Modelos disponibles: {len(backend.available_models)}")
+            else:
+                print(f"❌ Error conectando a Ollama ({backend.url}): {backend.last_error}")
+        if not any(backend.healthy for backend in self.backends):
             print("Instala Ollama: https://ollama.com/download")
 
-    async def complete(self, messages: List[dict], image_data: Optional[str] = None, stream: bool = False) -> Any:
-        """Completa con modelo local"""
+    def _pick_backend(self, model: str) -> OllamaBackend:
+        """Menos peticiones en curso, prefiriendo backends con el modelo ya cargado"""
+        key = _model_key(model)
+        candidates = [b for b in self.backends if b.healthy] or self.backends
+        warm = [b for b in candidates if key in b.loaded_models]
+        available = [b for b in candidates if key in b.available_models]
+        return min(warm or available or candidates, key=lambda b: b.outstanding)
+
+    def _mark_failure(self, backend: OllamaBackend, error: Exception):
+        """Los errores de conexión sacan al backend de la rotación hasta el próximo chequeo"""
         import httpx
-        # Si hay imagen, usar modelo de visión
-        model = self.vision_model if image_data else self.default_model
+        if isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout)):
+            backend.healthy = False
+            backend.last_error = str(error)
+
+    async def _acquire_backend(self, model: str, backend: Optional[OllamaBackend] = None) -> tuple:
+        """
+        Elige backend (o usa el indicado) y cuenta la petición. Si el modelo no está cargado, descarga
+        antes los que sobren según la política de residencia. Devuelve (backend, carga_en_frío)
+        """
+        key = _model_key(model)
+        backend = backend or self._pick_backend(model)
+        backend.outstanding += 1
+        backend.busy[key] = backend.busy.get(key, 0) + 1
+        self.residency.touch(key)
+        cold = key not in backend.loaded_models
+        if cold:
+            try:
+                await self._make_room(backend, key)
+            except Exception as e:
+                print(f"⚠ No se pudo liberar memoria en {backend.url}: {e}")
+        return backend, cold
+
+    def _release_backend(self, backend: OllamaBackend, model: str):
+        key = _model_key(model)
+        backend.outstanding -= 1
+        backend.busy[key] -= 1
+        if not backend.busy[key]:
+            del backend.busy[key]
+
+    def _mark_resident(self, backend: OllamaBackend, model: str, cold: bool, load_duration_ns: int):
+        key = _model_key(model)
+        backend.loaded_models.add(key)
+        backend.resident.setdefault(key, {"size": backend.model_sizes.get(key, 0), "size_vram": 0, "expires_at": None})
+        if cold:
+            self.residency.record_load(key, load_duration_ns / 1e6)
+
+    async def _make_room(self, backend: OllamaBackend, key: str):
+        async with backend.residency_lock:
+            resident = {model: info["size"] or backend.model_sizes.get(model, 0) for model, info in backend.resident.items()}
+            victims = self.residency.plan_evictions(resident, key, backend.model_sizes.get(key, 0), backend.busy)
+            client = await self._get_client()
+            for victim in victims:
+                # keep_alive 0 descarga el modelo de inmediato
+                response = await client.post(f"{backend.url}/api/generate", json={"model": victim, "keep_alive": 0, "stream": False})
+                response.raise_for_status()
+                backend.resident.pop(victim, None)
+                backend.loaded_models.discard(victim)
+                self.residency.evictions += 1
+                print(f"♻ Modelo {victim} descargado de {backend.url} para cargar {key}")
+
+    async def preload(self, models: List[str]):
+        """
+        Carga los modelos por adelantado en cada backend sano que los tenga descargados, para
+        que el enrutado no concentre las primeras peticiones en el único backend caliente
+        """
+        for model in models:
+            key = _model_key(model)
+            targets = [b for b in self.backends if b.healthy and key in b.available_models] or [self._pick_backend(model)]
+            results = await asyncio.gather(*(self._preload_on(backend, model) for backend in targets), return_exceptions=True)
+            errors = [result for result in results if isinstance(result, BaseException)]
+            for backend, result in zip(targets, results):
+                if isinstance(result, BaseException):
+                    print(f"⚠ No se pudo precargar {model} en {backend.url}: {result}")
+            if len(errors) == len(targets):
+                raise errors[0]
+
+    async def _preload_on(self, backend: OllamaBackend, model: str):
+        """Sin prompt Ollama solo carga el modelo"""
+        client = await self._get_client()
+        backend, cold = await self._acquire_backend(model, backend)
+        try:
+            response = await client.post(
+                f"{backend.url}/api/generate",
+                json={"model": model, "keep_alive": self.residency.keep_alive(_model_key(model)), "stream": False},
+                timeout=settings.OLLAMA_READ_TIMEOUT
+            )
+            response.raise_for_status()
+            self._mark_resident(backend, model, cold, response.json().get("load_duration", 0))
+            print(f"🔥 Modelo {model} cargado en {backend.url}")
+        finally:
+            self._release_backend(backend, model)
+
+    def select_model(self, image_data: Optional[str] = None) -> str:
+        """Si hay imagen, usar modelo de visión"""
+        return self.vision_model if image_data else self.default_model
+
+    async def complete(self, messages: List[dict], image_data: Optional[str] = None, stream: bool = False,
+                       context: Optional[List[int]] = None) -> Any:
+        """
+        Completa con modelo local. Con `context` (devuelto por una llamada anterior)
+        `messages` debe contener solo el turno nuevo y Ollama reutiliza el prefill
+        """
+        model = self.select_model(image_data)
 
         # Construir prompt
         prompt = self._build_prompt(messages)
 
+        payload = {
+            "model": model,
+            "prompt": prompt,
+            "stream": stream,
+            "keep_alive": self.residency.keep_alive(_model_key(model))
+        }
+        if context:
+            payload["context"] = context
+        # Agregar imagen si existe
+        if image_data:
+            payload["images"] = [image_data]
+
+        if stream:
+            return self._stream(model, payload)
+
+        backend, cold = await self._acquire_backend(model)
         try:
-            async with httpx.AsyncClient() as client:
-                payload = {
+            client = await self._get_client()
+            response = await client.post(f"{backend.url}/api/generate", json=payload)
+
+            if response.status_code == 200:
+                result = response.json()
+                self._mark_resident(backend, model, cold, result.get("load_duration", 0))
+                self._record_eval(model, result)
+                ttft_time.observe((result.get("load_duration", 0) + result.get("prompt_eval_duration", 0)) / 1e9, model=model, source="ollama")
+                return {
+                    "content": result["response"],
                     "model": model,
-                    "prompt": prompt,
-                    "stream": stream
+                    "tokens": result.get("eval_count", 0),
+                    "context": result.get("context"),
+                    "cost": 0.0 # ¡Gratis!
                 }
-                # Agregar imagen si existe
-                if image_data:
-                    payload["images"] = [image_data]
-
-                response = await client.post(
-                    f"{self.ollama_url}/api/generate",
-                    json=payload,
-                    timeout=120.0 # Modelos locales pueden ser lentos
-                )
-
-                if response.status_code == 200:
-                    if stream:
-                        async def stream_generator():
-                            async for chunk in response.aiter_bytes():
-                                try:
-                                    # Ollama envía chunks de JSON, cada uno con una 'response' field
-                                    # Necesitamos decodificar cada línea si son múltiples JSONs por chunk
-                                    for line in chunk.decode().split('\n'):
-                                        if line.strip():
-                                            json_data = json.loads(line)
-                                            if "response" in json_data:
-                                                yield json_data["response"]
-                                except json.JSONDecodeError:
-                                    # Esto puede ocurrir si un chunk no es un JSON completo
-                                    # Podríamos loggear o simplemente ignorar chunks incompletos
-                                    pass
-                        return stream_generator()
-                    else:
-                        result = response.json()
-                        return {
-                            "content": result["response"],
-                            "model": model,
-                            "tokens": result.get("eval_count", 0),
-                            "cost": 0.0 # ¡Gratis!
-                        }
-                else:
-                    raise Exception(f"Ollama error: {response.text}")
+            else:
+                raise Exception(f"Ollama error: {response.text}")
         except Exception as e:
+            self._mark_failure(backend, e)
             return {
                 "content": f"Error en modelo local: {str(e)}",
                 "model": "error",
                 "cost": 0.0,
                 "error": str(e)
             }
+        finally:
+            self._release_backend(backend, model)
+
+    async def _get_state(self, db: AsyncSession, conversation_id: int) -> Optional[ConversationState]:
+        result = await db.execute(select(ConversationState).where(ConversationState.conversation_id == conversation_id))
+        return result.scalar_one_or_none()
+
+    async def load_continuation(self, db: AsyncSession, conversation_id: int, model: str, last_message_id: Optional[int]) -> Optional[List[int]]:
+        """Contexto guardado si sigue siendo válido: mismo modelo, sin mensajes nuevos y dentro del límite"""
+        state = await self._get_state(db, conversation_id)
+        if state is None or state.model != model or state.last_message_id != last_message_id:
+            return None
+        context = json.loads(state.context)
+        if len(context) > settings.OLLAMA_CONTEXT_MAX_TOKENS:
+            return None # Reconstruir desde la ventana acotada + resumen
+        return context
+
+    async def save_continuation(self, db: AsyncSession, conversation_id: int, model: str, context: List[int], last_message_id: int):
+        """Actualiza el estado en la sesión; el commit lo hace quien llama"""
+        state = await self._get_state(db, conversation_id)
+        if state is None:
+            state = ConversationState(conversation_id=conversation_id)
+            db.add(state)
+        state.model = model
+        state.context = json.dumps(context)
+        state.last_message_id = last_message_id
+
+    async def embed(self, texts: List[str], model: Optional[str] = None) -> List[List[float]]:
+        """Embeddings vía /api/embed de Ollama"""
+        model = model or settings.EMBEDDING_MODEL
+        backend, cold = await self._acquire_backend(model)
+        try:
+            client = await self._get_client()
+            response = await client.post(
+                f"{backend.url}/api/embed",
+                json={"model": model, "input": texts, "keep_alive": self.residency.keep_alive(_model_key(model))}
+            )
+        except Exception as e:
+            self._mark_failure(backend, e)
+            raise
+        finally:
+            self._release_backend(backend, model)
+        if response.status_code != 200:
+            raise Exception(f"Ollama error: {response.text}")
+        result = response.json()
+        self._mark_resident(backend, model, cold, result.get("load_duration", 0))
+        return result["embeddings"]
+
+    async def _stream(self, model: str, payload: dict):
+        """
+        Streaming real desde Ollama. Genera eventos:
+        {"token": str} por fragmento, {"done": True, ...} al final o {"error": str}
+        """
+        start = time.perf_counter()
+        ttft = None
+        backend, cold = await self._acquire_backend(model)
+        try:
+            client = await self._get_client()
+            # El deadline cubre conexión + prefill; se desactiva al llegar el primer token
+            async with asyncio.timeout(settings.OLLAMA_FIRST_TOKEN_TIMEOUT) as first_token_deadline:
+                async with client.stream("POST", f"{backend.url}/api/generate", json=payload) as response:
+                    if response.status_code != 200:
+                        body = await response.aread()
+                        raise Exception(f"Ollama error: {body.decode(errors='replace')}")
+                    async for data in self._iter_ndjson(response):
+                        if "error" in data:
+                            raise Exception(f"Ollama error: {data['error']}")
+                        token = data.get("response", "")
+                        if token:
+                            if ttft is None:
+                                ttft = time.perf_counter() - start
+                                first_token_deadline.reschedule(None)
+                                ttft_time.observe(ttft, model=model, source="stream")
+                            yield {"token": token}
+                        if data.get("done"):
+                            first_token_deadline.reschedule(None)
+                            self._mark_resident(backend, model, cold, data.get("load_duration", 0))
+                            self._record_eval(model, data)
+                            yield {"done": True, "model": model, "stats": self._eval_stats(data, ttft), "context": data.get("context")}
+        except TimeoutError:
+            yield {"error": f"Sin primer token tras {settings.OLLAMA_FIRST_TOKEN_TIMEOUT}s", "model": "error"}
+        except Exception as e:
+            self._mark_failure(backend, e)
+            yield {"error": str(e), "model": "error"}
+        finally:
+            self._release_backend(backend, model)
+
+    async def _iter_ndjson(self, response):
+        """Decodifica NDJSON. aiter_lines acumula las líneas cortadas entre chunks"""
+        async for line in response.aiter_lines():
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+    def _record_eval(self, model: str, data: dict):
+        """Tokens/s por modelo a partir del chunk final de Ollama"""
+        eval_count = data.get("eval_count", 0)
+        eval_duration = data.get("eval_duration", 0) / 1e9
+        if eval_count and eval_duration:
+            eval_tokens.inc(eval_count, model=model)
+            eval_seconds.inc(eval_duration, model=model)
+            tokens_per_second.observe(eval_count / eval_duration, model=model)
+
+    def _eval_stats(self, data: dict, ttft: Optional[float]) -> dict:
+        """Estadísticas del chunk final de Ollama (duraciones en ns -> ms)"""
+        ns_to_ms = lambda key: round(data.get(key, 0) / 1e6, 2)
+        eval_count = data.get("eval_count", 0)
+        eval_duration = data.get("eval_duration", 0)
+        return {
+            "eval_count": eval_count,
+            "prompt_eval_count": data.get("prompt_eval_count", 0),
+            "eval_duration_ms": ns_to_ms("eval_duration"),
+            "prompt_eval_duration_ms": ns_to_ms("prompt_eval_duration"),
+            "load_duration_ms": ns_to_ms("load_duration"),
+            "total_duration_ms": ns_to_ms("total_duration"),
+            "tokens_per_second": round(eval_count / (eval_duration / 1e9), 2) if eval_duration else 0,
+            # TTFT medido aquí vs. el de Ollama (carga + prefill)
+            "ttft_ms": round(ttft * 1000, 2) if ttft is not None else None,
+            "ollama_ttft_ms": round((data.get("load_duration", 0) + data.get("prompt_eval_duration", 0)) / 1e6, 2),
+        }
 
     def _build_prompt(self, messages: List[dict]) -> str:
         """Construye prompt desde mensajes"""
@@ -251,131 +728,986 @@ class LocalModelManager:
                 prompt_parts.append(f"Assistant: {content}")
         return "\n\n".join(prompt_parts) + "\n\nAssistant:"
 
-model_manager = LocalModelManager(settings.OLLAMA_HOST, settings.DEFAULT_MODEL, settings.VISION_MODEL)
+model_manager = LocalModelManager(
+    settings.OLLAMA_HOSTS or [settings.OLLAMA_HOST],
+    settings.DEFAULT_MODEL,
+    settings.VISION_MODEL,
+    ModelResidency(
+        pinned=[_model_key(model) for model in settings.MODEL_PINNED],
+        keep_alive={_model_key(model): value for model, value in settings.MODEL_KEEP_ALIVE.items()},
+        default_keep_alive=settings.OLLAMA_KEEP_ALIVE,
+        ram_budget=settings.MODEL_RAM_BUDGET_MB * 1024 * 1024
+    )
+)
+
+# ===== PLANIFICADOR (admisión + reparto justo) =====
+scheduler = ModelScheduler(
+    default_limit=settings.SCHEDULER_DEFAULT_CONCURRENCY,
+    limits=settings.SCHEDULER_MODEL_CONCURRENCY,
+    max_queue=settings.SCHEDULER_MAX_QUEUE,
+    max_wait=settings.SCHEDULER_MAX_WAIT,
+    quantum=settings.SCHEDULER_QUANTUM,
+    on_wait=lambda model, priority, wait: queue_wait.observe(wait, model=model, priority=priority)
+)
+metrics.gauge(
+    "scheduler_slots", "Generaciones en curso y en cola por modelo", ("model", "state"),
+    lambda: {
+        key: value
+        for model, q in scheduler.queues.items()
+        for key, value in (((model, "active"), q.active), ((model, "queued"), q.queued))
+    }
+)
+
+async def scheduled_stream(events, ticket):
+    """Mantiene el slot del planificador mientras dura el stream"""
+    try:
+        async for event in events:
+            yield event
+    finally:
+        scheduler.release(ticket)
+
+# ===== ESCRITURA DIFERIDA DE MENSAJES =====
+message_writer = MessageWriter(
+    AsyncSessionLocal,
+    max_batch=settings.MESSAGE_WRITE_BATCH,
+    max_delay=settings.MESSAGE_WRITE_DELAY_MS / 1000
+)
+
+continuation_saves: set = set() # Tareas en vuelo, se esperan al apagar
+
+def schedule_continuation_save(write: asyncio.Future, conversation_id: int, model: str, context: List[int]):
+    task = asyncio.create_task(save_continuation_after(write, conversation_id, model, context))
+    continuation_saves.add(task)
+    task.add_done_callback(continuation_saves.discard)
+
+async def save_continuation_after(write: asyncio.Future, conversation_id: int, model: str, context: List[int]):
+    """Guarda el estado de continuación cuando el mensaje del asistente ya tiene id"""
+    try:
+        message_id = await write
+        async with AsyncSessionLocal() as db:
+            await model_manager.save_continuation(db, conversation_id, model, context, message_id)
+            await db.commit()
+    except Exception as e:
+        print(f"⚠ Error guardando continuación de la conversación {conversation_id}: {e}")
+
+
+# ===== CONTEXTO DE CONVERSACIÓN =====
+class ConversationContext:
+    """
+    Ventana de contexto acotada: últimos N mensajes que caben en un presupuesto de tokens.
+    Los turnos más antiguos se pliegan en un resumen incremental guardado en Conversation
+    """
+    def __init__(self, max_messages: int, token_budget: int, summary_batch: int, keep_recent: int = 4):
+        self.max_messages = max_messages
+        self.token_budget = token_budget
+        self.summary_batch = summary_batch
+        self.keep_recent = keep_recent # Mensajes recientes que nunca se pliegan
+        self._summarizing: set = set() # conversation_id con resumen en curso
+        self._tasks: set = set() # Tareas de resumen en vuelo, se cancelan al apagar
+
+    @staticmethod
+    def estimate_tokens(text: str) -> int:
+        """Estimación barata sin tokenizer"""
+        return len(text or "") // settings.CONTEXT_CHARS_PER_TOKEN + 1
+
+    async def build(self, db: AsyncSession, conversation: Conversation, reserve_tokens: int = 0) -> tuple:
+        """
+        Devuelve (messages, overflow). Solo lee mensajes aún no resumidos; overflow indica
+        que no caben todos en la ventana y conviene llamar a update_summary.
+        Incluye los mensajes aún en la cola de escritura diferida
+        """
+        # Antes de la consulta: un lote confirmado entre medias aparece en ambos y se descarta abajo
+        pending = message_writer.pending(conversation.id)
+        stored = (await db.execute(
+            select(Message)
+            .where(Message.conversation_id == conversation.id, Message.id > (conversation.summary_until_id or 0))
+            .order_by(Message.timestamp.desc(), Message.id.desc())
+            .limit(self.max_messages)
+        )).scalars().all()
+        stored_ids = {msg.id for msg in stored}
+        rows = [msg for msg in reversed(pending) if msg.id not in stored_ids] + list(stored)
+        rows = rows[:self.max_messages]
+        budget = self.token_budget - reserve_tokens
+        summary_message = None
+        if conversation.summary:
+            summary_message = {"role": "system", "content": f"Resumen de la conversación anterior: {conversation.summary}"}
+            budget -= self.estimate_tokens(summary_message["content"])
+
+        kept = []
+        for msg in rows: # Del más reciente al más antiguo
+            cost = self.estimate_tokens(msg.content)
+            if cost > budget:
+                break
+            budget -= cost
+            kept.append({"role": msg.role, "content": msg.content})
+        kept.reverse()
+        overflow = len(kept) < len(rows) or len(rows) == self.max_messages
+        return ([summary_message] if summary_message else []) + kept, overflow
+
+    def schedule_summary(self, conversation_id: int):
+        """Actualiza el resumen en segundo plano, sin bloquear la respuesta"""
+        if conversation_id not in self._summarizing:
+            self._summarizing.add(conversation_id)
+            task = asyncio.create_task(self.update_summary(conversation_id))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def close(self):
+        """Cancela los resúmenes en curso (se rehacen con el siguiente mensaje que desborde)"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def update_summary(self, conversation_id: int):
+        """Pliega en el resumen el siguiente lote de mensajes que quedó fuera de la ventana"""
+        db = AsyncSessionLocal()
+        try:
+            conversation = await db.get(Conversation, conversation_id)
+            if conversation is None:
+                return
+            _, overflow = await self.build(db, conversation)
+            if not overflow:
+                return
+            # Lote más antiguo sin resumir; los últimos turnos se conservan siempre literales
+            recent_ids = (await db.execute(
+                select(Message.id)
+                .where(Message.conversation_id == conversation_id)
+                .order_by(Message.timestamp.desc(), Message.id.desc())
+                .limit(self.keep_recent)
+            )).scalars().all()
+            pending = (await db.execute(
+                select(Message)
+                .where(
+                    Message.conversation_id == conversation_id,
+                    Message.id > (conversation.summary_until_id or 0),
+                    Message.id < min(recent_ids, default=0)
+                )
+                .order_by(Message.timestamp, Message.id)
+                .limit(self.summary_batch)
+            )).scalars().all()
+            if not pending:
+                return
+            transcript = "\n".join(f"{msg.role}: {msg.content}" for msg in pending)
+            # Trabajo en segundo plano: prioridad batch, todos los resúmenes comparten un turno justo
+            ticket = await scheduler.acquire(
+                model_manager.default_model, "__resumen__", "batch", cost=self.estimate_tokens(transcript)
+            )
+            try:
+                response = await model_manager.complete([
+                    {"role": "system", "content": "Actualiza el resumen de la conversación con los nuevos mensajes. "
+                                                  "Conserva hechos, decisiones y preferencias del usuario. Sé conciso."},
+                    {"role": "user", "content": f"Resumen actual:\n{conversation.summary or '(vacío)'}\n\nNuevos mensajes:\n{transcript}"}
+                ])
+            finally:
+                scheduler.release(ticket)
+            if response.get("error"):
+                return
+            conversation.summary = response["content"].strip()
+            conversation.summary_until_id = pending[-1].id
+            await db.commit()
+        except Exception as e:
+            print(f"⚠ Error actualizando resumen de la conversación {conversation_id}: {e}")
+        finally:
+            await db.close()
+            self._summarizing.discard(conversation_id)
+
+conversation_context = ConversationContext(
+    settings.CONTEXT_MAX_MESSAGES,
+    settings.CONTEXT_TOKEN_BUDGET,
+    settings.CONTEXT_SUMMARY_BATCH
+)
 
 # ===== WHISPER LOCAL =====
 class LocalWhisper:
-    """Transcripción de audio con Whisper local"""
-    def __init__(self, use_whisper: bool, whisper_model: str):
-        self.model_loaded = False
+    """Transcripción de audio con Whisper local, en un pool de procesos fuera del event loop"""
+    def __init__(self, use_whisper: bool, whisper_model: str, workers: int, timeout: float):
         self.use_whisper = use_whisper
         self.whisper_model = whisper_model
-        if self.use_whisper:
-            self._check_whisper()
+        self.workers = workers
+        self.timeout = timeout
+        self.available = use_whisper and self._check_whisper()
+        self._pool: Optional[ProcessPoolExecutor] = None
+        # Un trabajo entra al pool solo con un worker libre: el timeout cuenta desde que empieza
+        # a ejecutarse, y el que vence es siempre un trabajo en curso, nunca uno en cola
+        self._slots = asyncio.Semaphore(workers)
 
-    def _check_whisper(self):
-        """Verifica instalación de Whisper"""
-        try:
-            import whisper
-            self.model = whisper.load_model(self.whisper_model) # base, small, medium, large
-            self.model_loaded = True
-            print("✅ Whisper cargado (modelo: base)")
-        except ImportError:
+    def _check_whisper(self) -> bool:
+        """Verifica instalación de Whisper (el modelo se carga en cada worker)"""
+        if importlib.util.find_spec("whisper") is None:
             print("⚠ Whisper no instalado. Instala con: pip install openai-whisper")
-        except Exception as e:
-            print(f"❌ Error cargando Whisper: {e}")
+            return False
+        return True
 
-    async def transcribe(self, audio_bytes: bytes) -> str:
-        """Transcribe audio"""
-        if not self.use_whisper or not self.model_loaded:
+    def _get_pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=whisper_worker.init_worker,
+                initargs=(self.whisper_model,)
+            )
+        return self._pool
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def _kill(self):
+        """
+        Termina los procesos del pool (un trabajo colgado no se puede cancelar de otra forma)
+        y lo descarta; se recrea en la siguiente petición. Las transcripciones que se ejecutaban
+        a la vez reciben BrokenProcessPool y se reintentan una vez en el pool nuevo
+        """
+        pool, self._pool = self._pool, None
+        if pool is None:
+            return
+        for process in list((getattr(pool, "_processes", None) or {}).values()):
+            process.terminate()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    async def warm_up(self):
+        """Arranca los workers y carga el modelo antes de la primera petición"""
+        loop = asyncio.get_running_loop()
+        pool = self._get_pool()
+        await asyncio.gather(*(loop.run_in_executor(pool, whisper_worker.ping) for _ in range(self.workers)))
+
+    async def transcribe(self, audio: Union[bytes, str]) -> str:
+        """Transcribe audio en memoria (bytes) o desde una ruta del almacén de subidas"""
+        if not self.available:
             return "[Whisper no disponible - instala con: pip install openai-whisper]"
 
-        import whisper
-        # Guardar temporalmente
-        with tempfile.NamedTemporaryFile(suffix=".mp3", delete=False) as tmp:
-            tmp.write(audio_bytes)
-            tmp.flush()
+        loop = asyncio.get_running_loop()
+        async with self._slots:
+            for attempt in range(2):
+                pool = self._get_pool()
+                try:
+                    with transcription_time.time():
+                        return await asyncio.wait_for(
+                            loop.run_in_executor(pool, whisper_worker.transcribe, audio),
+                            timeout=self.timeout
+                        )
+                except asyncio.TimeoutError:
+                    # wait_for solo abandona el futuro: el worker seguiría ocupado con el trabajo colgado
+                    if self._pool is pool:
+                        self._kill()
+                    return f"[Error transcribiendo: timeout ({self.timeout}s)]"
+                except BrokenProcessPool as e:
+                    if self._pool is not pool and attempt == 0:
+                        continue # Otro trabajo ya descartó el pool (timeout o caída): reintentar
+                    if self._pool is pool:
+                        self.close() # Se recrea en la siguiente petición
+                    return f"[Error transcribiendo: {e}]"
+                except Exception as e:
+                    return f"[Error transcribiendo: {e}]"
+
+whisper_local = LocalWhisper(settings.USE_WHISPER, settings.WHISPER_MODEL, settings.WHISPER_WORKERS, settings.WHISPER_TIMEOUT)
+
+# ===== SUBIDAS =====
+upload_store = UploadStore(settings.UPLOADS_DIR, settings.MAX_UPLOAD_SIZE * 1024 * 1024)
+FORM_OVERHEAD = 1024 * 1024 # Margen para los demás campos y cabeceras multipart
+
+async def sweep_uploads(interval: float, max_age: float):
+    """Retención de UPLOADS_DIR: sin ella crece con cada archivo y texto enviado"""
+    while True:
         try:
-            result = self.model.transcribe(tmp.name)
-            return result["text"]
+            removed = await asyncio.to_thread(upload_store.sweep, max_age)
+            if removed:
+                print(f"🧹 {removed} subidas caducadas eliminadas")
         except Exception as e:
-            return f"[Error transcribiendo: {e}]"
+            print(f"⚠ Error limpiando subidas: {e}")
+        await asyncio.sleep(interval)
+
+async def prepare_image(upload: StoredUpload) -> str:
+    """Imagen reducida y sin metadatos en base64, cacheada por hash de contenido"""
+    key = {"image": upload.sha256, "max_side": settings.VISION_MAX_SIDE, "quality": settings.VISION_JPEG_QUALITY}
+    cached = image_cache.get(key)
+    if cached:
+        return cached["image_b64"]
+    try:
+        data = await asyncio.to_thread(preprocess_image, upload.path, settings.VISION_MAX_SIDE, settings.VISION_JPEG_QUALITY)
+    except Exception as e:
+        # Formato que Pillow no decodifica: se envía el original
+        print(f"⚠ No se pudo preprocesar la imagen {upload.sha256}: {e}")
+        data = await asyncio.to_thread(upload.path.read_bytes)
+    encoded = base64.b64encode(data).decode("utf-8")
+    image_cache.set(key, {"image_b64": encoded})
+    return encoded
+
+# ===== DOCUMENTOS (extracción + resumen map-reduce) =====
+class DocumentSummarizer:
+    """
+    Resume documentos largos: los trozos se resumen en paralelo (acotado) según se extraen
+    y una pasada final combina los resúmenes. Trozos y resúmenes parciales se cachean en
+    disco por hash del documento, así que repetir o preguntar otra cosa no rehace el trabajo
+    """
+    def __init__(self, store: DocumentCache, chunk_tokens: int, max_parallel: int, max_chunks: int):
+        self.store = store
+        self.chunk_tokens = chunk_tokens
+        self.max_parallel = max_parallel
+        self.max_chunks = max_chunks
+        self._locks = KeyedLocks() # Un resumen a la vez por documento
+
+    @property
+    def max_chars(self) -> int:
+        return self.chunk_tokens * settings.CONTEXT_CHARS_PER_TOKEN
+
+    async def iter_chunks(self, upload: StoredUpload, chunk_tokens: Optional[int] = None, max_chunks: Optional[int] = None):
+        """Trozos del documento: del caché o extrayendo en un hilo mientras se consumen"""
+        chunk_tokens = chunk_tokens or self.chunk_tokens
+        max_chunks = max_chunks or self.max_chunks
+        cached = self.store.load_chunks(upload.sha256, chunk_tokens, max_chunks)
+        if cached is not None:
+            for chunk in cached:
+                yield chunk
+            return
+        max_chars = chunk_tokens * settings.CONTEXT_CHARS_PER_TOKEN
+        blocks = itertools.islice(iter_chunks(iter_text(upload.path, upload.mime_type), max_chars), max_chunks)
+        with self.store.chunk_writer(upload.sha256, chunk_tokens, max_chunks) as writer:
+            async for chunk in iterate_in_thread(blocks):
+                writer.write(chunk)
+                yield chunk
+
+    async def _complete(self, prompt: str, user_id: str, priority: str) -> str:
+        model = model_manager.default_model
+        ticket = await scheduler.acquire(model, user_id, priority, cost=conversation_context.estimate_tokens(prompt))
+        try:
+            response = await model_manager.complete([{"role": "user", "content": prompt}])
         finally:
-            os.unlink(tmp.name)
+            scheduler.release(ticket)
+        if response.get("error"):
+            raise RuntimeError(response["error"])
+        return response["content"].strip()
+
+    async def summarize(self, upload: StoredUpload, user_id: str, priority: str = "interactive",
+                        question: Optional[str] = None) -> dict:
+        async with self._locks.hold(upload.sha256):
+            key = f"{hashlib.sha256(model_manager.default_model.encode()).hexdigest()[:12]}_{self.chunk_tokens}"
+            summaries = self.store.load_summaries(upload.sha256, key)
+            reused = len(summaries)
+            slots = asyncio.Semaphore(self.max_parallel)
+
+            async def summarize_chunk(i: int, chunk: str):
+                async with slots:
+                    summaries[str(i)] = await self._complete(
+                        "Resume el siguiente fragmento de un documento. Conserva datos, cifras y nombres.\n\n" + chunk,
+                        user_id, priority
+                    )
+
+            # Map: cada trozo se encola en cuanto sale del extractor
+            tasks = []
+            count = 0
+            try:
+                async for chunk in self.iter_chunks(upload):
+                    if str(count) not in summaries:
+                        tasks.append(asyncio.create_task(summarize_chunk(count, chunk)))
+                    count += 1
+                await asyncio.gather(*tasks)
+            finally:
+                for task in tasks:
+                    task.cancel()
+                # Lo ya resumido se conserva aunque algo falle
+                self.store.save_summaries(upload.sha256, key, summaries)
+
+            # Reduce (sin pregunta la respuesta final también se cachea)
+            final = None if question else summaries.get("final")
+            if final is None:
+                final = await self._reduce([summaries[str(i)] for i in range(count)], question, user_id, priority, slots)
+                if not question:
+                    summaries["final"] = final
+                    self.store.save_summaries(upload.sha256, key, summaries)
+            return {
+                "summary": final,
+                "sha256": upload.sha256,
+                "chunks": count,
+                "reused_summaries": min(reused, count),
+                "truncated": count >= self.max_chunks
+            }
+
+    async def _reduce(self, parts: List[str], question: Optional[str], user_id: str, priority: str,
+                      slots: asyncio.Semaphore) -> str:
+        """Combina resúmenes parciales; si no caben en un trozo, por niveles"""
+        async def combine(group: List[str]) -> str:
+            async with slots:
+                return await self._complete(
+                    "Combina estos resúmenes parciales en uno solo, sin repetir información.\n\n" + "\n\n".join(group),
+                    user_id, priority
+                )
+
+        while len(parts) > 1 and sum(len(part) for part in parts) > self.max_chars:
+            groups, group, size = [], [], 0
+            for part in parts:
+                if group and size + len(part) > self.max_chars:
+                    groups.append(group)
+                    group, size = [], 0
+                group.append(part)
+                size += len(part)
+            groups.append(group)
+            if len(groups) == len(parts):
+                break # Cada resumen ya llena un trozo: no se puede agrupar más
+            parts = await asyncio.gather(*(combine(group) for group in groups))
+
+        joined = "\n\n".join(parts)
+        if question:
+            prompt = f"Con estos resúmenes de las partes de un documento, responde a la pregunta.\n\n{joined}\n\nPregunta: {question}"
+        else:
+            prompt = f"Escribe un resumen final del documento a partir de estos resúmenes de sus partes.\n\n{joined}"
+        return await self._complete(prompt, user_id, priority)
+
+document_summarizer = DocumentSummarizer(
+    DocumentCache(settings.CACHE_DIR / "documents"),
+    chunk_tokens=settings.DOCUMENT_CHUNK_TOKENS,
+    max_parallel=settings.DOCUMENT_MAX_PARALLEL,
+    max_chunks=settings.DOCUMENT_MAX_CHUNKS
+)
+
+class BlockedURL(Exception):
+    """URL no permitida para descargar desde el servidor"""
 
-whisper_local = LocalWhisper(settings.USE_WHISPER, settings.WHISPER_MODEL)
+async def check_public_url(url) -> None:
+    """
+    Evita SSRF: solo http/https y hosts cuyas direcciones resueltas sean todas públicas
+    (nada de loopback, red privada, link-local ni metadatos de la nube, p. ej. 169.254.169.254)
+    """
+    import httpx
+    url = httpx.URL(str(url))
+    if url.scheme not in ("http", "https") or not url.host:
+        raise BlockedURL(f"Solo se admiten URLs http(s): {url}")
+    if settings.DOCUMENT_FETCH_ALLOW_PRIVATE:
+        return
+    loop = asyncio.get_running_loop()
+    try:
+        infos = await loop.getaddrinfo(url.host, url.port or (443 if url.scheme == "https" else 80))
+    except OSError as e:
+        raise BlockedURL(f"No se pudo resolver {url.host}: {e}")
+    for info in infos:
+        address = ipaddress.ip_address(info[4][0].split("%")[0])
+        if isinstance(address, ipaddress.IPv6Address) and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        if not address.is_global or address.is_multicast:
+            raise BlockedURL(f"Dirección no permitida para {url.host}: {address}")
+
+async def fetch_url(url: str) -> StoredUpload:
+    """
+    Descarga una URL por bloques al almacén de subidas (mismo límite de tamaño).
+    Las redirecciones se siguen a mano para validar cada salto con check_public_url
+    """
+    import httpx
+    size = 0
+    with tempfile.SpooledTemporaryFile(max_size=1024 * 1024) as spool:
+        async with httpx.AsyncClient(follow_redirects=False, timeout=settings.DOCUMENT_FETCH_TIMEOUT) as client:
+            request = client.build_request("GET", url)
+            for _ in range(settings.DOCUMENT_FETCH_MAX_REDIRECTS + 1):
+                await check_public_url(request.url)
+                response = await client.send(request, stream=True)
+                if not response.is_redirect:
+                    break
+                request = response.next_request
+                await response.aclose()
+            else:
+                raise BlockedURL(f"Demasiadas redirecciones: {url}")
+            try:
+                response.raise_for_status()
+                content_type = response.headers.get("content-type", "").split(";")[0].strip() or None
+                async for chunk in response.aiter_bytes():
+                    size += len(chunk)
+                    if size > upload_store.max_bytes:
+                        raise UploadTooLarge(upload_store.max_bytes)
+                    spool.write(chunk)
+            finally:
+                await response.aclose()
+        spool.seek(0)
+        return await asyncio.to_thread(upload_store.save, spool, content_type)
+
+# ===== RECUPERACIÓN (RAG) =====
+class DocumentRetriever:
+    """
+    Indexa los pasajes de cada documento (embeddings vía Ollama) y recupera los más parecidos
+    a la pregunta, para inyectar solo esos pasajes en el prompt en vez del documento entero.
+    Se crea en el arranque (importa numpy y abre el índice persistido en CACHE_DIR/rag)
+    """
+    def __init__(self, root: Path, chunk_tokens: int, max_chunks: int, embed_batch: int,
+                 top_k: int, ivf_min_rows: int, nprobe: int):
+        from vector_index import VectorIndex
+        self.index = VectorIndex(root, ivf_min_rows=ivf_min_rows, nprobe=nprobe)
+        self.chunk_tokens = chunk_tokens
+        self.max_chunks = max_chunks
+        self.embed_batch = embed_batch
+        self.top_k = top_k
+        self._locks = KeyedLocks() # Una indexación a la vez por documento
+
+    async def add_document(self, upload: StoredUpload, user_id: str, filename: Optional[str] = None) -> dict:
+        """Indexa el documento si es nuevo (solo se añaden sus filas) y da acceso al usuario"""
+        async with self._locks.hold(upload.sha256):
+            if await asyncio.to_thread(self.index.has_document, upload.sha256):
+                await asyncio.to_thread(self.index.grant, upload.sha256, user_id, filename)
+                return {"sha256": upload.sha256, "indexed": False}
+            chunks, vectors, batch = [], [], []
+            async for chunk in document_summarizer.iter_chunks(upload, self.chunk_tokens, self.max_chunks):
+                batch.append(chunk)
+                if len(batch) == self.embed_batch:
+                    vectors.extend(await model_manager.embed(batch))
+                    chunks.extend(batch)
+                    batch = []
+            if batch:
+                vectors.extend(await model_manager.embed(batch))
+                chunks.extend(batch)
+            if not chunks:
+                return {"sha256": upload.sha256, "indexed": False, "chunks": 0}
+            # add() vuelve a comprobar bajo el flock: otro worker pudo indexarlo entretanto
+            indexed = await asyncio.to_thread(
+                self.index.add, upload.sha256, user_id, filename, chunks, vectors, settings.EMBEDDING_MODEL
+            )
+            return {"sha256": upload.sha256, "indexed": indexed, "chunks": len(chunks) if indexed else 0}
+
+    async def retrieve(self, query: str, user_id: str, sha256: Optional[str] = None,
+                       min_score: float = 0.0) -> List[dict]:
+        if not await asyncio.to_thread(self.index.has_user_documents, user_id):
+            return []
+        embedding = (await model_manager.embed([query]))[0]
+        passages = await asyncio.to_thread(self.index.search, embedding, user_id, self.top_k, sha256)
+        return [passage for passage in passages if passage["score"] >= min_score]
+
+def format_passages(passages: List[dict]) -> str:
+    return "\n\n".join(
+        f"[{i}] ({passage['filename'] or passage['sha256'][:12]}, pasaje {passage['chunk'] + 1})\n{passage['text']}"
+        for i, passage in enumerate(passages, 1)
+    )
+
+document_retriever = None # DocumentRetriever; se crea en el arranque si RAG_ENABLED
 
 # ===== EJECUTOR SEGURO =====
 class LocalExecutor:
-    """Ejecuta código de forma segura localmente"""
-    def __init__(self, timeout: int, max_output: int):
+    """
+    Ejecuta código de forma segura localmente sin bloquear el event loop.
+    Python corre en intérpretes de un solo uso arrancados por adelantado (pool pre-calentado)
+    con límites de CPU, memoria y descriptores; el código llega por pipe
+    """
+    def __init__(self, timeout: int, max_output: int, pool_size: int, max_concurrency: int,
+                 max_queue: int, memory_mb: int, max_fds: int):
         self.timeout = timeout
         self.max_output = max_output # Caracteres
+        self.pool_size = pool_size
+        self.max_queue = max_queue
+        self.memory_mb = memory_mb
+        self.max_fds = max_fds
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._waiting = 0
+        self._idle: List[asyncio.subprocess.Process] = []
+        self._replenisher: Optional[asyncio.Task] = None # Una sola reposición a la vez
+        self._worker = str(Path(__file__).parent / "sandbox_worker.py")
 
-    async def execute_python(self, code: str) -> dict:
-        # Validación básica para evitar comandos del sistema en Python
-        if any(keyword in code for keyword in ['os.system', 'subprocess.run', 'subprocess.Popen', '__import__("os")']):
-            return {"success": False, "error": "Comandos del sistema no permitidos en el código Python."}
+    async def _spawn(self) -> asyncio.subprocess.Process:
+        return await asyncio.create_subprocess_exec(
+            sys.executable, "-I", self._worker,
+            str(self.timeout), str(self.memory_mb), str(self.max_fds), str(self.max_output),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+
+    async def _replenish(self):
+        while len(self._idle) < self.pool_size:
+            self._idle.append(await self._spawn())
 
-        """Ejecuta Python en subprocess"""
+    async def start(self):
+        """Pre-arranca los intérpretes del pool"""
+        await self._replenish()
+
+    async def _replenish_in_background(self):
         try:
-            # Crear archivo temporal
-            with tempfile.NamedTemporaryFile(mode='w', suffix='.py', delete=False) as f:
-                f.write(code)
-                f.flush()
-            # Ejecutar con timeout
-            result = subprocess.run(
-                ["python", f.name],
-                capture_output=True,
-                text=True,
-                timeout=self.timeout
-            )
-            return {
-                "success": result.returncode == 0,
-                "stdout": result.stdout[:self.max_output],
-                "stderr": result.stderr[:self.max_output]
-            }
-        except subprocess.TimeoutExpired:
+            await self._replenish()
+        except Exception as e:
+            print(f"⚠ No se pudo reponer el pool del ejecutor: {e}")
+
+    async def close(self):
+        if self._replenisher is not None:
+            self._replenisher.cancel()
+            await asyncio.gather(self._replenisher, return_exceptions=True)
+            self._replenisher = None
+        for proc in self._idle:
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+        self._idle.clear()
+
+    async def _take_worker(self) -> asyncio.subprocess.Process:
+        """Intérprete listo del pool (o uno nuevo si está vacío); se repone en segundo plano"""
+        proc = None
+        while self._idle and proc is None:
+            candidate = self._idle.pop()
+            if candidate.returncode is None:
+                proc = candidate
+        if proc is None:
+            proc = await self._spawn()
+        # El bucle de _replenish vuelve a mirar el tamaño del pool: una tarea en curso
+        # cubre también los intérpretes tomados mientras tanto
+        if self._replenisher is None or self._replenisher.done():
+            self._replenisher = asyncio.create_task(self._replenish_in_background())
+        return proc
+
+    async def _run(self, proc: asyncio.subprocess.Process, stdin: bytes) -> tuple:
+        """Envía la entrada y espera la salida con timeout de reloj; mata el proceso si se pasa"""
+        try:
+            stdout, stderr = await asyncio.wait_for(proc.communicate(stdin), timeout=self.timeout)
+            return stdout.decode(errors="replace"), stderr.decode(errors="replace")
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            raise
+
+    async def _limited(self, job):
+        """Limita ejecuciones simultáneas; el resto espera en cola acotada"""
+        if self._waiting >= self.max_queue:
+            return {"success": False, "error": "Ejecutor saturado, inténtalo más tarde"}
+        self._waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self._waiting -= 1
+        # Tiempo de ejecución, sin la espera en cola
+        start = time.perf_counter()
+        status = "error"
+        try:
+            result = await job()
+            if result.get("success"):
+                status = "success"
+            return result
+        except asyncio.TimeoutError:
+            status = "timeout"
             return {"success": False, "error": f"Timeout ({self.timeout}s)"}
         except Exception as e:
             return {"success": False, "error": str(e)}
         finally:
-            # Eliminar archivo temporal
-            if 'f' in locals() and f.name:
-                try:
-                    os.unlink(f.name)
-                except:
-                    pass
+            executor_time.observe(time.perf_counter() - start, status=status)
+            self._slots.release()
+
+    async def execute_python(self, code: str) -> dict:
+        # Validación básica para evitar comandos del sistema en Python
+        if any(keyword in code for keyword in ['os.system', 'subprocess.run', 'subprocess.Popen', '__import__("os")']):
+            return {"success": False, "error": "Comandos del sistema no permitidos en el código Python."}
+
+        async def job():
+            proc = await self._take_worker()
+            stdout, stderr = await self._run(proc, code.encode())
+            # La última línea es el resultado JSON del worker
+            lines = stdout.rstrip("\n").rsplit("\n", 1)
+            try:
+                return json.loads(lines[-1])
+            except json.JSONDecodeError:
+                # El proceso murió antes de responder (p. ej. límite de memoria o CPU)
+                return {
+                    "success": False,
+                    "stdout": stdout[:self.max_output],
+                    "stderr": (stderr or f"Proceso terminado (código {proc.returncode})")[:self.max_output]
+                }
+
+        return await self._limited(job)
 
     async def execute_bash(self, command: str) -> dict:
         # Validación básica para evitar comandos peligrosos en Bash
         if any(keyword in command for keyword in ['rm -rf', 'sudo', 'mkfs', 'dd', 'chmod 777', 'chown']):
             return {"success": False, "error": "Comandos peligrosos no permitidos en Bash."}
 
-        """Ejecuta comando bash"""
-        try:
-            result = subprocess.run(
-                ['bash', '-c', command], # Ejecutar explícitamente con bash para mejor control
-                capture_output=True,
-                text=True,
-                timeout=self.timeout,
-                # Añadir preexec_fn para restringir permisos (limitado en sandbox)
-                # preexec_fn=lambda: os.setuid(1000) # Ejecutar como un usuario sin privilegios (ej. usuario 'sandbox' en Docker)
+        async def job():
+            # Los mismos límites vía ulimit antes de evaluar el comando
+            limits = f"ulimit -t {self.timeout} -v {self.memory_mb * 1024} -n {self.max_fds}"
+            proc = await asyncio.create_subprocess_exec(
+                'bash', '-c', f'{limits}; eval "$1"', 'sandbox', command,
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
             )
+            stdout, stderr = await self._run(proc, None)
             return {
-                "success": result.returncode == 0,
-                "stdout": result.stdout[:self.max_output],
-                "stderr": result.stderr[:self.max_output]
+                "success": proc.returncode == 0,
+                "stdout": stdout[:self.max_output],
+                "stderr": stderr[:self.max_output]
             }
-        except subprocess.TimeoutExpired:
-            return {"success": False, "error": f"Timeout ({self.timeout}s)"}
-        except Exception as e:
-            return {"success": False, "error": str(e)}
 
-executor = LocalExecutor(settings.EXECUTOR_TIMEOUT, settings.EXECUTOR_MAX_OUTPUT)
+        return await self._limited(job)
+
+executor = LocalExecutor(
+    settings.EXECUTOR_TIMEOUT,
+    settings.EXECUTOR_MAX_OUTPUT,
+    pool_size=settings.EXECUTOR_POOL_SIZE,
+    max_concurrency=settings.EXECUTOR_MAX_CONCURRENCY,
+    max_queue=settings.EXECUTOR_MAX_QUEUE,
+    memory_mb=settings.EXECUTOR_MEMORY_MB,
+    max_fds=settings.EXECUTOR_MAX_FDS
+)
 
 # ===== LOGGING =====
+request_log = RequestLog(
+    settings.LOGS_DIR,
+    max_batch=settings.REQUEST_LOG_BATCH,
+    flush_interval=settings.REQUEST_LOG_FLUSH_INTERVAL,
+    max_queue=settings.REQUEST_LOG_MAX_QUEUE
+)
+
 def log_request(endpoint: str, user_id: str, duration: float, status: str):
-    log_entry = {
+    """Encola la línea; el hilo de request_log la escribe en lote"""
+    request_log.write({
         "timestamp": datetime.now().isoformat(),
         "endpoint": endpoint,
         "user_id": user_id,
         "duration_ms": round(duration * 1000, 2),
         "status": status
+    })
+
+def sse_event(data: dict, event: Optional[str] = None) -> str:
+    """Serializa un evento Server-Sent Events"""
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def response_cache_key(model: str, messages: List[dict], image_data: Optional[str] = None) -> dict:
+    """Clave del caché de respuestas: modelo + contexto normalizado (espacios colapsados)"""
+    return {
+        "model": model,
+        "messages": [
+            {"role": msg["role"], "content": " ".join(str(msg["content"]).split())}
+            for msg in messages
+        ],
+        "image": hashlib.sha256(image_data.encode()).hexdigest() if image_data else None,
     }
-    log_file = settings.LOGS_DIR / f"requests_{datetime.now().strftime("%Y%m%d")}.log"
-    with open(log_file, 'a') as f:
-        f.write(json.dumps(log_entry) + "\n")
+
+def semantic_cache_text(messages: List[dict]) -> str:
+    """Texto a embeber: último turno del usuario y la respuesta previa del asistente como contexto"""
+    last_user = next((m for m in reversed(messages) if m["role"] == "user"), None)
+    if last_user is None:
+        return ""
+    idx = messages.index(last_user)
+    previous = next((m for m in reversed(messages[:idx]) if m["role"] == "assistant"), None)
+    parts = [previous["content"], last_user["content"]] if previous else [last_user["content"]]
+    return "\n".join(" ".join(str(part).split()) for part in parts)
+
+async def replay_cached_stream(entry: dict):
+    """Reproduce una respuesta cacheada con los mismos eventos que LocalModelManager._stream"""
+    for chunk in entry.get("chunks") or [entry["content"]]:
+        yield {"token": chunk}
+    yield {"done": True, "model": entry["model"], "stats": {"eval_count": entry.get("tokens", 0)}}
+
+# ===== ARRANQUE =====
+class Readiness:
+    """Estado de calentamiento de cada componente, para /ready"""
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.components: Dict[str, dict] = {}
+        self.required: set = set()
+        self._probes: Dict[str, Any] = {}
+
+    def register(self, name: str, required: bool, probe=None):
+        """probe(): estado en vivo una vez terminado el calentamiento (p. ej. salud de Ollama)"""
+        self.components[name] = {"state": "pending"}
+        if required:
+            self.required.add(name)
+        if probe is not None:
+            self._probes[name] = probe
+
+    def set(self, name: str, state: str, **details):
+        self.components[name] = {"state": state, **details}
+
+    def get(self, name: str) -> dict:
+        component = self.components.get(name, {"state": "pending"})
+        probe = self._probes.get(name)
+        if probe is not None and component["state"] in ("ready", "failed"):
+            component = {**component, "state": "ready" if probe() else "failed"}
+        return component
+
+    def is_ready(self, name: str) -> bool:
+        return self.get(name)["state"] == "ready"
+
+    @property
+    def ready(self) -> bool:
+        return all(self.is_ready(name) for name in self.required)
+
+    async def run(self, name: str, warm_up):
+        """Ejecuta el calentamiento de un componente registrando estado y duración"""
+        self.set(name, "warming")
+        t = time.monotonic()
+        try:
+            await warm_up()
+        except Exception as e:
+            self.set(name, "failed", error=str(e), duration_ms=round((time.monotonic() - t) * 1000, 2))
+            print(f"⚠ {name} no disponible: {e}")
+        else:
+            self.set(name, "ready", duration_ms=round((time.monotonic() - t) * 1000, 2))
+
+readiness = Readiness()
+readiness.register("database", required=True)
+readiness.register("ollama", required=True, probe=lambda: any(b.healthy for b in model_manager.backends))
+readiness.register("models", required=False)
+readiness.register("executor", required=False)
+readiness.register("whisper", required=False)
+readiness.register("semantic_cache", required=False)
+readiness.register("document_index", required=False)
+
+async def warm_up_ollama():
+    await model_manager._check_ollama()
+    model_manager.start_health_checks(settings.OLLAMA_HEALTH_INTERVAL)
+    if not any(backend.healthy for backend in model_manager.backends):
+        raise RuntimeError("ningún backend de Ollama responde")
+
+async def warm_up_models():
+    """Tras conectar con Ollama: carga los modelos fijados y luego el resto de la lista de precarga"""
+    await readiness.run("ollama", warm_up_ollama)
+    if not readiness.is_ready("ollama"):
+        readiness.set("models", "failed", error="Ollama no disponible")
+        return
+    models = list(dict.fromkeys(settings.MODEL_PINNED + (settings.MODEL_PRELOAD or [settings.DEFAULT_MODEL])))
+    await readiness.run("models", lambda: model_manager.preload(models))
+
+async def warm_up_semantic_cache():
+    global semantic_cache
+    from semantic_cache import SemanticCache
+    semantic_cache = SemanticCache(
+        threshold=settings.SEMANTIC_CACHE_THRESHOLD,
+        max_entries=settings.SEMANTIC_CACHE_MAX_ENTRIES,
+        ttl=settings.CACHE_TTL
+    )
+
+async def warm_up_document_index():
+    global document_retriever
+    document_retriever = await asyncio.to_thread(
+        DocumentRetriever,
+        settings.CACHE_DIR / "rag",
+        chunk_tokens=settings.RAG_CHUNK_TOKENS,
+        max_chunks=settings.RAG_MAX_CHUNKS,
+        embed_batch=settings.RAG_EMBED_BATCH,
+        top_k=settings.RAG_TOP_K,
+        ivf_min_rows=settings.RAG_IVF_MIN_ROWS,
+        nprobe=settings.RAG_IVF_NPROBE
+    )
+
+async def warm_up():
+    """Inicialización pesada en segundo plano: el servidor acepta conexiones desde el principio"""
+    tasks = [
+        readiness.run("database", lambda: asyncio.to_thread(create_db_and_tables)),
+        warm_up_models(),
+        readiness.run("executor", executor.start),
+    ]
+    if whisper_local.available:
+        tasks.append(readiness.run("whisper", whisper_local.warm_up))
+    else:
+        readiness.set("whisper", "disabled")
+    if settings.SEMANTIC_CACHE_ENABLED:
+        tasks.append(readiness.run("semantic_cache", warm_up_semantic_cache))
+    else:
+        readiness.set("semantic_cache", "disabled")
+    if settings.RAG_ENABLED:
+        tasks.append(readiness.run("document_index", warm_up_document_index))
+    else:
+        readiness.set("document_index", "disabled")
+    await asyncio.gather(*tasks)
+    print(f"✅ Arranque completo en {time.monotonic() - readiness.started_at:.2f}s")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    request_log.start()
+    lag_monitor = asyncio.create_task(monitor_event_loop_lag(settings.EVENT_LOOP_LAG_INTERVAL))
+    uploads_sweeper = asyncio.create_task(
+        sweep_uploads(settings.UPLOADS_SWEEP_INTERVAL, settings.UPLOADS_RETENTION_HOURS * 3600)
+    ) if settings.UPLOADS_RETENTION_HOURS > 0 else None
+    cache.start_sweeper(settings.CACHE_SWEEP_INTERVAL)
+    image_cache.start_sweeper(settings.CACHE_SWEEP_INTERVAL)
+    message_writer.start()
+    await model_manager.start()
+    warm_up_task = asyncio.create_task(warm_up())
+    yield
+    warm_up_task.cancel()
+    lag_monitor.cancel()
+    if uploads_sweeper is not None:
+        uploads_sweeper.cancel()
+    print("💾 Cerrando caché antes de salir...")
+    await cache.close()
+    await image_cache.close()
+    rate_limiter.store.close()
+    whisper_local.close()
+    await executor.close()
+    await conversation_context.close()
+    print("💾 Confirmando mensajes pendientes...")
+    await message_writer.close()
+    await asyncio.gather(*continuation_saves)
+    await async_engine.dispose()
+    await model_manager.close()
+    await asyncio.to_thread(request_log.close)
+
+app = FastAPI(
+    title="Local AI Agent",
+    description="Sistema IA 100% local sin costos cloud",
+    version="1.0.0",
+    lifespan=lifespan
+)
+class MetricsMiddleware:
+    """
+    Latencia total por ruta hasta el último byte enviado (incluye respuestas en streaming).
+    Se usa la plantilla de la ruta (/search, no /search?q=...) para acotar las etiquetas
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get("route")
+            request_latency.observe(
+                time.perf_counter() - start,
+                method=scope["method"], route=getattr(route, "path", "unmatched"), status=status
+            )
+
+class UploadLimitMiddleware:
+    """
+    Rechaza cuerpos mayores que MAX_UPLOAD_SIZE antes de que Starlette los vuelque a disco
+    al parsear el formulario: por Content-Length sin leer nada, o al superar el límite
+    mientras llegan los bloques (peticiones chunked sin Content-Length)
+    """
+    def __init__(self, app, max_bytes: int):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        detail = f"Archivo demasiado grande > {settings.MAX_UPLOAD_SIZE}MB"
+        length = dict(scope["headers"]).get(b"content-length")
+        if length is not None and length.isdigit() and int(length) > self.max_bytes:
+            response = JSONResponse({"detail": detail}, status_code=413, headers={"Connection": "close"})
+            return await response(scope, receive, send)
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    # FastAPI propaga las HTTPException lanzadas al leer el cuerpo
+                    raise HTTPException(413, detail)
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+app.add_middleware(UploadLimitMiddleware, max_bytes=upload_store.max_bytes + FORM_OVERHEAD)
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
 
 # ===== ENDPOINT PRINCIPAL =====
 @app.post("/process")
@@ -384,7 +1716,10 @@ async def process_local(
     file: Optional[UploadFile] = File(None),
     user_id: str = Form("anonymous"),
     stream: bool = Form(False),
-    db: Session = Depends(get_db)
+    no_cache: bool = Form(False), # No leer ni escribir el caché de respuestas
+    refresh_cache: bool = Form(False), # Ignorar la entrada cacheada y regenerarla
+    priority: str = Form("interactive"), # interactive | batch
+    db: AsyncSession = Depends(get_db)
 ):
     """
     Endpoint principal que procesa cualquier entrada
@@ -393,29 +1728,54 @@ async def process_local(
     start_time = time.time()
 
     # Rate Limiter
-    if not rate_limiter.check_limit(user_id):
-        raise HTTPException(status_code=429, detail="Límite de peticiones excedido")
+    allowed, rate_limit = rate_limiter.check(user_id)
+    if not allowed:
+        raise HTTPException(
+            status_code=429,
+            detail="Límite de peticiones excedido",
+            headers=rate_limit_headers(rate_limit)
+        )
+    if priority not in PRIORITIES:
+        raise HTTPException(status_code=400, detail=f"Prioridad no válida: {priority}")
+    if not readiness.is_ready("database"):
+        raise HTTPException(status_code=503, detail="Servicio iniciándose", headers={"Retry-After": "1"})
 
     try:
         # Recuperar historial de conversación
-        conversation = db.query(Conversation).filter(Conversation.user_id == user_id).first()
+        conversation_query = select(Conversation).where(Conversation.user_id == user_id)
+        conversation = (await db.execute(conversation_query)).scalar_one_or_none()
         if not conversation:
             conversation = Conversation(user_id=user_id)
             db.add(conversation)
-            db.commit()
-            db.refresh(conversation)
+            try:
+                await db.commit()
+            except IntegrityError:
+                # Otra petición creó la conversación a la vez (user_id es único)
+                await db.rollback()
+                conversation = (await db.execute(conversation_query)).scalar_one()
+        conversation_id = conversation.id
 
-        messages = []
-        for msg in conversation.messages:
-            messages.append({"role": msg.role, "content": msg.content})
+        # Ventana de contexto acotada (+ resumen de lo anterior)
+        messages, context_overflow = await conversation_context.build(
+            db, conversation, reserve_tokens=conversation_context.estimate_tokens(text)
+        )
+        if context_overflow:
+            conversation_context.schedule_summary(conversation_id)
+        history_len = len(messages)
+        if message_writer.pending(conversation_id):
+            # El último turno aún no tiene id: la continuación no se puede validar
+            last_message_id = None
+        else:
+            last_message_id = (await db.execute(
+                select(Message.id)
+                .where(Message.conversation_id == conversation_id)
+                .order_by(Message.timestamp.desc(), Message.id.desc())
+                .limit(1)
+            )).scalar()
 
-        # Añadir el nuevo mensaje del usuario al historial
+        # Añadir el nuevo mensaje del usuario al contexto; se guarda solo si la generación se admite
         if text:
             messages.append({"role": "user", "content": text})
-            user_message_db = Message(conversation_id=conversation.id, role="user", content=text)
-            db.add(user_message_db)
-            db.commit()
-            db.refresh(user_message_db)
 
         # Procesar archivo si existe
         image_data = None
@@ -423,64 +1783,184 @@ async def process_local(
         if file:
             if file.size > settings.MAX_UPLOAD_SIZE * 1024 * 1024:
                 raise HTTPException(413, f"Archivo demasiado grande > {settings.MAX_UPLOAD_SIZE}MB")
-            file_bytes = await file.read()
-            # Usar python-magic para una detección más precisa
+            # Copia por bloques al almacén (hash, límite y MIME sin cargar el archivo en memoria)
             try:
-                mime_type = magic.from_buffer(file_bytes, mime=True)
-            except Exception:
-                mime_type = file.content_type # Fallback a content_type de FastAPI
+                with upload_time.time(endpoint="/process"):
+                    upload = await asyncio.to_thread(upload_store.save, file.file, file.content_type)
+            except UploadTooLarge as e:
+                raise HTTPException(413, str(e))
+            mime_type = upload.mime_type = refine_mime(upload.path, upload.mime_type)
             metadata["filename"] = file.filename
-            metadata["size"] = len(file_bytes)
+            metadata["size"] = upload.size
             metadata["mime_type"] = mime_type
+            metadata["sha256"] = upload.sha256
+            metadata["deduplicated"] = upload.deduplicated
 
-            # Si es imagen, convertir a base64
+            # Si es imagen, reducirla y convertir a base64
             if mime_type.startswith("image/"):
-                image_data = base64.b64encode(file_bytes).decode("utf-8")
+                image_data = await prepare_image(upload)
             elif mime_type.startswith("audio/"):
                 if settings.USE_WHISPER:
-                    transcript = await whisper_local.transcribe(file_bytes)
+                    transcript = await whisper_local.transcribe(str(upload.path))
                 else:
                     transcript = "[Transcripción de audio deshabilitada]"
                 messages.append({"role": "user", "content": f"[Audio: {file.filename}]\n{transcript}"})
+            elif is_document(mime_type):
+                # Documento con pregunta: solo los pasajes recuperados; sin pregunta: resumen map-reduce
+                try:
+                    if text and document_retriever is not None:
+                        indexed = await document_retriever.add_document(upload, user_id, file.filename)
+                        passages = await document_retriever.retrieve(text, user_id, sha256=upload.sha256)
+                        messages.append({"role": "user", "content": f"[Documento: {file.filename}]\nPasajes relevantes:\n{format_passages(passages)}"})
+                        metadata["document_indexed"] = indexed["indexed"]
+                        metadata["passages"] = len(passages)
+                    else:
+                        document = await document_summarizer.summarize(upload, user_id, priority)
+                        messages.append({"role": "user", "content": f"[Documento: {file.filename}]\nResumen:\n{document['summary']}"})
+                        metadata["document_chunks"] = document["chunks"]
+                except SchedulerOverloaded as e:
+                    raise HTTPException(503, "Servidor saturado, inténtalo más tarde", headers={"Retry-After": str(e.retry_after)})
+                except Exception as e:
+                    print(f"⚠ No se pudo procesar el documento {file.filename}: {e}")
+                    messages.append({"role": "user", "content": f"[Archivo: {file.filename}]"})
             else:
                 # Para otros archivos, usar el texto si se proporciona
                 if not text:
                     messages.append({"role": "user", "content": f"[Archivo: {file.filename}]"})
 
-        # Llamar al modelo local
-        model_response = await model_manager.complete(messages, image_data, stream=stream)
+        elif text and document_retriever is not None:
+            # Sin adjunto: pasajes de los documentos ya indexados del usuario, si alguno es relevante
+            try:
+                passages = await document_retriever.retrieve(text, user_id, min_score=settings.RAG_MIN_SCORE)
+            except Exception as e:
+                print(f"⚠ Recuperación de documentos no disponible: {e}")
+                passages = []
+            if passages:
+                # Antes de la pregunta, para que el modelo la lea con el contexto delante
+                messages.insert(len(messages) - 1, {"role": "user", "content": f"Pasajes de tus documentos:\n{format_passages(passages)}"})
+                metadata["passages"] = len(passages)
+
+        # Caché de respuestas (opt-in): exacto y luego semántico
+        selected_model = model_manager.select_model(image_data)
+        cache_key = None
+        semantic_embedding = None
+        cached = None
+        if settings.RESPONSE_CACHE_ENABLED and not no_cache:
+            cache_key = response_cache_key(selected_model, messages, image_data)
+            if not refresh_cache:
+                cached = cache.get(cache_key)
+        # El caché semántico es por modelo y compartido entre usuarios, y su clave solo embebe el
+        # último turno: con pasajes o contenido de archivos (privados) la respuesta no es reutilizable
+        private_context = bool(file) or "passages" in metadata
+        if semantic_cache is not None and not no_cache and not cached and not image_data and not private_context:
+            query_text = semantic_cache_text(messages)
+            if query_text:
+                try:
+                    semantic_embedding = (await model_manager.embed([query_text]))[0]
+                    if not refresh_cache:
+                        cached = semantic_cache.lookup(selected_model, semantic_embedding)
+                except Exception as e:
+                    print(f"⚠ Caché semántico no disponible: {e}")
+
+        def remember_response(entry: dict):
+            if cache_key:
+                cache.set(cache_key, entry)
+            if semantic_embedding is not None:
+                semantic_cache.add(selected_model, semantic_embedding, entry)
+
+        # Llamar al modelo local. Con estado de continuación válido solo se envía el turno nuevo
+        ticket = None
+        if not cached:
+            continuation = await model_manager.load_continuation(db, conversation_id, selected_model, last_message_id)
+            model_messages = messages[history_len:] if continuation else messages
+            try:
+                ticket = await scheduler.acquire(
+                    selected_model, user_id, priority,
+                    cost=sum(conversation_context.estimate_tokens(str(msg["content"])) for msg in model_messages)
+                )
+            except SchedulerOverloaded as e:
+                raise HTTPException(
+                    status_code=503,
+                    detail="Servidor saturado, inténtalo más tarde",
+                    headers={"Retry-After": str(e.retry_after)}
+                )
+
+        # Petición admitida: ahora se guarda el turno del usuario (se confirma en el siguiente lote).
+        # Un 503 o un error previo no deja turnos sin respuesta que el cliente duplicaría al reintentar
+        if text:
+            message_writer.write(conversation_id, "user", text)
+
+        if cached:
+            model_response = replay_cached_stream(cached) if stream else {**cached, "cost": 0.0}
+        elif stream:
+            model_response = scheduled_stream(
+                await model_manager.complete(model_messages, image_data, stream=True, context=continuation),
+                ticket
+            )
+        else:
+            try:
+                model_response = await model_manager.complete(model_messages, image_data, context=continuation)
+            finally:
+                scheduler.release(ticket)
 
         if stream:
             async def stream_and_save_generator():
-                full_response_content = ""
-                async for chunk in model_response:
-                    full_response_content += chunk
-                    yield chunk
-                # Guardar la respuesta completa del asistente después del stream
-                assistant_message_db = Message(conversation_id=conversation.id, role="assistant", content=full_response_content)
-                db.add(assistant_message_db)
-                db.commit()
-                db.refresh(assistant_message_db)
-
-            return StreamingResponse(stream_and_save_generator(), media_type="text/event-stream")
+                chunks = []
+                async for event in model_response:
+                    if "token" in event:
+                        chunks.append(event["token"])
+                        yield sse_event({"token": event["token"]})
+                    elif "error" in event:
+                        yield sse_event(event, event="error")
+                    else:
+                        # Guardar la respuesta completa del asistente antes del evento final
+                        full_response_content = "".join(chunks)
+                        if full_response_content:
+                            write = message_writer.write(conversation_id, "assistant", full_response_content)
+                            if event.get("context"):
+                                schedule_continuation_save(write, conversation_id, event["model"], event["context"])
+                            if not cached:
+                                remember_response({
+                                    "content": full_response_content,
+                                    "chunks": chunks,
+                                    "model": event["model"],
+                                    "tokens": event["stats"].get("eval_count", 0)
+                                })
+                        event.pop("context", None)
+                        event["from_cache"] = bool(cached)
+                        event["processing_time"] = round(time.time() - start_time, 2)
+                        yield sse_event(event, event="done")
+                log_request("/process", user_id, time.time() - start_time, "stream")
+
+            return StreamingResponse(
+                stream_and_save_generator(),
+                media_type="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+                # Por si el stream nunca llega a iterarse (release es idempotente)
+                background=BackgroundTask(scheduler.release, ticket) if ticket else None
+            )
         else:
             # No streaming: procesar la respuesta completa
             result_content = model_response["content"]
             model_name = model_response["model"]
-            tokens_used = model_response["tokens"]
+            tokens_used = model_response.get("tokens", 0)
             cost = model_response["cost"]
 
+            if not cached and model_name != "error":
+                remember_response({"content": result_content, "model": model_name, "tokens": tokens_used})
+
             # Verificar si necesita ejecutar código
-            if "```python" in result_content:
+            executed = "```python" in result_content
+            if executed:
                 code = result_content.split("```python")[1].split("```")[0].strip()
                 exec_result = await executor.execute_python(code)
-                result_content += f"\n\n[Resultado de ejecución]\n{exec_result['stdout']}"
+                result_content += f"\n\n[Resultado de ejecución]\n{exec_result.get('stdout') or exec_result.get('error', '')}"
 
             # Guardar la respuesta del asistente
-            assistant_message_db = Message(conversation_id=conversation.id, role="assistant", content=result_content)
-            db.add(assistant_message_db)
-            db.commit()
-            db.refresh(assistant_message_db)
+            write = message_writer.write(conversation_id, "assistant", result_content)
+            # El resultado de ejecución no está en el contexto del modelo: en ese caso se reconstruye
+            if model_response.get("context") and not executed:
+                schedule_continuation_save(write, conversation_id, model_name, model_response["context"])
 
             result = {
                 "response": result_content,
@@ -488,8 +1968,9 @@ async def process_local(
                 "cost": cost,
                 "metadata": metadata,
                 "processing_time": round(time.time() - start_time, 2),
-                "from_cache": False
+                "from_cache": bool(cached)
             }
+            log_request("/process", user_id, time.time() - start_time, "ok" if model_name != "error" else "model_error")
             return JSONResponse(result)
 
     except HTTPException:
@@ -498,19 +1979,246 @@ async def process_local(
         log_request("/process", user_id, time.time() - start_time, "error")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/documents/summarize")
+async def summarize_document(
+    file: Optional[UploadFile] = File(None),
+    url: Optional[str] = Form(None),
+    text: Optional[str] = Form(None),
+    question: Optional[str] = Form(None), # Sin pregunta: resumen general
+    user_id: str = Form("anonymous"),
+    priority: str = Form("interactive")
+):
+    """Resume un documento (PDF, DOCX, TXT, HTML), una URL o un texto largo"""
+    start_time = time.time()
+    allowed, rate_limit = rate_limiter.check(user_id)
+    if not allowed:
+        raise HTTPException(status_code=429, detail="Límite de peticiones excedido", headers=rate_limit_headers(rate_limit))
+    if priority not in PRIORITIES:
+        raise HTTPException(status_code=400, detail=f"Prioridad no válida: {priority}")
+
+    try:
+        if file:
+            with upload_time.time(endpoint="/documents/summarize"):
+                upload = await asyncio.to_thread(upload_store.save, file.file, file.content_type)
+        elif url:
+            upload = await fetch_url(url)
+        elif text:
+            upload = await asyncio.to_thread(upload_store.save, io.BytesIO(text.encode("utf-8")), "text/plain")
+        else:
+            raise HTTPException(400, "Envía un archivo, una URL o un texto")
+        upload.mime_type = refine_mime(upload.path, upload.mime_type)
+        if not is_document(upload.mime_type):
+            raise UnsupportedDocument(f"Tipo de documento no soportado: {upload.mime_type}")
+        result = await document_summarizer.summarize(upload, user_id, priority, question)
+    except HTTPException:
+        raise
+    except UploadTooLarge as e:
+        raise HTTPException(413, str(e))
+    except BlockedURL as e:
+        raise HTTPException(400, str(e))
+    except UnsupportedDocument as e:
+        raise HTTPException(415, str(e))
+    except SchedulerOverloaded as e:
+        raise HTTPException(503, "Servidor saturado, inténtalo más tarde", headers={"Retry-After": str(e.retry_after)})
+    except Exception as e:
+        raise HTTPException(502, f"Error procesando el documento: {e}")
+    return {**result, "mime_type": upload.mime_type, "processing_time": round(time.time() - start_time, 2)}
+
+@app.post("/documents/index")
+async def index_document(
+    file: Optional[UploadFile] = File(None),
+    url: Optional[str] = Form(None),
+    text: Optional[str] = Form(None),
+    user_id: str = Form("anonymous")
+):
+    """Añade un documento al índice de recuperación del usuario (sin reconstruir el índice)"""
+    start_time = time.time()
+    allowed, rate_limit = rate_limiter.check(user_id)
+    if not allowed:
+        raise HTTPException(status_code=429, detail="Límite de peticiones excedido", headers=rate_limit_headers(rate_limit))
+    if document_retriever is None:
+        raise HTTPException(503, "Índice de documentos no disponible", headers={"Retry-After": "1"})
+
+    try:
+        if file:
+            with upload_time.time(endpoint="/documents/index"):
+                upload = await asyncio.to_thread(upload_store.save, file.file, file.content_type)
+        elif url:
+            upload = await fetch_url(url)
+        elif text:
+            upload = await asyncio.to_thread(upload_store.save, io.BytesIO(text.encode("utf-8")), "text/plain")
+        else:
+            raise HTTPException(400, "Envía un archivo, una URL o un texto")
+        upload.mime_type = refine_mime(upload.path, upload.mime_type)
+        if not is_document(upload.mime_type):
+            raise UnsupportedDocument(f"Tipo de documento no soportado: {upload.mime_type}")
+        result = await document_retriever.add_document(upload, user_id, file.filename if file else url)
+    except HTTPException:
+        raise
+    except UploadTooLarge as e:
+        raise HTTPException(413, str(e))
+    except BlockedURL as e:
+        raise HTTPException(400, str(e))
+    except UnsupportedDocument as e:
+        raise HTTPException(415, str(e))
+    except Exception as e:
+        raise HTTPException(502, f"Error indexando el documento: {e}")
+    return {**result, "mime_type": upload.mime_type, "processing_time": round(time.time() - start_time, 2)}
+
+# ===== BÚSQUEDA EN EL HISTORIAL (FTS5) =====
+SEARCH_SORTS = ("rank", "recent")
+
+def fts_match(query: str, conversation_id: int) -> Optional[str]:
+    """
+    Expresión MATCH segura a partir del texto del usuario: cada palabra entre comillas
+    (sin operadores FTS5) y la última como prefijo, restringida a la conversación
+    """
+    words = re.findall(r"\w+", query)
+    if not words:
+        return None
+    terms = " ".join(f'"{word}"' for word in words) + "*"
+    return f'conversation_id : "{conversation_id}" AND content : ({terms})'
+
+def encode_search_cursor(values: list) -> str:
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip("=")
+
+def decode_search_cursor(cursor: str) -> list:
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except Exception:
+        raise HTTPException(400, "Cursor no válido")
+
+@app.get("/search")
+async def search_messages(
+    q: str,
+    user_id: str = "anonymous",
+    limit: int = 20,
+    cursor: Optional[str] = None, # next_cursor de la página anterior
+    sort: str = "rank", # rank (bm25) | recent
+    highlight_start: str = "<mark>",
+    highlight_end: str = "</mark>",
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Busca en los mensajes del usuario. Paginación por cursor (keyset): cada página continúa
+    tras el último resultado en vez de usar OFFSET, así que su coste no crece con la página
+    """
+    allowed, rate_limit = rate_limiter.check(user_id)
+    if not allowed:
+        raise HTTPException(status_code=429, detail="Límite de peticiones excedido", headers=rate_limit_headers(rate_limit))
+    if sort not in SEARCH_SORTS:
+        raise HTTPException(400, f"Orden no válido: {sort}")
+    if not readiness.is_ready("database"):
+        raise HTTPException(status_code=503, detail="Servicio iniciándose", headers={"Retry-After": "1"})
+    limit = max(1, min(limit, 100))
+
+    conversation_id = (await db.execute(
+        select(Conversation.id).where(Conversation.user_id == user_id)
+    )).scalar()
+    match = fts_match(q, conversation_id) if conversation_id is not None else None
+    if match is None:
+        return {"query": q, "hits": [], "next_cursor": None}
+
+    params = {"match": match, "limit": limit + 1, "hs": highlight_start, "he": highlight_end}
+    keyset = ""
+    if cursor:
+        values = decode_search_cursor(cursor)
+        if sort == "rank":
+            keyset = "AND (messages_fts.rank > :rank OR (messages_fts.rank = :rank AND messages_fts.rowid > :after_id))"
+            params["rank"], params["after_id"] = values
+        else:
+            keyset = "AND messages_fts.rowid < :after_id"
+            params["after_id"] = values[0]
+    order = "messages_fts.rank, messages_fts.rowid" if sort == "rank" else "messages_fts.rowid DESC"
+    rows = (await db.execute(sql_text(f"""
+        SELECT m.id, m.role, m.timestamp, messages_fts.rank AS rank,
+               snippet(messages_fts, 0, :hs, :he, '…', 16) AS snippet
+        FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid
+        WHERE messages_fts MATCH :match {keyset}
+        ORDER BY {order}
+        LIMIT :limit
+    """), params)).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_search_cursor([last.rank, last.id] if sort == "rank" else [last.id])
+    return {
+        "query": q,
+        "hits": [
+            {
+                "id": row.id,
+                "role": row.role,
+                "timestamp": str(row.timestamp),
+                "snippet": row.snippet,
+                "score": round(-row.rank, 4)
+            }
+            for row in rows
+        ],
+        "next_cursor": next_cursor
+    }
+
 # ===== OTROS ENDPOINTS =====
+@app.get("/metrics")
+def metrics_endpoint():
+    """Métricas del proceso en formato de texto de Prometheus"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 @app.get("/health")
 def health_check():
+    """Liveness: el proceso responde (puede estar aún calentando)"""
     return {"status": "ok"}
 
+@app.get("/ready")
+def ready_check():
+    """Readiness: 200 cuando los componentes requeridos están listos, 503 mientras tanto"""
+    return JSONResponse({
+        "ready": readiness.ready,
+        "uptime_s": round(time.monotonic() - readiness.started_at, 2),
+        "components": {
+            name: {**readiness.get(name), "required": name in readiness.required}
+            for name in readiness.components
+        }
+    }, status_code=200 if readiness.ready else 503)
+
+@app.get("/backends")
+def backends_status():
+    return [backend.to_dict() for backend in model_manager.backends]
+
+@app.get("/models/residency")
+def models_residency():
+    return {
+        **model_manager.residency.get_stats(),
+        "backends": {
+            backend.url: {
+                model: {
+                    **info,
+                    "pinned": model in model_manager.residency.pinned,
+                    "in_flight": backend.busy.get(model, 0),
+                    "keep_alive": model_manager.residency.keep_alive(model)
+                }
+                for model, info in backend.resident.items()
+            }
+            for backend in model_manager.backends
+        }
+    }
+
+@app.get("/scheduler/stats")
+def scheduler_stats():
+    return scheduler.get_stats()
+
+@app.get("/documents/index/stats")
+def document_index_stats():
+    return document_retriever.index.get_stats() if document_retriever else {"enabled": False}
+
 @app.get("/cache/stats")
 def cache_stats():
-    return cache.get_stats()
-
-@app.on_event("shutdown")
-def on_shutdown():
-    print("💾 Guardando caché antes de salir...")
-    cache._save_cache()
+    return {
+        **cache.get_stats(),
+        "images": image_cache.get_stats(),
+        "semantic": semantic_cache.get_stats() if semantic_cache else None
+    }
 
 if __name__ == "__main__":
     import uvicorn
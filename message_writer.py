@@ -0,0 +1,111 @@
+"""
+Escritura diferida de mensajes con group commit
+Las inserciones de Message de muchas peticiones se agrupan en una sola transacción
+(un fsync) cada pocos milisegundos o cada N filas
+"""
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, List, Optional
+import asyncio
+
+from database import Message
+
+
+class MessageWriter:
+    """Cola de inserciones con un escritor en segundo plano"""
+    def __init__(self, session_factory, max_batch: int, max_delay: float, retries: int = 3):
+        self.session_factory = session_factory
+        self.max_batch = max_batch
+        self.max_delay = max_delay # segundos
+        self.retries = retries
+        self._queue: Optional[asyncio.Queue] = None
+        self._pending: Dict[int, List[Message]] = defaultdict(list) # Aún no confirmados, por conversación
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"batches": 0, "rows": 0, "largest_batch": 0, "failed_rows": 0}
+
+    def start(self):
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+
+    def write(self, conversation_id: int, role: str, content: str) -> asyncio.Future:
+        """
+        Encola el mensaje y devuelve un future con su id una vez confirmado.
+        No hace falta esperarlo: pending() lo expone mientras tanto
+        """
+        self.start()
+        message = Message(conversation_id=conversation_id, role=role, content=content, timestamp=datetime.utcnow())
+        future = asyncio.get_running_loop().create_future()
+        self._pending[conversation_id].append(message)
+        self._queue.put_nowait((message, future))
+        return future
+
+    def pending(self, conversation_id: int) -> List[Message]:
+        """Mensajes encolados y aún no confirmados (lectura de lo propio escrito)"""
+        return list(self._pending.get(conversation_id, ()))
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                    continue
+                except asyncio.QueueEmpty:
+                    pass
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self._commit(batch)
+
+    async def _commit(self, batch: list):
+        error = None
+        for attempt in range(self.retries):
+            try:
+                async with self.session_factory() as session:
+                    session.add_all([message for message, _ in batch])
+                    await session.commit()
+                error = None
+                break
+            except Exception as e:
+                error = e
+                await asyncio.sleep(0.05 * (attempt + 1))
+
+        for message, future in batch:
+            pending = self._pending.get(message.conversation_id)
+            if pending is not None:
+                pending.remove(message)
+                if not pending:
+                    del self._pending[message.conversation_id]
+            if not future.done():
+                if error is None:
+                    future.set_result(message.id)
+                else:
+                    future.set_exception(error)
+                    future.exception() # Marcar como recuperada: quien no espera no recibe warnings
+            self._queue.task_done()
+
+        if error is None:
+            self.stats["batches"] += 1
+            self.stats["rows"] += len(batch)
+            self.stats["largest_batch"] = max(self.stats["largest_batch"], len(batch))
+        else:
+            self.stats["failed_rows"] += len(batch)
+            print(f"❌ Error guardando {len(batch)} mensajes: {error}")
+
+    async def flush(self):
+        """Espera a que todo lo encolado esté confirmado"""
+        if self._queue is not None:
+            await self._queue.join()
+
+    async def close(self):
+        await self.flush()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
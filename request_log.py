@@ -0,0 +1,77 @@
+"""
+Registro de peticiones en segundo plano
+write() solo encola (nunca bloquea el event loop); un hilo escribe los lotes en
+LOGS_DIR/requests_AAAAMMDD.log con una apertura por lote en vez de una por línea
+"""
+from datetime import datetime
+from pathlib import Path
+from typing import List, Optional
+import json
+import queue
+import threading
+import time
+
+
+class RequestLog:
+    def __init__(self, directory: Path, max_batch: int = 500, flush_interval: float = 1.0, max_queue: int = 10_000):
+        self.directory = directory
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval # segundos máximos que una línea espera en memoria
+        self._queue: queue.Queue = queue.Queue(max_queue)
+        self._thread: Optional[threading.Thread] = None
+        self._stop = object()
+        self.stats = {"written": 0, "dropped": 0, "batches": 0, "errors": 0}
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="request-log", daemon=True)
+            self._thread.start()
+
+    def write(self, entry: dict):
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            # Disco lento o atascado: se pierde la línea antes que bloquear peticiones
+            self.stats["dropped"] += 1
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            stop = item is self._stop
+            batch: List[dict] = [] if stop else [item]
+            # Agrupar lo que llegue hasta llenar el lote o cumplir el intervalo
+            deadline = time.monotonic() + self.flush_interval
+            while not stop and len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is self._stop:
+                    stop = True
+                else:
+                    batch.append(item)
+            if batch:
+                self._flush(batch)
+            if stop:
+                return
+
+    def _flush(self, batch: List[dict]):
+        path = self.directory / f"requests_{datetime.now().strftime('%Y%m%d')}.log"
+        try:
+            with open(path, "a", encoding="utf-8") as f:
+                f.write("".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in batch))
+            self.stats["written"] += len(batch)
+            self.stats["batches"] += 1
+        except OSError as e:
+            self.stats["errors"] += 1
+            print(f"⚠ No se pudo escribir el log de peticiones: {e}")
+
+    def close(self, timeout: float = 5.0):
+        """Escribe lo pendiente y detiene el hilo"""
+        if self._thread is not None:
+            self._queue.put(self._stop)
+            self._thread.join(timeout)
+            self._thread = None
@@ -0,0 +1,75 @@
+"""
+Residencia de modelos en Ollama
+Qué modelos siguen cargados en cada backend: los fijados nunca se descargan, el resto
+por LRU dentro de un presupuesto de RAM. También keep_alive por modelo y tiempos de carga
+Los nombres de modelo llegan ya normalizados (ver _model_key en main.py)
+"""
+from typing import Dict, Iterable, List, Union
+import time
+
+
+class ModelResidency:
+    """Política de residencia; el gestor de modelos hace las llamadas a Ollama"""
+    def __init__(self, pinned: Iterable[str], keep_alive: Dict[str, str], default_keep_alive: str, ram_budget: int):
+        self.pinned = set(pinned)
+        self.keep_alive_overrides = keep_alive
+        self.default_keep_alive = default_keep_alive
+        self.ram_budget = ram_budget # bytes por backend (0 = sin gestión)
+        self.last_used: Dict[str, float] = {}
+        self.loads: Dict[str, dict] = {} # Cargas en frío observadas por modelo
+        self.evictions = 0
+
+    def keep_alive(self, model: str) -> Union[str, int]:
+        """-1 mantiene el modelo cargado indefinidamente en Ollama"""
+        if model in self.pinned:
+            return -1
+        return self.keep_alive_overrides.get(model, self.default_keep_alive)
+
+    def touch(self, model: str):
+        self.last_used[model] = time.time()
+
+    def record_load(self, model: str, load_ms: float):
+        stats = self.loads.setdefault(model, {"count": 0, "last_ms": 0.0, "max_ms": 0.0, "total_ms": 0.0})
+        stats["count"] += 1
+        stats["last_ms"] = round(load_ms, 2)
+        stats["max_ms"] = round(max(stats["max_ms"], load_ms), 2)
+        stats["total_ms"] += load_ms
+
+    def plan_evictions(self, resident: Dict[str, int], model: str, size: int, busy: Iterable[str]) -> List[str]:
+        """
+        Modelos a descargar para que `model` (de `size` bytes) quepa en el presupuesto.
+        Nunca los fijados ni los que tienen peticiones en curso; primero los menos usados
+        """
+        if not self.ram_budget or model in resident:
+            return []
+        total = sum(resident.values()) + size
+        busy = set(busy)
+        candidates = sorted(
+            (m for m in resident if m not in self.pinned and m not in busy and m != model),
+            key=lambda m: self.last_used.get(m, 0.0)
+        )
+        victims = []
+        for candidate in candidates:
+            if total <= self.ram_budget:
+                break
+            victims.append(candidate)
+            total -= resident[candidate]
+        return victims
+
+    def get_stats(self) -> dict:
+        now = time.time()
+        return {
+            "ram_budget_mb": self.ram_budget // (1024 * 1024),
+            "pinned": sorted(self.pinned),
+            "evictions": self.evictions,
+            "idle_s": {model: round(now - used, 1) for model, used in self.last_used.items()},
+            "loads": {
+                model: {
+                    "count": stats["count"],
+                    "last_ms": stats["last_ms"],
+                    "max_ms": stats["max_ms"],
+                    "avg_ms": round(stats["total_ms"] / stats["count"], 2)
+                }
+                for model, stats in self.loads.items()
+            }
+        }
@@ -0,0 +1,50 @@
+"""
+Intérprete de un solo uso para LocalExecutor
+Se arranca por adelantado (pre-calentado), aplica sus límites de recursos y queda
+bloqueado leyendo el código por stdin. Ejecuta, imprime el resultado como JSON
+en la última línea de stdout y termina.
+
+Uso: python -I sandbox_worker.py <cpu_segundos> <memoria_mb> <max_fds> <max_output>
+"""
+import contextlib
+import io
+import json
+import resource
+import sys
+import traceback
+
+
+def _set_limits(cpu_seconds: int, memory_mb: int, max_fds: int):
+    resource.setrlimit(resource.RLIMIT_CPU, (cpu_seconds, cpu_seconds))
+    memory = memory_mb * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+    resource.setrlimit(resource.RLIMIT_NOFILE, (max_fds, max_fds))
+
+
+def main():
+    cpu_seconds, memory_mb, max_fds, max_output = (int(arg) for arg in sys.argv[1:5])
+    result_stream = sys.stdout
+    code = sys.stdin.read() # Bloquea hasta que el pool asigna un trabajo
+    _set_limits(cpu_seconds, memory_mb, max_fds)
+
+    stdout, stderr = io.StringIO(), io.StringIO()
+    success = True
+    with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+        try:
+            exec(compile(code, "<sandbox>", "exec"), {"__name__": "__main__"})
+        except SystemExit as e:
+            success = e.code in (None, 0)
+        except BaseException:
+            success = False
+            traceback.print_exc()
+
+    result_stream.write("\n" + json.dumps({
+        "success": success,
+        "stdout": stdout.getvalue()[:max_output],
+        "stderr": stderr.getvalue()[:max_output]
+    }) + "\n")
+    result_stream.flush()
+
+
+if __name__ == "__main__":
+    main()
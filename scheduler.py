@@ -0,0 +1,198 @@
+"""
+Control de admisión y planificación justa delante de Ollama
+Límite de concurrencia por modelo, cola acotada, reparto por usuario (deficit round robin)
+y clases de prioridad
+"""
+from collections import OrderedDict, deque
+from typing import Callable, Dict, Optional
+import asyncio
+import math
+import time
+
+# De mayor a menor prioridad
+PRIORITIES = ("interactive", "batch")
+
+
+class SchedulerOverloaded(Exception):
+    """La cola está llena o la espera estimada supera el máximo"""
+    def __init__(self, retry_after: int):
+        super().__init__(f"Cola saturada, reintentar en {retry_after}s")
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    __slots__ = ("future", "user_id", "cost", "enqueued_at")
+
+    def __init__(self, future: asyncio.Future, user_id: str, cost: int):
+        self.future = future
+        self.user_id = user_id
+        self.cost = cost
+        self.enqueued_at = time.monotonic()
+
+
+class _ModelQueue:
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+        self.queued = 0
+        # Por prioridad: user_id -> deque de _Waiter, en orden de turno
+        self.users: Dict[str, "OrderedDict[str, deque]"] = {p: OrderedDict() for p in PRIORITIES}
+        self.deficit: Dict[str, Dict[str, int]] = {p: {} for p in PRIORITIES}
+        self.current: Dict[str, Optional[str]] = {p: None for p in PRIORITIES} # Usuario que ya recibió su quantum
+        self.served = 0
+        self.rejected = 0
+        self.avg_wait = 0.0 # EWMA en segundos
+        self.max_wait = 0.0
+        self.avg_service = 1.0 # EWMA en segundos
+
+
+class Ticket:
+    """Slot concedido; se devuelve con ModelScheduler.release"""
+    __slots__ = ("model", "started_at", "released")
+
+    def __init__(self, model: str):
+        self.model = model
+        self.started_at = time.monotonic()
+        self.released = False
+
+
+class ModelScheduler:
+    """Planificador asíncrono: un slot por generación en curso"""
+    def __init__(self, default_limit: int, limits: Dict[str, int], max_queue: int,
+                 max_wait: float, quantum: int, on_wait: Optional[Callable[[str, str, float], None]] = None):
+        self.default_limit = default_limit
+        self.limits = limits
+        self.max_queue = max_queue # Por modelo
+        self.max_wait = max_wait # segundos
+        self.quantum = quantum # Coste (tokens estimados) acreditado por turno a cada usuario
+        self.queues: Dict[str, _ModelQueue] = {}
+        self.on_wait = on_wait # (modelo, prioridad, segundos) por cada slot concedido, p. ej. para métricas
+
+    def _queue(self, model: str) -> _ModelQueue:
+        q = self.queues.get(model)
+        if q is None:
+            q = self.queues[model] = _ModelQueue(self.limits.get(model, self.default_limit))
+        return q
+
+    def estimated_wait(self, model: str) -> float:
+        q = self._queue(model)
+        if q.active < q.limit and q.queued == 0:
+            return 0.0
+        return (q.queued + 1) / q.limit * q.avg_service
+
+    async def acquire(self, model: str, user_id: str, priority: str = "interactive", cost: int = 1) -> Ticket:
+        """Espera un slot para `model`. Lanza SchedulerOverloaded si no se admite"""
+        if priority not in PRIORITIES:
+            raise ValueError(f"Prioridad desconocida: {priority}")
+        q = self._queue(model)
+        if q.active < q.limit and q.queued == 0:
+            q.active += 1
+            self._record_wait(q, model, priority, 0.0)
+            return Ticket(model)
+
+        wait = self.estimated_wait(model)
+        if q.queued >= self.max_queue or wait > self.max_wait:
+            q.rejected += 1
+            raise SchedulerOverloaded(max(1, math.ceil(wait)))
+
+        waiter = _Waiter(asyncio.get_running_loop().create_future(), user_id, max(1, cost))
+        q.users[priority].setdefault(user_id, deque()).append(waiter)
+        q.queued += 1
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # El slot se concedió justo al cancelar: devolverlo
+                self._release_slot(q)
+            else:
+                self._remove_waiter(q, priority, waiter)
+            raise
+        self._record_wait(q, model, priority, time.monotonic() - waiter.enqueued_at)
+        return Ticket(model)
+
+    def release(self, ticket: Ticket):
+        """Devuelve el slot (idempotente)"""
+        if ticket.released:
+            return
+        ticket.released = True
+        q = self._queue(ticket.model)
+        q.avg_service = 0.8 * q.avg_service + 0.2 * (time.monotonic() - ticket.started_at)
+        self._release_slot(q)
+
+    def _release_slot(self, q: _ModelQueue):
+        q.active -= 1
+        self._dispatch(q)
+
+    def _record_wait(self, q: _ModelQueue, model: str, priority: str, wait: float):
+        q.served += 1
+        q.avg_wait = 0.8 * q.avg_wait + 0.2 * wait
+        q.max_wait = max(q.max_wait, wait)
+        if self.on_wait is not None:
+            self.on_wait(model, priority, wait)
+
+    def _remove_waiter(self, q: _ModelQueue, priority: str, waiter: _Waiter):
+        waiters = q.users[priority].get(waiter.user_id)
+        if waiters is None or waiter not in waiters:
+            return
+        waiters.remove(waiter)
+        q.queued -= 1
+        if not waiters:
+            self._drop_user(q, priority, waiter.user_id)
+
+    def _drop_user(self, q: _ModelQueue, priority: str, user_id: str):
+        del q.users[priority][user_id]
+        q.deficit[priority].pop(user_id, None)
+        if q.current[priority] == user_id:
+            q.current[priority] = None
+
+    def _dispatch(self, q: _ModelQueue):
+        while q.active < q.limit and q.queued:
+            waiter = self._next_waiter(q)
+            q.queued -= 1
+            if waiter.future.done():
+                # Cancelado pero su tarea aún no ha salido de la cola (el CancelledError de
+                # acquire se entrega en la siguiente vuelta del loop): se descarta sin slot
+                continue
+            q.active += 1
+            waiter.future.set_result(None)
+
+    def _next_waiter(self, q: _ModelQueue) -> _Waiter:
+        """Prioridad estricta entre clases, deficit round robin entre usuarios de una clase"""
+        for priority in PRIORITIES:
+            users = q.users[priority]
+            if not users:
+                continue
+            deficit = q.deficit[priority]
+            while True:
+                user_id, waiters = next(iter(users.items()))
+                if q.current[priority] != user_id:
+                    # Nuevo turno de este usuario: acreditar quantum
+                    deficit[user_id] = deficit.get(user_id, 0) + self.quantum
+                    q.current[priority] = user_id
+                head = waiters[0]
+                if deficit[user_id] >= head.cost:
+                    deficit[user_id] -= head.cost
+                    waiters.popleft()
+                    if not waiters:
+                        self._drop_user(q, priority, user_id)
+                    return head
+                # Sin crédito suficiente: pasa al final de la ronda
+                users.move_to_end(user_id)
+                q.current[priority] = None
+        raise RuntimeError("Cola vacía")
+
+    def get_stats(self) -> dict:
+        return {
+            model: {
+                "limit": q.limit,
+                "active": q.active,
+                "queued": q.queued,
+                "served": q.served,
+                "rejected": q.rejected,
+                "avg_wait_ms": round(q.avg_wait * 1000, 2),
+                "max_wait_ms": round(q.max_wait * 1000, 2),
+                "avg_service_ms": round(q.avg_service * 1000, 2),
+                "estimated_wait_s": round(self.estimated_wait(model), 2)
+            }
+            for model, q in self.queues.items()
+        }
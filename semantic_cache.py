@@ -0,0 +1,117 @@
+"""
+Caché semántico de respuestas
+Busca prompts parecidos (paráfrasis) por similitud coseno entre embeddings
+"""
+from typing import Optional, Dict, Any, List
+import time
+
+import numpy as np
+
+
+class _Namespace:
+    """Índice vectorial denso de un modelo: una fila por entrada"""
+    def __init__(self, dim: int, capacity: int = 64):
+        self.dim = dim
+        self.vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self.expires_at = np.zeros(capacity, dtype=np.float64)
+        self.last_used = np.zeros(capacity, dtype=np.float64)
+        self.entries: List[dict] = []
+
+    @property
+    def size(self) -> int:
+        return len(self.entries)
+
+    def _grow(self):
+        capacity = self.vectors.shape[0] * 2
+        for name in ("vectors", "expires_at", "last_used"):
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def append(self, vector: np.ndarray, data: dict, expires_at: float, now: float):
+        if self.size == self.vectors.shape[0]:
+            self._grow()
+        i = self.size
+        self.vectors[i] = vector
+        self.expires_at[i] = expires_at
+        self.last_used[i] = now
+        self.entries.append(data)
+
+    def remove(self, i: int):
+        """Elimina la fila i moviendo la última a su lugar (mantiene la matriz compacta)"""
+        last = self.size - 1
+        if i != last:
+            self.vectors[i] = self.vectors[last]
+            self.expires_at[i] = self.expires_at[last]
+            self.last_used[i] = self.last_used[last]
+            self.entries[i] = self.entries[last]
+        self.entries.pop()
+
+    def drop_expired(self, now: float) -> int:
+        n = self.size
+        keep = self.expires_at[:n] > now
+        removed = int(n - keep.sum())
+        if removed:
+            k = n - removed
+            self.vectors[:k] = self.vectors[:n][keep]
+            self.expires_at[:k] = self.expires_at[:n][keep]
+            self.last_used[:k] = self.last_used[:n][keep]
+            self.entries = [entry for entry, kept in zip(self.entries, keep) if kept]
+        return removed
+
+
+class SemanticCache:
+    """Respuestas indexadas por embedding del prompt, con un espacio de nombres por modelo"""
+    def __init__(self, threshold: float, max_entries: int, ttl: int):
+        self.threshold = threshold
+        self.max_entries = max_entries # Por modelo
+        self.ttl = ttl
+        self.namespaces: Dict[str, _Namespace] = {}
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def lookup(self, namespace: str, embedding: List[float]) -> Optional[dict]:
+        """Devuelve la respuesta más parecida si supera el umbral de similitud"""
+        index = self.namespaces.get(namespace)
+        query = self._normalize(embedding)
+        if index is None or index.size == 0 or index.dim != query.shape[0]:
+            self.stats["misses"] += 1
+            return None
+        now = time.time()
+        n = index.size
+        scores = index.vectors[:n] @ query
+        scores[index.expires_at[:n] <= now] = -np.inf
+        best = int(np.argmax(scores))
+        if scores[best] >= self.threshold:
+            index.last_used[best] = now
+            self.stats["hits"] += 1
+            return index.entries[best]
+        self.stats["misses"] += 1
+        return None
+
+    def add(self, namespace: str, embedding: List[float], data: dict):
+        vector = self._normalize(embedding)
+        index = self.namespaces.get(namespace)
+        if index is None or index.dim != vector.shape[0]:
+            # Primer uso o cambió el modelo de embeddings
+            index = self.namespaces[namespace] = _Namespace(vector.shape[0])
+        now = time.time()
+        self.stats["expirations"] += index.drop_expired(now)
+        while index.size >= self.max_entries:
+            index.remove(int(np.argmin(index.last_used[:index.size])))
+            self.stats["evictions"] += 1
+        index.append(vector, data, now + self.ttl, now)
+
+    def get_stats(self) -> Dict[str, Any]:
+        total = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "hit_rate": self.stats["hits"] / total if total > 0 else 0,
+            "entries": {name: index.size for name, index in self.namespaces.items()}
+        }
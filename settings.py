@@ -1,5 +1,6 @@
 from pydantic_settings import BaseSettings
 from pathlib import Path
+from typing import Dict, List
 import os
 
 class Settings(BaseSettings):
@@ -11,27 +12,112 @@ class Settings(BaseSettings):
 
     # Ollama
     OLLAMA_HOST: str = "http://localhost:11434"
+    OLLAMA_HOSTS: List[str] = [] # Varios backends, ej. ["http://gpu1:11434", "http://gpu2:11434"]; vacío = OLLAMA_HOST
+    OLLAMA_HEALTH_INTERVAL: float = 15.0 # segundos entre chequeos de /api/tags y /api/ps
     DEFAULT_MODEL: str = "llama3.1:8b"
     VISION_MODEL: str = "llava:13b"
+    EMBEDDING_MODEL: str = "nomic-embed-text"
+    OLLAMA_KEEP_ALIVE: str = "30m" # Tiempo que Ollama mantiene el modelo cargado
+    MODEL_PRELOAD: List[str] = [] # Modelos a cargar al arrancar (vacío = DEFAULT_MODEL)
+    MODEL_PINNED: List[str] = [] # Siempre cargados (keep_alive -1), nunca se descargan
+    MODEL_KEEP_ALIVE: Dict[str, str] = {} # keep_alive por modelo; el resto usa OLLAMA_KEEP_ALIVE
+    MODEL_RAM_BUDGET_MB: int = 0 # Memoria para modelos cargados por backend (0 = lo gestiona Ollama)
+    OLLAMA_CONTEXT_MAX_TOKENS: int = 8192 # Por encima se reconstruye el prompt en vez de continuar
+
+    # Cliente HTTP hacia Ollama (compartido por toda la app)
+    OLLAMA_MAX_CONNECTIONS: int = 20
+    OLLAMA_MAX_KEEPALIVE: int = 10
+    OLLAMA_KEEPALIVE_EXPIRY: float = 60.0 # segundos
+    OLLAMA_CONNECT_TIMEOUT: float = 5.0 # segundos
+    OLLAMA_READ_TIMEOUT: float = 120.0 # Modelos locales pueden ser lentos
+    OLLAMA_FIRST_TOKEN_TIMEOUT: float = 60.0 # espera máxima del primer token en streaming
+
+    # Contexto de conversación
+    CONTEXT_MAX_MESSAGES: int = 40 # Mensajes recientes leídos por petición
+    CONTEXT_TOKEN_BUDGET: int = 3000 # Tokens de historial enviados al modelo
+    CONTEXT_CHARS_PER_TOKEN: int = 4 # Estimación sin tokenizer
+    CONTEXT_SUMMARY_BATCH: int = 20 # Mensajes plegados en el resumen por actualización
+
+    # Planificador de peticiones al modelo
+    SCHEDULER_DEFAULT_CONCURRENCY: int = 2 # Generaciones simultáneas por modelo
+    SCHEDULER_MODEL_CONCURRENCY: Dict[str, int] = {} # Límites por modelo, ej. {"llava:13b": 1}
+    SCHEDULER_MAX_QUEUE: int = 64 # Peticiones en espera por modelo
+    SCHEDULER_MAX_WAIT: float = 30.0 # segundos de espera estimada antes de responder 503
+    SCHEDULER_QUANTUM: int = 1000 # Tokens acreditados por turno a cada usuario (DRR)
 
     # Ejecutor de código
     EXECUTOR_TIMEOUT: int = 10
     EXECUTOR_MAX_OUTPUT: int = 5000
+    EXECUTOR_POOL_SIZE: int = 2 # Intérpretes Python pre-arrancados
+    EXECUTOR_MAX_CONCURRENCY: int = 4 # Ejecuciones simultáneas
+    EXECUTOR_MAX_QUEUE: int = 32 # Ejecuciones en espera
+    EXECUTOR_MEMORY_MB: int = 512 # RLIMIT_AS por ejecución
+    EXECUTOR_MAX_FDS: int = 64 # RLIMIT_NOFILE por ejecución
 
     # Caché
     CACHE_TTL: int = 3600 # segundos
+    STATE_BACKEND: str = "sqlite" # sqlite (cache/cache.db, compartido entre workers) | memory (un solo proceso)
+    CACHE_MAX_ENTRIES: int = 1000 # Entradas en memoria (LRU)
+    CACHE_MAX_BYTES: int = 64 * 1024 * 1024 # Bytes en memoria (LRU)
+    CACHE_DISK_MAX_ENTRIES: int = 100_000 # Entradas en el almacén compartido (STATE_BACKEND)
+    CACHE_SWEEP_INTERVAL: int = 60 # segundos entre limpiezas de expirados
+    STATE_BUSY_TIMEOUT: int = 250 # ms esperando el lock de cache.db (se espera en el event loop)
+    IMAGE_CACHE_MAX_ENTRIES: int = 100 # Imágenes preprocesadas en memoria (caché aparte del de respuestas)
+    IMAGE_CACHE_MAX_BYTES: int = 64 * 1024 * 1024
+    IMAGE_CACHE_DISK_MAX_ENTRIES: int = 5000
+    SEMANTIC_CACHE_ENABLED: bool = False # Caché por similitud de embeddings (opt-in)
+    SEMANTIC_CACHE_THRESHOLD: float = 0.92 # Similitud coseno mínima para reutilizar una respuesta
+    SEMANTIC_CACHE_MAX_ENTRIES: int = 5000 # Por modelo
+    RESPONSE_CACHE_ENABLED: bool = False # Caché de respuestas exactas en /process (opt-in)
 
     # Rate Limiter
     RATE_LIMIT_MAX_REQUESTS: int = 100
     RATE_LIMIT_WINDOW: int = 3600 # segundos
+    RATE_LIMIT_BURST: int = 0 # Peticiones seguidas permitidas (0 = RATE_LIMIT_MAX_REQUESTS)
+    RATE_LIMIT_MAX_USERS: int = 100_000 # Buckets guardados a la vez (los inactivos se barren)
 
     # Whisper
     USE_WHISPER: bool = True
     WHISPER_MODEL: str = "base"
+    WHISPER_WORKERS: int = 1 # Procesos del pool (cada uno carga su copia del modelo)
+    WHISPER_TIMEOUT: float = 300.0 # segundos por transcripción
+
+    # SQLite (conversations.db)
+    SQLITE_JOURNAL_MODE: str = "WAL" # Lectores concurrentes con un escritor
+    SQLITE_SYNCHRONOUS: str = "NORMAL" # Con WAL: sin fsync por commit, durable salvo corte de luz
+    SQLITE_CACHE_SIZE: int = -65536 # Negativo = KiB (64 MB)
+    SQLITE_MMAP_SIZE: int = 268435456 # 256 MB
+    SQLITE_BUSY_TIMEOUT: int = 5000 # ms esperando el lock antes de fallar
+    MESSAGE_WRITE_BATCH: int = 200 # Filas máximas por transacción del escritor diferido
+    MESSAGE_WRITE_DELAY_MS: int = 5 # Espera máxima para agrupar inserciones
 
     # Otros
     LOG_LEVEL: str = "INFO"
+    REQUEST_LOG_BATCH: int = 500 # Líneas por escritura del log de peticiones
+    REQUEST_LOG_FLUSH_INTERVAL: float = 1.0 # segundos máximos antes de escribir un lote
+    REQUEST_LOG_MAX_QUEUE: int = 10_000 # Líneas en espera; si se llena se descartan
+    EVENT_LOOP_LAG_INTERVAL: float = 0.1 # segundos entre muestras del retraso del event loop (/metrics)
     MAX_UPLOAD_SIZE: int = 100 # MB
+    UPLOADS_RETENTION_HOURS: float = 24.0 # Subidas sin usar durante este tiempo se borran (0 = conservar siempre)
+    UPLOADS_SWEEP_INTERVAL: float = 3600.0 # segundos entre limpiezas de UPLOADS_DIR
+    VISION_MAX_SIDE: int = 1024 # px; las imágenes se reducen a este lado máximo antes del modelo de visión
+    VISION_JPEG_QUALITY: int = 85
+    DOCUMENT_CHUNK_TOKENS: int = 1500 # Tamaño de cada trozo a resumir
+    DOCUMENT_MAX_PARALLEL: int = 4 # Resúmenes de trozos en paralelo por documento
+    DOCUMENT_MAX_CHUNKS: int = 200 # Trozos procesados como máximo por documento
+    DOCUMENT_FETCH_TIMEOUT: float = 30.0 # segundos, descarga de URLs
+    DOCUMENT_FETCH_MAX_REDIRECTS: int = 5
+    DOCUMENT_FETCH_ALLOW_PRIVATE: bool = False # Permitir URLs a localhost/red privada (Ollama, servicios internos)
+
+    # Recuperación sobre documentos (RAG, índice en CACHE_DIR/rag)
+    RAG_ENABLED: bool = True
+    RAG_CHUNK_TOKENS: int = 300 # Tamaño de cada pasaje indexado
+    RAG_MAX_CHUNKS: int = 5000 # Pasajes indexados como máximo por documento
+    RAG_EMBED_BATCH: int = 32 # Pasajes por llamada a /api/embed
+    RAG_TOP_K: int = 5 # Pasajes inyectados en el prompt
+    RAG_MIN_SCORE: float = 0.3 # Similitud mínima para usar pasajes sin documento adjunto
+    RAG_IVF_MIN_ROWS: int = 20_000 # A partir de aquí se particiona el índice (IVF)
+    RAG_IVF_NPROBE: int = 8 # Particiones exploradas por búsqueda
 
     class Config:
         env_file = ".env"
@@ -0,0 +1,166 @@
+"""
+Almacenes clave-valor con expiración para el estado compartido (caché de respuestas e imágenes, rate limiter)
+- memory: dentro del proceso, para un solo worker
+- sqlite: fichero en WAL compartido por todos los workers de uvicorn del mismo host
+Los valores son texto (JSON); update() hace lectura-modificación-escritura atómica
+Las llamadas son síncronas y se hacen desde el event loop: los barridos borran por lotes
+(transacciones cortas) y la espera por el lock de escritura es breve
+"""
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Optional, Tuple
+import sqlite3
+import time
+
+STATE_BACKENDS = ("sqlite", "memory")
+SWEEP_BATCH = 1000 # Filas por transacción de barrido; entre lotes otros workers pueden escribir
+
+# fn(valor actual o None) -> (nuevo valor, expires_at, resultado para quien llama)
+UpdateFn = Callable[[Optional[str]], Tuple[str, float, object]]
+
+
+class MemoryStore:
+    """Diccionario LRU acotado, solo visible dentro del proceso"""
+    def __init__(self, max_entries: int, sweep_interval: float = 60.0):
+        self.max_entries = max_entries
+        self.sweep_interval = sweep_interval
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict() # key -> (data, expires_at)
+        self._last_sweep = time.time()
+
+    def get(self, key: str) -> Optional[tuple]:
+        """Devuelve (data, expires_at) o None"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def set(self, key: str, data: str, expires_at: float):
+        self._entries.pop(key, None)
+        self._entries[key] = (data, expires_at)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        self._maybe_sweep()
+
+    def update(self, key: str, fn: UpdateFn):
+        entry = self.get(key)
+        data, expires_at, result = fn(entry[0] if entry else None)
+        self.set(key, data, expires_at)
+        return result
+
+    def _maybe_sweep(self):
+        if time.time() - self._last_sweep >= self.sweep_interval:
+            self.sweep()
+
+    def sweep(self, max_rows: Optional[int] = None) -> int:
+        now = self._last_sweep = time.time()
+        expired = [key for key, (_, expires_at) in self._entries.items() if expires_at <= now]
+        for key in expired:
+            del self._entries[key]
+        return len(expired)
+
+    def count(self) -> int:
+        return len(self._entries)
+
+    def close(self):
+        self._entries.clear()
+
+
+class SQLiteStore:
+    """Tabla en un fichero SQLite (WAL): la ven todos los procesos que lo abren"""
+    def __init__(self, path: Path, table: str, max_entries: int, sweep_interval: float = 60.0,
+                 busy_timeout: int = 250):
+        self.table = table
+        self.max_entries = max_entries
+        self.sweep_interval = sweep_interval
+        # ms esperando el lock de otro worker: bloquea el event loop, así que se mantiene corto
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=busy_timeout / 1000)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL)")
+        self._db.execute(f"CREATE INDEX IF NOT EXISTS ix_{table}_expires_at ON {table} (expires_at)")
+        self._last_sweep = time.time()
+        self._sweep_pending = False # El último barrido agotó su lote y quedan filas
+
+    def get(self, key: str) -> Optional[tuple]:
+        return self._db.execute(
+            f"SELECT data, expires_at FROM {self.table} WHERE key = ? AND expires_at > ?", (key, time.time())
+        ).fetchone()
+
+    def set(self, key: str, data: str, expires_at: float):
+        self._db.execute(f"INSERT OR REPLACE INTO {self.table} (key, data, expires_at) VALUES (?, ?, ?)", (key, data, expires_at))
+        self._maybe_sweep()
+
+    def update(self, key: str, fn: UpdateFn):
+        # BEGIN IMMEDIATE toma el lock de escritura antes de leer: otro worker no puede intercalarse
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            row = self._db.execute(
+                f"SELECT data FROM {self.table} WHERE key = ? AND expires_at > ?", (key, time.time())
+            ).fetchone()
+            data, expires_at, result = fn(row[0] if row else None)
+            self._db.execute(f"INSERT OR REPLACE INTO {self.table} (key, data, expires_at) VALUES (?, ?, ?)", (key, data, expires_at))
+            self._db.execute("COMMIT")
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        self._maybe_sweep()
+        return result
+
+    def _maybe_sweep(self):
+        """Barrido oportunista en escrituras: como mucho un lote por llamada"""
+        if self._sweep_pending or time.time() - self._last_sweep >= self.sweep_interval:
+            try:
+                self.sweep(SWEEP_BATCH)
+            except sqlite3.OperationalError:
+                pass # Otro worker tiene el lock; la escritura ya se hizo, se barre más tarde
+
+    def sweep(self, max_rows: Optional[int] = None) -> int:
+        """
+        Elimina expirados y recorta al límite (primero los que antes expiran), en lotes de
+        SWEEP_BATCH filas para no retener el lock de escritura. Con `max_rows` para tras
+        ese número de filas y el resto se barre en las siguientes escrituras
+        """
+        now = self._last_sweep = time.time()
+        budget = max_rows if max_rows is not None else float("inf")
+        removed = 0
+        while removed < budget:
+            batch = int(min(SWEEP_BATCH, budget - removed))
+            deleted = self._db.execute(
+                f"DELETE FROM {self.table} WHERE rowid IN "
+                f"(SELECT rowid FROM {self.table} WHERE expires_at <= ? LIMIT ?)", (now, batch)
+            ).rowcount
+            removed += deleted
+            if deleted < batch:
+                break
+        excess = self.count() - self.max_entries
+        while excess > 0 and removed < budget:
+            batch = int(min(SWEEP_BATCH, excess, budget - removed))
+            deleted = self._db.execute(
+                f"DELETE FROM {self.table} WHERE rowid IN "
+                f"(SELECT rowid FROM {self.table} ORDER BY expires_at LIMIT ?)", (batch,)
+            ).rowcount
+            removed += deleted
+            excess -= deleted
+            if deleted < batch:
+                break
+        self._sweep_pending = removed >= budget
+        return removed
+
+    def count(self) -> int:
+        return self._db.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+    def close(self):
+        self._db.close()
+
+
+def open_store(backend: str, path: Path, table: str, max_entries: int, sweep_interval: float = 60.0,
+               busy_timeout: int = 250):
+    if backend == "memory":
+        return MemoryStore(max_entries, sweep_interval)
+    if backend == "sqlite":
+        return SQLiteStore(path, table, max_entries, sweep_interval, busy_timeout)
+    raise ValueError(f"Backend de estado desconocido: {backend} (opciones: {', '.join(STATE_BACKENDS)})")
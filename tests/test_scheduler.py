@@ -0,0 +1,56 @@
+import asyncio
+
+from scheduler import ModelScheduler
+
+
+def make_scheduler(limit: int = 1) -> ModelScheduler:
+    return ModelScheduler(default_limit=limit, limits={}, max_queue=10, max_wait=60.0, quantum=1)
+
+
+def test_cancel_then_release_does_not_leak_slot():
+    async def scenario():
+        scheduler = make_scheduler()
+        ticket = await scheduler.acquire("m", "a")
+        waiting = asyncio.create_task(scheduler.acquire("m", "b"))
+        await asyncio.sleep(0)
+        assert scheduler.get_stats()["m"]["queued"] == 1
+
+        # Cancelar y liberar en el mismo paso del loop: el futuro ya está cancelado
+        # pero la tarea todavía no ha procesado su CancelledError
+        waiting.cancel()
+        scheduler.release(ticket)
+        stats = scheduler.get_stats()["m"]
+        assert (stats["active"], stats["queued"]) == (0, 0)
+
+        try:
+            await waiting
+        except asyncio.CancelledError:
+            pass
+        stats = scheduler.get_stats()["m"]
+        assert (stats["active"], stats["queued"]) == (0, 0)
+
+        # El modelo sigue admitiendo peticiones
+        ticket = await asyncio.wait_for(scheduler.acquire("m", "c"), timeout=1)
+        scheduler.release(ticket)
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_is_skipped_for_the_next_one():
+    async def scenario():
+        scheduler = make_scheduler()
+        ticket = await scheduler.acquire("m", "a")
+        cancelled = asyncio.create_task(scheduler.acquire("m", "b"))
+        waiting = asyncio.create_task(scheduler.acquire("m", "c"))
+        await asyncio.sleep(0)
+
+        cancelled.cancel()
+        scheduler.release(ticket)
+        next_ticket = await asyncio.wait_for(waiting, timeout=1)
+        assert cancelled.cancelled()
+        stats = scheduler.get_stats()["m"]
+        assert (stats["active"], stats["queued"]) == (1, 0)
+        scheduler.release(next_ticket)
+        assert scheduler.get_stats()["m"]["active"] == 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,104 @@
+"""
+Almacén de subidas direccionado por contenido
+Cada archivo se copia por bloques a UPLOADS_DIR/<sha256[:2]>/<sha256>, calculando el hash
+a la vez; el límite de tamaño se aplica durante la copia y el tipo MIME se detecta solo
+con los primeros KB. Las subidas repetidas del mismo contenido no se duplican en disco.
+Los archivos solo se usan durante la petición que los sube: sweep() borra los que no se
+han vuelto a subir en un tiempo (cada subida repetida renueva su fecha de modificación).
+Las funciones son bloqueantes: se llaman con asyncio.to_thread
+"""
+from pathlib import Path
+from typing import BinaryIO, Optional
+import hashlib
+import os
+import tempfile
+import time
+
+import magic
+
+CHUNK_SIZE = 1024 * 1024
+SNIFF_SIZE = 2048 # Bytes que recibe magic
+
+
+class UploadTooLarge(Exception):
+    def __init__(self, max_bytes: int):
+        super().__init__(f"Archivo demasiado grande > {max_bytes // (1024 * 1024)}MB")
+        self.max_bytes = max_bytes
+
+
+class StoredUpload:
+    """Archivo ya guardado en el almacén"""
+    __slots__ = ("sha256", "path", "size", "mime_type", "deduplicated")
+
+    def __init__(self, sha256: str, path: Path, size: int, mime_type: str, deduplicated: bool):
+        self.sha256 = sha256
+        self.path = path
+        self.size = size
+        self.mime_type = mime_type
+        self.deduplicated = deduplicated
+
+
+class UploadStore:
+    def __init__(self, root: Path, max_bytes: int, chunk_size: int = CHUNK_SIZE):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self._tmp_dir = root / "tmp"
+        self._tmp_dir.mkdir(parents=True, exist_ok=True)
+
+    def path_for(self, sha256: str) -> Path:
+        return self.root / sha256[:2] / sha256
+
+    def save(self, source: BinaryIO, fallback_mime: Optional[str] = None) -> StoredUpload:
+        """Copia `source` al almacén. Lanza UploadTooLarge en cuanto se supera el límite"""
+        digest = hashlib.sha256()
+        size = 0
+        head = b""
+        fd, tmp_name = tempfile.mkstemp(dir=self._tmp_dir)
+        try:
+            with os.fdopen(fd, "wb") as tmp:
+                while chunk := source.read(self.chunk_size):
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise UploadTooLarge(self.max_bytes)
+                    if len(head) < SNIFF_SIZE:
+                        head += chunk[:SNIFF_SIZE - len(head)]
+                    digest.update(chunk)
+                    tmp.write(chunk)
+            sha256 = digest.hexdigest()
+            path = self.path_for(sha256)
+            deduplicated = path.exists()
+            if deduplicated:
+                try:
+                    os.utime(path) # Sigue en uso: no caduca en sweep()
+                    os.unlink(tmp_name)
+                except FileNotFoundError:
+                    deduplicated = False # sweep() lo borró entre medias: se vuelve a escribir
+            if not deduplicated:
+                path.parent.mkdir(exist_ok=True)
+                os.replace(tmp_name, path) # Atómico: nunca se ve un archivo a medias
+        except BaseException:
+            if os.path.exists(tmp_name):
+                os.unlink(tmp_name)
+            raise
+        try:
+            mime_type = magic.from_buffer(head, mime=True)
+        except Exception:
+            mime_type = fallback_mime or "application/octet-stream"
+        return StoredUpload(sha256, path, size, mime_type, deduplicated)
+
+    def sweep(self, max_age: float) -> int:
+        """Borra archivos (y temporales abandonados) modificados hace más de `max_age` segundos"""
+        cutoff = time.time() - max_age
+        removed = 0
+        for directory in self.root.iterdir():
+            if not directory.is_dir():
+                continue
+            for path in directory.iterdir():
+                try:
+                    if path.stat().st_mtime < cutoff:
+                        path.unlink()
+                        removed += 1
+                except FileNotFoundError:
+                    pass # Otro worker lo borró antes
+        return removed
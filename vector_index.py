@@ -0,0 +1,306 @@
+"""
+Índice vectorial local para recuperación (RAG) sobre documentos subidos
+- vectors.f32: matriz float32 (filas normalizadas) que se abre con np.memmap y crece por append
+- chunks.jsonl: una línea por fila con documento, posición y texto (se lee solo para el top-k)
+- docs.jsonl: documentos y qué usuarios pueden consultarlos
+- ivf.npz: particionado opcional (centroides k-means + lista de cada fila) a partir de ivf_min_rows
+Las escrituras toman un flock, así que varios workers pueden compartir el directorio;
+dentro de un proceso, un RLock protege el estado en memoria (se usa desde hilos de asyncio.to_thread)
+"""
+from pathlib import Path
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Set
+import fcntl
+import json
+import os
+import threading
+
+import numpy as np
+
+
+class VectorIndex:
+    def __init__(self, root: Path, ivf_min_rows: int = 20_000, nprobe: int = 8):
+        self.root = root
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.ivf_min_rows = ivf_min_rows
+        self.nprobe = nprobe
+        self._vectors_path = root / "vectors.f32"
+        self._chunks_path = root / "chunks.jsonl"
+        self._docs_path = root / "docs.jsonl"
+        self._header_path = root / "index.json"
+        self._ivf_path = root / "ivf.npz"
+        self._lock_path = root / ".lock"
+        self._state_lock = threading.RLock()
+        self._load()
+
+    # --- Carga y sincronización entre procesos ---
+    def _load(self):
+        """Estado vacío y lectura completa; después _refresh solo lee lo añadido"""
+        self.dim: Optional[int] = None
+        self.model: Optional[str] = None
+        self.docs: List[dict] = [] # código -> {"sha256", "filename"}
+        self.doc_codes: Dict[str, int] = {}
+        self.user_docs: Dict[str, Set[int]] = {}
+        self.count = 0
+        self.row_doc = np.zeros(0, dtype=np.int32)
+        self.offsets = np.zeros(0, dtype=np.int64)
+        self._matrix = None
+        self.centroids: Optional[np.ndarray] = None
+        self.assign: Optional[np.ndarray] = None
+        self.trained_rows = 0
+        self._docs_read = 0 # Bytes de docs.jsonl ya aplicados
+        self._chunks_read = 0 # Bytes de chunks.jsonl ya leídos
+        self._pending_rows: List[tuple] = [] # (doc, offset) leídos cuyo vector aún no está escrito
+        self._ivf_mtime: Optional[float] = None
+        self._read_new()
+
+    def _read_lines(self, path: Path, start: int):
+        """Líneas completas a partir del byte `start`: (offset, línea); una línea a medias se deja"""
+        if not path.exists():
+            return
+        with open(path, "rb") as f:
+            f.seek(start)
+            offset = start
+            for line in f:
+                if not line.endswith(b"\n"):
+                    return
+                yield offset, line
+                offset += len(line)
+
+    def _read_new(self):
+        """Aplica solo lo que otros workers añadieron desde la última lectura"""
+        if self.dim is None and self._header_path.exists():
+            header = json.loads(self._header_path.read_text())
+            self.dim, self.model = header.get("dim"), header.get("model")
+        for offset, line in self._read_lines(self._docs_path, self._docs_read):
+            self._apply_doc(json.loads(line))
+            self._docs_read = offset + len(line)
+        for offset, line in self._read_lines(self._chunks_path, self._chunks_read):
+            self._pending_rows.append((json.loads(line)["doc"], offset))
+            self._chunks_read = offset + len(line)
+        # Solo filas completas en ambos archivos (una escritura interrumpida o en curso no se cuenta)
+        take = min(len(self._pending_rows), self._vector_rows() - self.count)
+        if take > 0:
+            new_rows, self._pending_rows = self._pending_rows[:take], self._pending_rows[take:]
+            self.row_doc = np.concatenate([self.row_doc, np.array([doc for doc, _ in new_rows], dtype=np.int32)])
+            self.offsets = np.concatenate([self.offsets, np.array([offset for _, offset in new_rows], dtype=np.int64)])
+            self.count += take
+            self._matrix = None
+        ivf_mtime = self._ivf_path.stat().st_mtime if self._ivf_path.exists() else None
+        if ivf_mtime != self._ivf_mtime:
+            ivf = np.load(self._ivf_path)
+            self.centroids, self.assign, self.trained_rows = ivf["centroids"], ivf["assign"], int(ivf["trained_rows"])
+            self._ivf_mtime = ivf_mtime
+        if self.centroids is not None and len(self.assign) < self.count:
+            self.assign = np.concatenate([self.assign, self._nearest(np.arange(len(self.assign), self.count))])
+
+    def _vector_rows(self) -> int:
+        if not self.dim or not self._vectors_path.exists():
+            return 0
+        return self._vectors_path.stat().st_size // (self.dim * 4)
+
+    def _refresh(self):
+        """Otro worker añadió filas o documentos: leer solo lo nuevo"""
+        with self._state_lock:
+            docs_size = self._docs_path.stat().st_size if self._docs_path.exists() else 0
+            if self._vector_rows() != self.count or docs_size != self._docs_read:
+                self._read_new()
+
+    def _apply_doc(self, record: dict):
+        code = self.doc_codes.get(record["sha256"])
+        if code is None:
+            code = self.doc_codes[record["sha256"]] = len(self.docs)
+            self.docs.append({"sha256": record["sha256"], "filename": record.get("filename")})
+        self.user_docs.setdefault(record["user_id"], set()).add(code)
+
+    def matrix(self) -> np.ndarray:
+        if self._matrix is None or self._matrix.shape[0] != self.count:
+            self._matrix = np.memmap(self._vectors_path, dtype=np.float32, mode="r", shape=(self.count, self.dim)) if self.count else np.zeros((0, self.dim or 0), np.float32)
+        return self._matrix
+
+    # --- Escritura incremental ---
+    def has_document(self, sha256: str) -> bool:
+        with self._state_lock:
+            self._refresh()
+            return self._indexed(sha256)
+
+    def _indexed(self, sha256: str) -> bool:
+        code = self.doc_codes.get(sha256)
+        return code is not None and bool(np.any(self.row_doc == code))
+
+    def _has_access(self, sha256: str, user_id: str) -> bool:
+        code = self.doc_codes.get(sha256)
+        return code is not None and code in self.user_docs.get(user_id, set())
+
+    def has_user_documents(self, user_id: str) -> bool:
+        with self._state_lock:
+            self._refresh()
+            return bool(self.user_docs.get(user_id))
+
+    def grant(self, sha256: str, user_id: str, filename: Optional[str] = None):
+        """Da acceso a un documento ya indexado (mismo contenido subido por otro usuario)"""
+        with self._state_lock:
+            if self._has_access(sha256, user_id):
+                return
+        with self._locked():
+            if not self._has_access(sha256, user_id):
+                self._append_doc(sha256, user_id, filename)
+
+    def add(self, sha256: str, user_id: str, filename: Optional[str], chunks: List[str], vectors: np.ndarray, model: str) -> bool:
+        """
+        Añade las filas del documento; devuelve False si otro worker ya lo indexó mientras
+        se calculaban los embeddings (entonces solo se da acceso al usuario)
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.where(norms > 0, norms, 1)
+        with self._locked():
+            # Comprobación repetida bajo el lock: has_document() se consultó antes, sin él
+            if self._indexed(sha256):
+                if not self._has_access(sha256, user_id):
+                    self._append_doc(sha256, user_id, filename)
+                return False
+            if self.dim is None:
+                self.dim, self.model = vectors.shape[1], model
+                self._header_path.write_text(json.dumps({"dim": self.dim, "model": model}))
+            elif vectors.shape[1] != self.dim or model != self.model:
+                raise ValueError(f"El índice usa {self.model} ({self.dim} dim); no se puede mezclar con {model}")
+            code = self._append_doc(sha256, user_id, filename)
+            offset = self._chunks_path.stat().st_size if self._chunks_path.exists() else 0
+            offsets = []
+            with open(self._chunks_path, "ab") as f:
+                for i, text in enumerate(chunks):
+                    line = (json.dumps({"doc": code, "chunk": i, "text": text}, ensure_ascii=False) + "\n").encode("utf-8")
+                    f.write(line)
+                    offsets.append(offset)
+                    offset += len(line)
+            # Los vectores se escriben al final: una fila solo cuenta cuando existe en ambos archivos
+            with open(self._vectors_path, "ab") as f:
+                f.write(vectors.tobytes())
+            start = self.count
+            self.count += len(chunks)
+            self.row_doc = np.concatenate([self.row_doc, np.full(len(chunks), code, dtype=np.int32)])
+            self.offsets = np.concatenate([self.offsets, np.array(offsets, dtype=np.int64)])
+            self._chunks_read, self._pending_rows = offset, []
+            self._matrix = None
+            self._update_ivf(start)
+        return True
+
+    def _append_doc(self, sha256: str, user_id: str, filename: Optional[str]) -> int:
+        record = {"sha256": sha256, "user_id": user_id, "filename": filename}
+        with open(self._docs_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._apply_doc(record)
+        self._docs_read = self._docs_path.stat().st_size # Bajo el flock: no hay líneas ajenas sin leer
+        return self.doc_codes[sha256]
+
+    @contextmanager
+    def _locked(self):
+        """Exclusión entre procesos (flock) y entre hilos (RLock); dentro se ve siempre el estado más reciente"""
+        with self._state_lock, open(self._lock_path, "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self._refresh()
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    # --- Particionado IVF ---
+    def _nearest(self, rows: np.ndarray, batch: int = 65536) -> np.ndarray:
+        matrix = self.matrix()
+        return np.concatenate([
+            np.argmax(matrix[rows[i:i + batch]] @ self.centroids.T, axis=1).astype(np.int32)
+            for i in range(0, len(rows), batch)
+        ]) if len(rows) else np.zeros(0, np.int32)
+
+    def _update_ivf(self, first_new_row: int):
+        if self.count < self.ivf_min_rows:
+            return
+        if self.centroids is None or self.count >= 2 * self.trained_rows:
+            self._train_ivf()
+        else:
+            self.assign = np.concatenate([self.assign, self._nearest(np.arange(first_new_row, self.count))])
+        # Reemplazo atómico: otros workers leen ivf.npz en _load sin tomar el flock
+        tmp = self._ivf_path.with_suffix(".tmp")
+        with open(tmp, "wb") as f:
+            np.savez(f, centroids=self.centroids, assign=self.assign, trained_rows=self.trained_rows)
+        os.replace(tmp, self._ivf_path)
+        self._ivf_mtime = self._ivf_path.stat().st_mtime
+
+    def _train_ivf(self, iterations: int = 10, sample_size: int = 50_000):
+        """k-means esférico sobre una muestra; nlist ~ sqrt(filas)"""
+        matrix = self.matrix()
+        nlist = max(1, int(np.sqrt(self.count)))
+        rng = np.random.default_rng(0)
+        sample = np.asarray(matrix[np.sort(rng.choice(self.count, min(sample_size, self.count), replace=False))])
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)]
+        for _ in range(iterations):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            # Centroides vacíos conservan su posición
+            centroids = np.where(norms > 0, sums / np.where(norms > 0, norms, 1), centroids)
+        self.centroids = centroids.astype(np.float32)
+        self.trained_rows = self.count
+        self.assign = self._nearest(np.arange(self.count))
+
+    # --- Búsqueda ---
+    def search(self, query: List[float], user_id: str, k: int, sha256: Optional[str] = None) -> List[dict]:
+        """Top-k por similitud coseno entre los documentos del usuario (o solo uno)"""
+        # Instantánea bajo el lock: add() sustituye los arrays (no los modifica en sitio)
+        # y docs solo crece, así que el cálculo puede seguir fuera del lock
+        with self._state_lock:
+            self._refresh()
+            allowed = set(self.user_docs.get(user_id, set()))
+            if sha256 is not None:
+                allowed &= {self.doc_codes.get(sha256)}
+            count, row_doc, offsets, docs = self.count, self.row_doc, self.offsets, self.docs
+            centroids, assign = self.centroids, self.assign
+            matrix = self.matrix()
+        if not count or not allowed:
+            return []
+        q = np.asarray(query, dtype=np.float32)
+        q /= np.linalg.norm(q) or 1
+        mask = np.isin(row_doc, list(allowed))
+        rows = np.flatnonzero(mask)
+        if not len(rows):
+            return []
+        # IVF solo si los candidatos permitidos son muchos: las filas de un documento pequeño
+        # caen casi siempre fuera de las nprobe listas. Si el sondeo deja menos de k, búsqueda exacta
+        if centroids is not None and len(assign) == count and len(rows) >= self.ivf_min_rows:
+            probe = np.argsort(centroids @ q)[-self.nprobe:]
+            probed = rows[np.isin(assign[rows], probe)]
+            if len(probed) >= k:
+                rows = probed
+        scores = (matrix if len(rows) == count else matrix[rows]) @ q
+        k = min(k, len(rows))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        results = []
+        with open(self._chunks_path, "rb") as f:
+            for i in top:
+                f.seek(int(offsets[rows[i]]))
+                record = json.loads(f.readline())
+                doc = docs[record["doc"]]
+                results.append({
+                    "score": round(float(scores[i]), 4),
+                    "text": record["text"],
+                    "chunk": record["chunk"],
+                    "sha256": doc["sha256"],
+                    "filename": doc["filename"]
+                })
+        return results
+
+    def get_stats(self) -> dict:
+        with self._state_lock:
+            self._refresh()
+            return {
+                "rows": self.count,
+                "dim": self.dim,
+                "model": self.model,
+                "documents": len(self.docs),
+                "users": len(self.user_docs),
+                "ivf_lists": len(self.centroids) if self.centroids is not None else 0,
+                "bytes": self._vectors_path.stat().st_size if self._vectors_path.exists() else 0
+            }
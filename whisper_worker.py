@@ -0,0 +1,42 @@
+"""
+Funciones que corren dentro de los procesos del pool de Whisper
+Módulo ligero a propósito: los workers (spawn) solo importan esto, no main.py
+"""
+import subprocess
+
+SAMPLE_RATE = 16000
+
+_model = None
+
+
+def init_worker(model_name: str):
+    """Carga el modelo una sola vez por proceso"""
+    global _model
+    import whisper
+    _model = whisper.load_model(model_name) # base, small, medium, large
+
+
+def ping() -> bool:
+    """Tarea vacía para arrancar el worker (y cargar el modelo) por adelantado"""
+    return _model is not None
+
+
+def decode_audio(audio):
+    """
+    Decodifica con ffmpeg a PCM mono 16 kHz. bytes: por stdin (sin archivo temporal);
+    str: ruta que ffmpeg lee directamente (no se copia el audio al worker)
+    """
+    import numpy as np # Solo en los workers: main.py importa este módulo sin pagar numpy
+    from_pipe = isinstance(audio, bytes)
+    result = subprocess.run(
+        ["ffmpeg", "-nostdin", "-threads", "0", "-i", "pipe:0" if from_pipe else audio,
+         "-f", "s16le", "-ac", "1", "-acodec", "pcm_s16le", "-ar", str(SAMPLE_RATE), "-"],
+        input=audio if from_pipe else None,
+        capture_output=True,
+        check=True
+    )
+    return np.frombuffer(result.stdout, np.int16).astype(np.float32) / 32768.0
+
+
+def transcribe(audio) -> str:
+    return _model.transcribe(decode_audio(audio))["text"]